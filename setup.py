@@ -21,6 +21,7 @@ setup(
     long_description=read("README.md"),
     package_dir={'': 'src'},
     packages=["ganon"],
+    install_requires=["multitax>=1.6.0,<1.7.0"],
     entry_points={'console_scripts': ['ganon=ganon.ganon:main_cli']},
     scripts=['scripts/ganon-get-seq-info.sh'],
     classifiers=[
@@ -30,6 +30,8 @@ std::optional< Config > CommandLineParser::parse( int argc, char** argv )
         ( "a,output-all", "Outputs file with all matches (prefix.all)", cxxopts::value< bool >() )
         ( "u,output-unclassified", "Outputs unclassified read ids (prefix.unc)", cxxopts::value< bool >() )
         ( "s,output-single", "Do not split output files (lca and all) with multi-level --hierarchy-labels", cxxopts::value< bool >() )
+        ( "b,output-binary", "Write output files (lca and all) in binary format", cxxopts::value< bool >() )
+        ( "z,output-compression", "Compress output files (rep, lca, all and unc) [gzip]. Adds .gz to the file names", cxxopts::value< std::string >() )
         
         ( "hibf", "Input is an Hierarchical IBF (.hibf) generated from raptor.", cxxopts::value< bool >())
         ( "skip-lca", "Skip LCA step.", cxxopts::value< bool >())
@@ -94,6 +96,10 @@ std::optional< Config > CommandLineParser::parse( int argc, char** argv )
         config.output_unclassified = args["output-unclassified"].as< bool >();
     if ( args.count( "output-single" ) )
         config.output_single = args["output-single"].as< bool >();
+    if ( args.count( "output-binary" ) )
+        config.output_binary = args["output-binary"].as< bool >();
+    if ( args.count( "output-compression" ) )
+        config.output_compression = args["output-compression"].as< std::string >();
 
     if ( args.count( "hibf" ) )
         config.hibf = args["hibf"].as< bool >();
@@ -5,6 +5,7 @@
 
 #include <utils/IBFConfig.hpp>
 #include <utils/LCA.hpp>
+#include <utils/OutputFile.hpp>
 #include <utils/SafeQueue.hpp>
 #include <utils/StopClock.hpp>
 #include <utils/adjust_seed.hpp>
@@ -53,6 +54,9 @@ typedef std::vector< std::tuple< size_t, std::string > >
 typedef robin_hood::unordered_map< std::string, std::vector< size_t > >                    TMap;
 typedef robin_hood::unordered_map< std::string, double >                                   TTargetFpr;
 
+// Number of reads written in each block of binary output files
+const size_t binary_block_size = 100000;
+
 struct Node
 {
     std::string parent;
@@ -223,6 +227,12 @@ struct Filter
     FilterConfig filter_config;
 };
 
+inline std::string output_ext( Config const& config )
+{
+    // Extension of the output files written with --output-compression
+    return config.output_compression == "gzip" ? ".gz" : "";
+}
+
 std::map< std::string, HierarchyConfig > parse_hierarchy( Config& config )
 {
 
@@ -251,13 +261,15 @@ std::map< std::string, HierarchyConfig > parse_hierarchy( Config& config )
             std::string output_file_all = "";
             if ( !config.output_prefix.empty() && unique_hierarchy > 1 && !config.output_single )
             {
-                output_file_lca = config.output_prefix + "." + config.hierarchy_labels[h] + ".one";
-                output_file_all = config.output_prefix + "." + config.hierarchy_labels[h] + ".all";
+                output_file_lca =
+                    config.output_prefix + "." + config.hierarchy_labels[h] + ".one" + output_ext( config );
+                output_file_all =
+                    config.output_prefix + "." + config.hierarchy_labels[h] + ".all" + output_ext( config );
             }
             else if ( !config.output_prefix.empty() )
             {
-                output_file_lca = config.output_prefix + ".one";
-                output_file_all = config.output_prefix + ".all";
+                output_file_lca = config.output_prefix + ".one" + output_ext( config );
+                output_file_all = config.output_prefix + ".all" + output_ext( config );
             }
 
             parsed_hierarchy[config.hierarchy_labels[h]] = HierarchyConfig{ fc,
@@ -299,7 +311,7 @@ void print_hierarchy( Config const& config, auto const& parsed_hierarchy )
         if ( !config.output_prefix.empty() )
         {
             std::cerr << "    Output files: ";
-            std::cerr << config.output_prefix + ".rep";
+            std::cerr << config.output_prefix + ".rep" + output_ext( config );
             if ( config.output_lca )
                 std::cerr << ", " << hierarchy_config.second.output_file_lca;
             if ( config.output_all )
@@ -651,7 +663,7 @@ void classify( std::vector< Filter< TFilter > >& filters,
     }
 }
 
-void write_report( TRep& rep, TTax& tax, std::ofstream& out_rep, std::string hierarchy_label )
+void write_report( TRep& rep, TTax& tax, std::ostream& out_rep, std::string hierarchy_label )
 {
     for ( auto const& [target, report] : rep )
     {
@@ -985,7 +997,7 @@ void parse_reads( SafeQueue< ReadBatches >& queue1, Stats& stats, Config const&
     queue1.notify_push_over();
 }
 
-void write_classified( SafeQueue< ReadOut >& classified_queue, std::ofstream& out )
+void write_classified( SafeQueue< ReadOut >& classified_queue, std::ostream& out )
 {
     while ( true )
     {
@@ -1004,9 +1016,93 @@ void write_classified( SafeQueue< ReadOut >& classified_queue, std::ofstream& ou
     }
 }
 
-void write_unclassified( SafeQueue< ReadOut >& unclassified_queue, std::string out_unclassified_file )
+void write_binary_block( std::vector< ReadOut >&    block,
+                         std::vector< std::string >& new_targets,
+                         robin_hood::unordered_map< std::string, uint32_t >& target_ids,
+                         std::ostream&               out )
 {
-    std::ofstream out_unclassified( out_unclassified_file );
+    /*
+     * Block of reads in binary format (all values uint32_t little-endian):
+     * n_new_targets, n_reads, n_matches
+     * length of new targets [n_new_targets], new targets (chars)
+     * length of read ids [n_reads], read ids (chars)
+     * number of matches per read [n_reads]
+     * target ids [n_matches] (in order of definition by new targets), kmer counts [n_matches]
+     */
+    std::vector< uint32_t > n_matches;
+    std::vector< uint32_t > targets;
+    std::vector< uint32_t > kcounts;
+    for ( auto const& ro : block )
+    {
+        n_matches.push_back( ro.matches.size() );
+        for ( auto const& match : ro.matches )
+        {
+            targets.push_back( target_ids.at( match.target ) );
+            kcounts.push_back( match.kmer_count );
+        }
+    }
+
+    auto write_uint32 = [&out]( uint32_t v ) { out.write( reinterpret_cast< const char* >( &v ), sizeof( v ) ); };
+    auto write_vector = [&out]( std::vector< uint32_t > const& v ) {
+        out.write( reinterpret_cast< const char* >( v.data() ), v.size() * sizeof( uint32_t ) );
+    };
+
+    write_uint32( new_targets.size() );
+    write_uint32( block.size() );
+    write_uint32( targets.size() );
+    for ( auto const& target : new_targets )
+        write_uint32( target.size() );
+    for ( auto const& target : new_targets )
+        out << target;
+    for ( auto const& ro : block )
+        write_uint32( ro.readID.size() );
+    for ( auto const& ro : block )
+        out << ro.readID;
+    write_vector( n_matches );
+    write_vector( targets );
+    write_vector( kcounts );
+
+    block.clear();
+    new_targets.clear();
+}
+
+void write_classified_binary( SafeQueue< ReadOut >& classified_queue, std::ostream& out, size_t block_size )
+{
+    // Every file (or hierarchy, if appended) starts with a header, target ids are defined in the blocks
+    out.write( "GANONBM\x01", 8 );
+    robin_hood::unordered_map< std::string, uint32_t > target_ids;
+    std::vector< std::string >                         new_targets;
+    std::vector< ReadOut >                             block;
+    while ( true )
+    {
+        ReadOut ro = classified_queue.pop();
+        if ( ro.readID != "" )
+        {
+            for ( auto const& match : ro.matches )
+            {
+                if ( target_ids.count( match.target ) == 0 )
+                {
+                    target_ids.emplace( match.target, target_ids.size() );
+                    new_targets.push_back( match.target );
+                }
+            }
+            block.push_back( std::move( ro ) );
+            if ( block.size() == block_size )
+                write_binary_block( block, new_targets, target_ids, out );
+        }
+        else
+        {
+            break;
+        }
+    }
+    if ( !block.empty() )
+        write_binary_block( block, new_targets, target_ids, out );
+}
+
+void write_unclassified( SafeQueue< ReadOut >& unclassified_queue, std::string out_unclassified_file, bool compressed )
+{
+    OutputFile out_unclassified;
+    out_unclassified.open( out_unclassified_file, compressed );
     while ( true )
     {
         ReadOut rou = unclassified_queue.pop();
@@ -1090,20 +1186,22 @@ bool ganon_classify( Config config )
     StopClock timeClassPrint;
 
     detail::Stats stats;
-    std::ofstream out_rep; // Set default output stream (file or stdout)
-    std::ofstream out_all; // output all file
-    std::ofstream out_lca; // output lca file
+    OutputFile out_rep; // Set default output stream (file or stdout)
+    OutputFile out_all; // output all file
+    OutputFile out_lca; // output lca file
+
+    // Output files are gzip compressed with --output-compression
+    const bool compressed = !config.output_compression.empty();
 
     // If there's no output prefix, redirect to STDOUT
     if ( config.output_prefix.empty() )
     {
         out_rep.copyfmt( std::cout ); // STDOUT
-        out_rep.clear( std::cout.rdstate() );
-        out_rep.basic_ios< char >::rdbuf( std::cout.rdbuf() );
+        out_rep.open( std::cout.rdbuf() );
     }
     else
     {
-        out_rep.open( config.output_prefix + ".rep" );
+        out_rep.open( config.output_prefix + ".rep" + detail::output_ext( config ), compressed );
     }
 
     // Queues for internal read handling
@@ -1132,7 +1230,8 @@ bool ganon_classify( Config config )
         write_unclassified_task = std::async( std::launch::async,
                                               detail::write_unclassified,
                                               std::ref( unclassified_queue ),
-                                              config.output_prefix + ".unc" );
+                                              config.output_prefix + ".unc" + detail::output_ext( config ),
+                                              compressed );
     }
 
 
@@ -1224,29 +1323,43 @@ bool ganon_classify( Config config )
         {
             if ( config.output_lca && !config.skip_lca )
             {
-                if ( hierarchy_first || !config.output_single )
-                    out_lca.open( hierarchy_config.output_file_lca );
-                else // append if not first and output_single
-                    out_lca.open( hierarchy_config.output_file_lca, std::ofstream::app );
+                // append if not first and output_single
+                out_lca.open( hierarchy_config.output_file_lca,
+                              compressed,
+                              !hierarchy_first && config.output_single );
 
                 // Start writing thread for lca matches
-                write_tasks.emplace_back( std::async( std::launch::async,
-                                                      detail::write_classified,
-                                                      std::ref( classified_lca_queue ),
-                                                      std::ref( out_lca ) ) );
+                if ( config.output_binary )
+                    write_tasks.emplace_back( std::async( std::launch::async,
+                                                          detail::write_classified_binary,
+                                                          std::ref( classified_lca_queue ),
+                                                          std::ref( out_lca ),
+                                                          detail::binary_block_size ) );
+                else
+                    write_tasks.emplace_back( std::async( std::launch::async,
+                                                          detail::write_classified,
+                                                          std::ref( classified_lca_queue ),
+                                                          std::ref( out_lca ) ) );
             }
             if ( config.output_all )
             {
-                if ( hierarchy_first || !config.output_single )
-                    out_all.open( hierarchy_config.output_file_all );
-                else // append if not first and output_single
-                    out_all.open( hierarchy_config.output_file_all, std::ofstream::app );
+                // append if not first and output_single
+                out_all.open( hierarchy_config.output_file_all,
+                              compressed,
+                              !hierarchy_first && config.output_single );
 
                 // Start writing thread for all matches
-                write_tasks.emplace_back( std::async( std::launch::async,
-                                                      detail::write_classified,
-                                                      std::ref( classified_all_queue ),
-                                                      std::ref( out_all ) ) );
+                if ( config.output_binary )
+                    write_tasks.emplace_back( std::async( std::launch::async,
+                                                          detail::write_classified_binary,
+                                                          std::ref( classified_all_queue ),
+                                                          std::ref( out_all ),
+                                                          detail::binary_block_size ) );
+                else
+                    write_tasks.emplace_back( std::async( std::launch::async,
+                                                          detail::write_classified,
+                                                          std::ref( classified_all_queue ),
+                                                          std::ref( out_all ) ) );
             }
         }
 
@@ -36,6 +36,8 @@ public:
     bool        output_all          = false;
     bool        output_unclassified = false;
     bool        output_single       = false;
+    bool        output_binary       = false;
+    std::string output_compression  = "";
 
     bool        hibf          = false;
     bool        skip_lca      = false;
@@ -134,6 +136,12 @@ public:
             return false;
         }
 
+        if ( !output_compression.empty() && output_compression != "gzip" )
+        {
+            std::cerr << "--output-compression should be gzip" << std::endl;
+            return false;
+        }
+
         if ( n_batches < 1 )
             n_batches = 1;
 
@@ -253,6 +261,8 @@ inline std::ostream& operator<<( std::ostream& stream, const Config& config )
     stream << "--output-all          " << config.output_all << newl;
     stream << "--output-unclassified " << config.output_unclassified << newl;
     stream << "--output-single       " << config.output_single << newl;
+    stream << "--output-binary       " << config.output_binary << newl;
+    stream << "--output-compression  " << config.output_compression << newl;
     stream << "--hibf                " << config.hibf << newl;
     stream << "--threads             " << config.threads << newl;
     stream << "--n-batches           " << config.n_batches << newl;
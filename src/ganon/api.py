@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+from copy import deepcopy
+
+from ganon.config import Config
+from ganon.report import load_report_tax, get_report_ranks, remove_hierarchy, build_report, report_rows
+from ganon.table import rank_reports, make_table, make_rank_tables
+
+# In-process functions for reports and tables without intermediate files
+# Input are parsed .rep entries (reports, counts) as returned by ganon.report.parse_rep:
+# reports = {hierarchy: {target: {"direct_matches": int, "unique_reads": int, "lca_reads": int}}}
+# counts = {hierarchy: {"matches": int, "reads": int}, "total": {"matches": int, "reads": int, "unclassified": int}}
+# Options are the same as in the command line (e.g. ranks=["species"], min_count=0.01), quiet by default
+
+report_columns = ["rank", "target", "lineage", "name", "unique",
+                  "shared", "children", "cumulative", "cumulative_perc"]
+
+
+def get_config(which: str, **kwargs):
+    """
+    Config for report or table with the same arguments and defaults as the command line
+    Input and output files are not used
+    """
+    files = {"report": {"input": ["-"], "output_prefix": "-"},
+             "table": {"input": ["-"], "output_file": "-"}}
+    kwargs.setdefault("quiet", True)
+    cfg = Config(which, **files[which], **kwargs)
+    if not cfg.validate():
+        raise ValueError("Invalid arguments for " + which)
+    cfg.set_defaults()
+    # Report files are only written on request
+    if which == "report":
+        cfg.output_prefix = ""
+    return cfg
+
+
+def load_taxonomy(**kwargs):
+    """
+    Load taxonomy and genome sizes as in ganon report (e.g. db_prefix=["db"] or taxonomy="ncbi", taxonomy_files=[...])
+    Returns tax, genome_sizes to be re-used in report() and table()
+    """
+    cfg = get_config("report", **kwargs)
+    tax, genome_sizes = load_report_tax(cfg)
+    if tax is None:
+        raise ValueError("Failed to get genome sizes")
+    return tax, genome_sizes
+
+
+def report(reports: dict, counts: dict, tax, genome_sizes=None, **kwargs):
+    """
+    Build a report for parsed .rep entries, all hierarchies together (--split-hierarchy is not used)
+    Returns a DataFrame with the same rows and values as the .tre file (tsv) or None if nothing to report
+    """
+    cfg = get_config("report", **kwargs)
+    check_genome_sizes(genome_sizes, cfg)
+
+    # Entries are modified when building reports
+    reports = deepcopy(reports)
+    if cfg.skip_hierarchy or cfg.keep_hierarchy:
+        reports = remove_hierarchy(reports, counts, cfg.skip_hierarchy, cfg.keep_hierarchy, cfg.quiet)
+    if not reports:
+        return None
+
+    default_ranks, fixed_ranks = get_report_ranks(cfg, tax)
+    rep = build_report(reports, counts, tax, genome_sizes, fixed_ranks, default_ranks, cfg)
+    if not rep:
+        return None
+    return pd.DataFrame(report_rows(rep, cfg), columns=report_columns)
+
+
+def table(samples: dict, tax, genome_sizes=None, **kwargs):
+    """
+    Build a table for parsed .rep entries of several samples {label: (reports, counts)}
+    Returns a DataFrame with the same values as the table file (taxa as rows, samples as cols by default)
+    or None if no taxa are left. With split_rank=True, returns {rank: DataFrame or None} for each rank
+    """
+    cfg = get_config("table", **kwargs)
+    check_genome_sizes(genome_sizes, cfg)
+
+    parsed = ((label, deepcopy(reports), counts) for label, (reports, counts) in samples.items())
+    table_reports, total_taxa = rank_reports(parsed, len(samples), tax, genome_sizes, cfg)
+    if not table_reports:
+        return None
+
+    if cfg.split_rank:
+        return {rank: table_dataframe(out_table) for rank, out_table in make_rank_tables(table_reports, cfg)}
+    return table_dataframe(make_table(table_reports, total_taxa, cfg))
+
+
+def table_dataframe(out_table):
+    if not out_table:
+        return None
+    values = np.zeros((len(out_table["rows"]), len(out_table["cols"])), dtype=out_table["value"].dtype)
+    values[out_table["row"], out_table["col"]] = out_table["value"]
+    return pd.DataFrame(values, index=out_table["rows"], columns=out_table["cols"])
+
+
+def check_genome_sizes(genome_sizes, cfg):
+    if cfg.report_type in ["abundance", "corr"] and genome_sizes is None:
+        raise ValueError("Genome sizes are required for --report-type " + cfg.report_type)
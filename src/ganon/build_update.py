@@ -21,6 +21,7 @@ from ganon.tax_util import get_sequence_info
 from ganon.tax_util import parse_sequence_accession
 from ganon.tax_util import parse_file_accession
 from ganon.tax_util import get_genome_size
+from ganon.tax_cache import load_tax, CompiledTx
 
 from multitax import NcbiTx, GtdbTx
 
@@ -307,7 +308,10 @@ def build_custom(cfg, which_call: str="build_custom"):
             genome_sizes = get_genome_size(cfg, unique_nodes, tax, build_output_folder)
             
             # filter only used tax. nodes
-            tax.filter(unique_nodes) 
+            if isinstance(tax, CompiledTx):
+                tax = tax.filter(unique_nodes)
+            else:
+                tax.filter(unique_nodes)
 
             # write tax with added nodes and genome sizes
             write_tax(cfg.db_prefix + ".tax", info, tax, genome_sizes, user_bins_col, cfg.level, cfg.input_target)
@@ -559,14 +563,18 @@ def load_taxonomy(cfg, build_output_folder):
     else:
         print_log("Downloading and parsing " + cfg.taxonomy + " taxonomy", cfg.quiet)
 
-    if cfg.taxonomy == "ncbi":
+    if cfg.taxonomy_files and cfg.taxonomy_cache:
+        # Compiled taxonomy is used directly, only the nodes used in the build are decoded
+        tax = load_tax(NcbiTx if cfg.taxonomy == "ncbi" else GtdbTx, cfg.taxonomy_files, cfg.taxonomy_cache, cfg.quiet)
+    elif cfg.taxonomy == "ncbi":
         tax = NcbiTx(files=cfg.taxonomy_files)
     elif cfg.taxonomy == "gtdb":
         tax = GtdbTx(files=cfg.taxonomy_files, output_prefix=build_output_folder)
 
     # If level is not in special targets or leaves and present in available ranks
     if cfg.level not in [None, "leaves"] + cfg.choices_level:
-        if cfg.level not in set(tax._ranks.values()):
+        ranks = tax.ranks if isinstance(tax, CompiledTx) else set(tax._ranks.values())
+        if cfg.level not in ranks:
             print_log(" - " + cfg.level + " not found in taxonomic ranks, changing to --level 'leaves'", cfg.quiet)
             cfg.level = 'leaves'
 
@@ -681,12 +689,12 @@ def validate_taxonomy(info, tax, cfg):
     tx = time.time()
     print_log("Validating taxonomy", cfg.quiet)
 
-    # Get latest and valid taxonomic nodes
-    info["node"] = info["node"].apply(tax.latest)
+    # Get latest and valid taxonomic nodes (once for each node)
+    info["node"] = info["node"].map({node: tax.latest(node) for node in info["node"].unique()})
 
     # If level is set and not leaves or reserved
     if cfg.level and cfg.level not in ["leaves"] + cfg.choices_level:
-        info["node"] = info["node"].apply(lambda n: tax.parent_rank(n, cfg.level))
+        info["node"] = info["node"].map({node: tax.parent_rank(node, cfg.level) for node in info["node"].unique()})
 
     # Skip invalid nodes (na == tax.undefined_node (None))
     na_entries = info["node"].isna().sum()
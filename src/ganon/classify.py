@@ -1,8 +1,10 @@
-from ganon.util import run, print_log, check_file
+from ganon.util import run, print_log, check_file, compress_file, compression_ext
 from ganon.report import report
 from ganon.reassign import reassign
 from ganon.config import Config
 
+import os
+
 
 def classify(cfg):
 
@@ -42,6 +44,8 @@ def classify(cfg):
                                    "--output-all" if cfg.output_all or cfg.multiple_matches == "em" else "",
                                    "--output-unclassified" if cfg.output_unclassified else "",
                                    "--output-single" if cfg.output_single else "",
+                                   "--output-binary" if cfg.output_binary else "",
+                                   "--output-compression gzip" if cfg.output_compression == "gzip" else "",
                                    "--threads " + str(cfg.threads) if cfg.threads else "",
                                    "--n-reads " + str(cfg.n_reads) if cfg.n_reads is not None else "",
                                    "--n-batches " + str(cfg.n_batches) if cfg.n_batches is not None else "",
@@ -53,11 +57,19 @@ def classify(cfg):
     if not cfg.output_prefix:
         print(stdout)
     else:
+        if cfg.output_compression == "zstd":
+            # ganon-classify writes gzip only, zstd files are compressed after classification
+            for file in classify_output_files(cfg):
+                compress_file(file, cfg.output_compression)
+        output_ext = compression_ext.get(cfg.output_compression, "")
+
         if cfg.multiple_matches == "em":
             reassign_params = {"input_prefix": cfg.output_prefix,
                                "output_prefix": cfg.output_prefix,
                                "remove_all": False if cfg.output_all else True,
                                "skip_one": False if cfg.output_one else True,
+                               "output_compression": cfg.output_compression,
+                               "threads": cfg.threads,
                                "verbose": cfg.verbose,
                                "quiet": cfg.quiet}
             reassign_cfg = Config("reassign", **reassign_params)
@@ -68,13 +80,14 @@ def classify(cfg):
 
         if tax_files and not cfg.skip_report:
             report_params = {"db_prefix": cfg.db_prefix,
-                             "input": cfg.output_prefix + ".rep",
+                             "input": cfg.output_prefix + ".rep" + output_ext,
                              "output_prefix": cfg.output_prefix,
                              "min_count": cfg.min_count,
                              "ranks": cfg.ranks,
                              "output_format": "tsv",
                              "verbose": cfg.verbose,
                              "report_type": cfg.report_type,
+                             "output_compression": cfg.output_compression,
                              "quiet": cfg.quiet}
             report_cfg = Config("report", **report_params)
             print_log("- - - - - - - - - -", cfg.quiet)
@@ -83,3 +96,22 @@ def classify(cfg):
                 return False
 
     return True
+
+
+def classify_output_files(cfg):
+    """
+    Plain output files written by ganon-classify (.rep, .one, .all, .unc)
+    """
+    prefixes = [cfg.output_prefix]
+    if cfg.hierarchy_labels and not cfg.output_single:
+        prefixes += [cfg.output_prefix + "." + h for h in dict.fromkeys(cfg.hierarchy_labels)]
+
+    files = [cfg.output_prefix + ".rep"]
+    if cfg.output_unclassified:
+        files.append(cfg.output_prefix + ".unc")
+    for prefix in prefixes:
+        if cfg.multiple_matches == "lca" and cfg.output_one:
+            files.append(prefix + ".one")
+        if cfg.output_all or cfg.multiple_matches == "em":
+            files.append(prefix + ".all")
+    return [f for f in files if os.path.isfile(f)]
@@ -24,6 +24,8 @@ class Config:
     choices_default_ranks = ["superkingdom", "phylum", "class", "order", "family", "genus", "species", "assembly"]
     choices_report_type = ["abundance", "reads", "matches", "dist", "corr"]
     choices_multiple_matches = ["em", "lca", "skip"]
+    choices_em_mode = ["hard", "soft"]
+    choices_compression = ["gzip", "zstd"]
     choices_report_output = ["text", "tsv", "csv", "bioboxes"]
     choices_mode = ["avg", "smaller", "smallest", "faster", "fastest"]
     choices_filter_type = ["hibf", "ibf"]
@@ -75,6 +77,7 @@ class Config:
         build_download_args.add_argument("-r", "--reference-genomes",       action="store_true",                                         help="Download only sub-set of reference genomes")
         build_download_args.add_argument("-u", "--genome-updater",    type=str,                                        metavar="", help="Additional genome_updater parameters (https://github.com/pirovc/genome_updater)")
         build_download_args.add_argument("-m", "--taxonomy-files",    type=file_exists, nargs="*", metavar="",                     help="Specific files for taxonomy - otherwise files will be downloaded")
+        build_download_args.add_argument("--taxonomy-cache",          type=str,                    metavar="", default="",         help="Folder to store compiled taxonomies from --taxonomy-files, re-used for faster loading in later runs")
         build_download_args.add_argument("-z", "--genome-size-files", type=file_exists, nargs="*", metavar="",                     help="Specific files for genome size estimation - otherwise files will be downloaded")
         build_download_args.add_argument("--skip-genome-size",        action="store_true",  help="Do not attempt to get genome sizes. Activate this option when using sequences not representing full genomes.")
 
@@ -92,6 +95,7 @@ class Config:
         build_custom_args.add_argument("-a", "--input-target",      type=str,         default="file", metavar="", help="Target to use [file, sequence]. Parse input by file or by sequence. Using 'file' is recommended and will speed-up the building process", choices=self.choices_input_target)
         build_custom_args.add_argument("-l", "--level",             type=str,                         metavar="", help="Max. level to build the database. By default, --level is the --input-target. Options: any available taxonomic rank [species, genus, ...] or 'leaves' (requires --taxonomy). Further specialization options [" + ", ".join(self.choices_level) + "]. assembly will retrieve and use the assembly accession and name. custom requires and uses the specialization field in the --input-file.")
         build_custom_args.add_argument("-m", "--taxonomy-files",    type=file_exists, nargs="*",      metavar="", help="Specific files for taxonomy - otherwise files will be downloaded")
+        build_custom_args.add_argument("--taxonomy-cache",          type=str,                         metavar="", default="", help="Folder to store compiled taxonomies from --taxonomy-files, re-used for faster loading in later runs")
         build_custom_args.add_argument("-z", "--genome-size-files", type=file_exists, nargs="*",      metavar="", help="Specific files for genome size estimation - otherwise files will be downloaded")
         build_custom_args.add_argument("--skip-genome-size",        action="store_true",  help="Do not attempt to get genome sizes. Activate this option when using sequences not representing full genomes.")
 
@@ -155,6 +159,8 @@ class Config:
         classify_group_output.add_argument("--output-all",                action="store_true",               help="Output a file with all unique and multiple matches (.all)")
         classify_group_output.add_argument("--output-unclassified",       action="store_true",               help="Output a file with unclassified read headers (.unc)")
         classify_group_output.add_argument("--output-single",             action="store_true",               help="When using multiple hierarchical levels, output everything in one file instead of one per hierarchy")
+        classify_group_output.add_argument("--output-binary",             action="store_true",               help="Output files with matches (.all, .one) in a compact binary format. Can be used as input for 'ganon reassign'.")
+        classify_group_output.add_argument("-z", "--output-compression", type=str, metavar="", default="", help="Compress output files (.rep, .one, .all, .unc, .tre) [" + ", ".join(self.choices_compression) + "]. gzip files are written directly by the classifier, zstd files are compressed after classification and require the python package zstandard.", choices=self.choices_compression)
 
         classify_group_other = classify_parser.add_argument_group("other arguments")
         classify_group_other.add_argument("-t", "--threads",             type=unsigned_int(minval=1), metavar="", default=1,  help="Number of sub-processes/threads to use")
@@ -174,16 +180,21 @@ class Config:
 
         # Required
         reassign_group_required = reassign_parser.add_argument_group("required arguments")
-        reassign_group_required.add_argument("-i", "--input-prefix",  type=str, required=True, metavar="", help="Input prefix to find files from ganon classify (.all and optionally .rep)")
-        reassign_group_required.add_argument("-o", "--output-prefix", type=str, required=True,             help="Output prefix for reassigned file (.one and optionally .rep). In case of multiple files, the base input filename will be appended at the end of the output file 'output_prefix + FILENAME.out'")
+        reassign_group_required.add_argument("-i", "--input-prefix",  type=str, required=True, nargs="+", help="Input prefix to find files from ganon classify (.all and optionally .rep). Multiple prefixes can be provided.")
+        reassign_group_required.add_argument("-o", "--output-prefix", type=str, required=True,             help="Output prefix for reassigned file (.one, .prob and optionally .rep). In case of multiple files, the base input filename will be appended at the end of the output file 'output_prefix + FILENAME.out'")
    
         reassign_em = reassign_parser.add_argument_group("EM arguments")
         reassign_em.add_argument("-e", "--max-iter",  type=unsigned_int(minval=0), metavar="", default=10, help="Max. number of iterations for the EM algorithm. If 0, will run until convergence (check --threshold)")
-        reassign_em.add_argument("-s", "--threshold", type=int_or_float(minval=0), metavar="", default=0,  help="Convergence threshold limit to stop the EM algorithm.")
+        reassign_em.add_argument("-s", "--threshold", type=int_or_float(minval=0), metavar="", default=0,  help="Convergence threshold limit to stop the EM algorithm. For --em-mode soft, relative change of the log-likelihood (0 defaults to 1e-6).")
+        reassign_em.add_argument("-p", "--prior",     type=str,                    metavar="", default="", help="Initial probabilities for the EM algorithm (warm start), from a previous run (.prob) or a report (.tre). Targets not found start from their unique matches.")
+        reassign_em.add_argument("-m", "--em-mode",   type=str,                    metavar="", default="hard", help="EM mode [" + ", ".join(self.choices_em_mode) + "]. hard -> reads are assigned to their most probable match on every iteration. soft -> reads are distributed among their matches proportionally to the probabilities, with accelerated convergence (one iteration = 3 passes over the matches). Final assignment (.one) is the most probable match in both modes.", choices=self.choices_em_mode)
 
         reassign_group_other = reassign_parser.add_argument_group("other arguments")
+        reassign_group_other.add_argument("-t", "--threads", type=unsigned_int(minval=1), metavar="", default=1, help="Number of threads to use in the EM algorithm. With multiple .all files (several --input-prefix or hierarchies), number of files processed in parallel.")
         reassign_group_other.add_argument("--remove-all", action="store_true", help="Remove input file (.all) after processing.")
         reassign_group_other.add_argument("--skip-one",   action="store_true", help="Do not write output file (.one) after processing.")
+        reassign_group_other.add_argument("-z", "--output-compression", type=str, metavar="", default="", help="Compress output files (.one, .rep) [" + ", ".join(self.choices_compression) + "]. Compressed input files (.all, .rep) are detected automatically. zstd requires the python package zstandard.", choices=self.choices_compression)
+        reassign_group_other.add_argument("--low-memory", action="store_true", help="Stream the .all file instead of loading it into memory. Memory usage depends only on the number of targets. Slower, requires matches of each read in consecutive lines (default from ganon classify).")
         reassign_group_other.add_argument("--verbose",    action="store_true", help="Verbose output mode")
         reassign_group_other.add_argument("--quiet",      action="store_true", help="Quiet output mode")
 
@@ -200,11 +211,12 @@ class Config:
         report_group_dbtax.add_argument("-d", "--db-prefix",         type=str,         nargs="*", metavar="", default=[],     help="Database prefix(es) used for classification. Only '.tax' file(s) are required. If not provided, new taxonomy will be downloaded. Mutually exclusive with --taxonomy.")
         report_group_dbtax.add_argument("-x", "--taxonomy",          type=str,                    metavar="", default="ncbi", help="Taxonomy database to use [" + ", ".join(self.choices_taxonomy) + "]. Mutually exclusive with --db-prefix.", choices=self.choices_taxonomy)
         report_group_dbtax.add_argument("-m", "--taxonomy-files",    type=file_exists, nargs="*", metavar="",                 help="Specific files for taxonomy - otherwise files will be downloaded")
+        report_group_dbtax.add_argument("--taxonomy-cache",          type=str,                    metavar="", default="",     help="Folder to store compiled taxonomies from --taxonomy-files or .tax files (--db-prefix), re-used for faster loading in later runs")
         report_group_dbtax.add_argument("-z", "--genome-size-files", type=file_exists, nargs="*", metavar="",                 help="Specific files for genome size estimation - otherwise files will be downloaded")
         report_group_dbtax.add_argument("--skip-genome-size",        action="store_true",  help="Do not attempt to get genome sizes. Valid only without --db-prefix. Activate this option when using sequences not representing full genomes.")
 
         report_group_output = report_parser.add_argument_group("output arguments")
-        report_group_output.add_argument("-f", "--output-format",  type=str,            metavar="", default="tsv",       help="Output format [" + ", ".join(self.choices_report_output) + "]. text outputs a tabulated formatted text file for better visualization. bioboxes is the the CAMI challenge profiling format (only percentage/abundances are reported).", choices=self.choices_report_output)
+        report_group_output.add_argument("-f", "--output-format",  type=str, nargs="*", metavar="", default=["tsv"],     help="Output format(s) [" + ", ".join(self.choices_report_output) + "]. text outputs a tabulated formatted text file for better visualization. bioboxes is the the CAMI challenge profiling format (only percentage/abundances are reported). With more than one format, reports are computed once and written to '{output_prefix}.{format}.tre'", choices=self.choices_report_output)
         report_group_output.add_argument("-t", "--report-type",    type=str,            metavar="", default="abundance", help="Type of report [" + ", ".join(self.choices_report_type) + "]. 'abundance' -> tax. abundance (re-distribute read counts and correct by genome size), 'reads' -> sequence abundance, 'matches' -> report all unique and shared matches, 'dist' -> like reads with re-distribution of shared read counts only, 'corr' -> like abundance without re-distribution of shared read counts", choices=self.choices_report_type)
         report_group_output.add_argument("-r", "--ranks",          type=str, nargs="*", metavar="", default=[],          help="Ranks to report ['', 'all', custom list]. 'all' for all possible ranks. empty for default ranks [" + ", ".join(self.choices_default_ranks) + "].")
         report_group_output.add_argument("-s", "--sort",           type=str,            metavar="", default="",          help="Sort report by [rank, lineage, count, unique]. Default: rank (with custom --ranks) or lineage (with --ranks all)")
@@ -214,10 +226,13 @@ class Config:
         report_group_output.add_argument("-k", "--keep-hierarchy", type=str,                              nargs="*", metavar="", default=[],          help="One or more hierarchies to keep in the report (from ganon classify --hierarchy-labels)")
         report_group_output.add_argument("-c", "--top-percentile", type=int_or_float(minval=0, maxval=0.999999),     metavar="", default=0,           help="Top percentile filter, based on percentage/relative abundance. Applied only at default ranks [" + ", ".join(self.choices_default_ranks) + "]")
         report_group_output.add_argument("-n", "--normalize",       action="store_true",                                  help="Ignore the number of unclassified reads, normalizing the output to 100%%. Use with caution, can drastically change abundance estimations.")
+        report_group_output.add_argument("--output-compression",    type=str,            metavar="", default="",          help="Compress output file(s) (.tre) [" + ", ".join(self.choices_compression) + "]. Compressed input files (.rep) are detected automatically. zstd requires the python package zstandard.", choices=self.choices_compression)
 
         report_group_optional = report_parser.add_argument_group("optional arguments")
         report_group_optional.add_argument("--verbose", action="store_true", default=False, help="Verbose output mode")
         report_group_optional.add_argument("--quiet",   action="store_true", default=False, help="Quiet output mode")
+        report_group_optional.add_argument("--threads", type=unsigned_int(minval=1), metavar="", default=1, help="Number of input files processed in parallel (in sub-processes sharing the taxonomy)")
+        report_group_optional.add_argument("--report-cache", type=str, metavar="", default="", help="Folder to store reports of each input file before filters (keyed by file content, db/tax and --report-type). Re-used when running again with different filter/output arguments. Not used with downloaded taxonomy or genome sizes.")
         report_group_optional.add_argument("--ncbi-url",             type=str,                              metavar="", default="https://ftp.ncbi.nlm.nih.gov/", help=argparse.SUPPRESS)
         report_group_optional.add_argument("--gtdb-url",             type=str,                              metavar="", default="https://data.gtdb.ecogenomic.org/releases/latest/", help=argparse.SUPPRESS)
 
@@ -226,7 +241,7 @@ class Config:
         table_parser = argparse.ArgumentParser(add_help=False)
 
         table_group_required = table_parser.add_argument_group("required arguments")
-        table_group_required.add_argument("-i", "--input",           type=str,          required=True, nargs="*",     metavar="", help="Input file(s) and/or folder(s). '.tre' file(s) from ganon report.")
+        table_group_required.add_argument("-i", "--input",           type=str,          required=True, nargs="*",     metavar="", help="Input file(s) and/or folder(s). '.tre' file(s) from ganon report or '.rep' file(s) from ganon classify (see report arguments).")
         table_group_required.add_argument("-e", "--input-extension", type=str,          default="tre", metavar="",                help="Required if --input contains folder(s). Wildcards/Shell Expansions not supported (e.g. *).")
         table_group_required.add_argument("-o", "--output-file",     type=str,          required=True,                            help="Output filename for the table")
 
@@ -236,7 +251,8 @@ class Config:
         table_group_output.add_argument("-t", "--top-sample",    type=unsigned_int(minval=0), metavar="", default=0,        help="Top hits of each sample individually")
         table_group_output.add_argument("-a", "--top-all",       type=unsigned_int(minval=0), metavar="", default=0,        help="Top hits of all samples (ranked by percentage)")
         table_group_output.add_argument("-m", "--min-frequency", type=int_or_float(minval=0), metavar="", default=0,        help="Minimum number/percentage of files containing an taxa to keep the taxa [values between 0-1 for percentage, >1 specific number]")
-        table_group_output.add_argument("-r", "--rank",          type=str,   metavar="", default=None,   help="Define specific rank to report. Empty will report all ranks.")
+        table_group_output.add_argument("-r", "--rank",          type=str,   nargs="*", metavar="", default=[], help="Define specific rank(s) to report. Empty will report all ranks. Several ranks are reported together in one table (counts adjusted as for all ranks) or in one table per rank with --split-rank.")
+        table_group_output.add_argument("--split-rank",          action="store_true",    default=False,  help="Write one table for each --rank, with the rank added to --output-file (e.g. table.species.tsv). Files are parsed only once.")
         table_group_output.add_argument("-n", "--no-root",       action="store_true",    default=False,  help="Do not report root node entry and lineage. Direct and shared matches to root will be accounted as unclassified")
         table_group_output.add_argument("--header",              type=str,   metavar="", default="name", help="Header information [name, taxid, lineage]")
         table_group_output.add_argument("--unclassified-label",  type=str,   metavar="", default=None,   help="Add column with unclassified count/percentage with the chosen label. May be the same as --filtered-label (e.g. unassigned)")
@@ -244,9 +260,31 @@ class Config:
         table_group_output.add_argument("--skip-zeros",          action="store_true",    default=False,  help="Do not print lines with only zero count/percentage")
         table_group_output.add_argument("--transpose",           action="store_true",    default=False,  help="Transpose output table (taxa as cols and files as rows)")
 
+        table_group_report = table_parser.add_argument_group("report arguments", "Used with '.rep' files in --input. Reports are built in memory (as in ganon report) and filters are applied to them as for '.tre' files")
+        table_group_report.add_argument("--db-prefix",         type=str,         nargs="*", metavar="", default=[],          help="Database prefix(es) used for classification. Only '.tax' file(s) are required. If not provided, new taxonomy will be downloaded. Mutually exclusive with --taxonomy.")
+        table_group_report.add_argument("--taxonomy",          type=str,                    metavar="", default="ncbi",      help="Taxonomy database to use [" + ", ".join(self.choices_taxonomy) + "]. Mutually exclusive with --db-prefix.", choices=self.choices_taxonomy)
+        table_group_report.add_argument("--taxonomy-files",    type=file_exists, nargs="*", metavar="",                      help="Specific files for taxonomy - otherwise files will be downloaded")
+        table_group_report.add_argument("--taxonomy-cache",    type=str,                    metavar="", default="",          help="Folder to store compiled taxonomies from --taxonomy-files or .tax files (--db-prefix), re-used for faster loading in later runs")
+        table_group_report.add_argument("--genome-size-files", type=file_exists, nargs="*", metavar="",                      help="Specific files for genome size estimation - otherwise files will be downloaded")
+        table_group_report.add_argument("--skip-genome-size",  action="store_true",                                         help="Do not attempt to get genome sizes. Valid only without --db-prefix.")
+        table_group_report.add_argument("--report-type",       type=str,                    metavar="", default="abundance", help="Type of report [" + ", ".join(self.choices_report_type) + "]. More info in 'ganon report'.", choices=self.choices_report_type)
+        table_group_report.add_argument("--ranks",             type=str, nargs="*",         metavar="", default=[],          help="Ranks to report ['', 'all', custom list]. 'all' for all possible ranks. empty for default ranks [" + ", ".join(self.choices_default_ranks) + "].")
+        table_group_report.add_argument("--top-percentile",    type=int_or_float(minval=0, maxval=0.999999), metavar="", default=0, help="Top percentile filter, based on percentage/relative abundance. Applied only at default ranks [" + ", ".join(self.choices_default_ranks) + "]")
+        table_group_report.add_argument("--no-orphan",         action="store_true",                                         help="Omit orphan nodes from the reports.")
+        table_group_report.add_argument("--normalize",         action="store_true",                                         help="Ignore the number of unclassified reads, normalizing the output to 100%%.")
+        table_group_report.add_argument("--skip-hierarchy",    type=str, nargs="*",         metavar="", default=[],          help="One or more hierarchies to skip in the reports (from ganon classify --hierarchy-labels)")
+        table_group_report.add_argument("--keep-hierarchy",    type=str, nargs="*",         metavar="", default=[],          help="One or more hierarchies to keep in the reports (from ganon classify --hierarchy-labels)")
+        table_group_report.add_argument("--output-prefix",     type=str,                    metavar="", default="",          help="Also write the reports ('.tre', tsv format) with this prefix, as in ganon report. Otherwise reports are not written.")
+
         table_group_optional = table_parser.add_argument_group("optional arguments")
+        table_group_optional.add_argument("--incremental", action="store_true", default=False, help="Store parsed '.tre' files in a cache next to the output table (--output-file + '.cache'). Following runs only parse new or changed files (by path, size and modification time) and use the same cache. Filters and output arguments can change between runs, a different --rank parses all files again.")
+        table_group_optional.add_argument("--low-memory", action="store_true", default=False, help="Parse '.tre' files in batches (twice) and write the table from temporary files (next to --output-file). Memory usage depends on the number of taxa and --batch-size, not on the number of files. Slower, results are the same.")
+        table_group_optional.add_argument("--batch-size", type=unsigned_int(minval=1), metavar="", default=1000, help="Number of files parsed at a time with --low-memory")
+        table_group_optional.add_argument("--threads", type=unsigned_int(minval=1), metavar="", default=1, help="Number of input files parsed in parallel (in sub-processes)")
         table_group_optional.add_argument("--verbose", action="store_true", default=False, help="Verbose output mode")
         table_group_optional.add_argument("--quiet",   action="store_true", default=False, help="Quiet output mode")
+        table_group_optional.add_argument("--ncbi-url",             type=str,                              metavar="", default="https://ftp.ncbi.nlm.nih.gov/", help=argparse.SUPPRESS)
+        table_group_optional.add_argument("--gtdb-url",             type=str,                              metavar="", default="https://data.gtdb.ecogenomic.org/releases/latest/", help=argparse.SUPPRESS)
 
         ####################################################################################################
 
@@ -474,6 +512,10 @@ class Config:
         
         elif self.which == "report":
 
+            if not self.output_format:
+                print_log("--output-format requires at least one format")
+                return False
+
             if self.skip_hierarchy and self.keep_hierarchy:
                 print_log("--skip-hierarchy and --keep-hierarchy are mutually exclusive")
                 return False
@@ -490,7 +532,29 @@ class Config:
                 return False
 
         elif self.which == "table":
-            pass
+
+            if self.split_rank and not self.rank:
+                print_log("--split-rank requires --rank")
+                return False
+
+            if self.low_memory and self.incremental:
+                print_log("--low-memory and --incremental are mutually exclusive")
+                return False
+
+            if self.skip_hierarchy and self.keep_hierarchy:
+                print_log("--skip-hierarchy and --keep-hierarchy are mutually exclusive")
+                return False
+
+            if self.db_prefix:
+                for prefix in self.db_prefix:
+                    file = prefix + ".tax" if not prefix.endswith(".tax") else prefix
+                    if not check_file(file):
+                        print_log("File not found: " + file)
+                        return False
+
+            if self.db_prefix and self.taxonomy == "skip":
+                print_log("To skip taxonomy, omit --db-prefix and set --taxonomy skip")
+                return False
 
         return True
 
@@ -0,0 +1,98 @@
+import numpy as np
+
+from ganon.util import open_file
+
+# Header of binary match files (.all, .one, .lca with --output-binary)
+# followed by blocks of reads, all values uint32 little-endian:
+# n_new_targets, n_reads, n_matches
+# length of new targets [n_new_targets], new targets (chars)
+# length of read ids [n_reads], read ids (chars)
+# number of matches per read [n_reads]
+# target ids [n_matches] (in order of definition by new targets), kmer counts [n_matches]
+# Files can have several headers (e.g. hierarchies appended with --output-single), target ids restart in each of them
+binary_magic = b"GANONBM\x01"
+
+
+def is_binary(file):
+    """
+    Check if a match file (.all, .one, .lca) is in binary format
+    """
+    with open_file(file, "rb") as f:
+        return f.read(len(binary_magic)) == binary_magic
+
+
+def iter_binary(file, targets):
+    """
+    Read a binary match file block by block. New targets are added to targets {target: id}
+    Yields read ids, read offsets, target ids and kcounts for each block
+    read i has matches in the positions offsets[i]:offsets[i+1] of target_ids and kcounts
+    """
+    with open_file(file, "rb") as f:
+        file_ids = []
+        while True:
+            header = f.read(len(binary_magic))
+            if not header:
+                break
+            if header == binary_magic:
+                file_ids = []
+                continue
+            n_new_targets, n_reads, n_matches = read_uint32(f, 3, header).tolist()
+
+            for target in split_strings(f, read_uint32(f, n_new_targets)):
+                if target not in targets:
+                    targets[target] = len(targets)
+                file_ids.append(targets[target])
+
+            read_ids = split_strings(f, read_uint32(f, n_reads))
+            offsets = np.zeros(n_reads+1, dtype=np.int64)
+            np.cumsum(read_uint32(f, n_reads), out=offsets[1:])
+            target_ids = np.array(file_ids, dtype=np.int64)[read_uint32(f, n_matches)]
+            kcounts = read_uint32(f, n_matches).astype(np.uint64)
+            yield read_ids, offsets, target_ids, kcounts
+
+
+def read_uint32(f, n, prefix: bytes=b""):
+    """
+    Read n uint32 values (optionally with already read bytes in prefix)
+    """
+    buf = prefix + f.read(n*4 - len(prefix))
+    if len(buf) != n*4:
+        raise ValueError("Truncated binary file")
+    return np.frombuffer(buf, dtype="<u4")
+
+
+def split_strings(f, lengths):
+    """
+    Read concatenated strings with the given lengths
+    """
+    data = f.read(int(lengths.sum()))
+    ends = np.cumsum(lengths).tolist()
+    return [data[s:e].decode() for s, e in zip([0] + ends[:-1], ends)]
+
+
+def write_binary_header(out_file):
+    out_file.write(binary_magic)
+
+
+def write_binary_block(out_file, read_ids, offsets, target_ids, kcounts, target_names, file_ids):
+    """
+    Write a block of reads in binary format
+    target_ids are positions in target_names, file_ids maps them to ids already defined in the file (-1 if not defined)
+    and is updated with new targets of the block
+    """
+    _, first = np.unique(target_ids, return_index=True)
+    new_targets = target_ids[np.sort(first)]
+    new_targets = new_targets[file_ids[new_targets] < 0]
+    n_defined = int(np.count_nonzero(file_ids >= 0))
+    file_ids[new_targets] = np.arange(n_defined, n_defined+len(new_targets))
+
+    new_names = [target_names[t].encode() for t in new_targets.tolist()]
+    read_names = [r.encode() for r in read_ids]
+    out_file.write(np.array([len(new_names), len(read_names), len(target_ids)], dtype="<u4").tobytes())
+    out_file.write(np.array([len(n) for n in new_names], dtype="<u4").tobytes())
+    out_file.write(b"".join(new_names))
+    out_file.write(np.array([len(r) for r in read_names], dtype="<u4").tobytes())
+    out_file.write(b"".join(read_names))
+    out_file.write(np.diff(offsets).astype("<u4").tobytes())
+    out_file.write(file_ids[target_ids].astype("<u4").tobytes())
+    out_file.write(kcounts.astype("<u4").tobytes())
@@ -1,10 +1,16 @@
 from ganon.util import run, print_log, check_file
 from ganon.report import report
 from ganon.config import Config
-from ganon.util import validate_input_files, rm_files
+from ganon.util import validate_input_files, rm_files, compressed_file, open_file, compression_ext
+from ganon.matches import is_binary, iter_binary, write_binary_header, write_binary_block
 
 import os
-from collections import defaultdict
+import tempfile
+from copy import copy
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+from array import array
 
 
 def reassign(cfg):
@@ -12,17 +18,83 @@ def reassign(cfg):
     print_log("Reassigning reads", cfg.quiet)
     print_log("", cfg.quiet)
 
-    # Look for .rep and match with .all files (in case of multi level hierarchy)
+    prior = None
+    if cfg.prior:
+        prior = parse_prior(cfg.prior)
+        print_log("Initial probabilities: " + cfg.prior, cfg.quiet)
+
+    # Look for .rep and .all files for every input prefix
+    samples = []
+    for input_prefix in cfg.input_prefix:
+        files = find_files(input_prefix, cfg.quiet)
+        if not files:
+            return False
+        # In case of multiple inputs, the base input filename is appended to the output prefix
+        output_prefix = cfg.output_prefix
+        if len(cfg.input_prefix) > 1:
+            output_prefix += os.path.basename(input_prefix)
+        samples.append(dict(files, input_prefix=input_prefix, output_prefix=output_prefix))
+
+    # Outputs of different inputs would overwrite each other (e.g. same input name in different folders)
+    output_prefixes = {}
+    for s in samples:
+        if s["output_prefix"] in output_prefixes:
+            print_log("ERROR: " + output_prefixes[s["output_prefix"]] + " and " + s["input_prefix"] +
+                      " have the same output prefix " + s["output_prefix"], cfg.quiet)
+            return False
+        output_prefixes[s["output_prefix"]] = s["input_prefix"]
+
+    # Every .all file (sample and hierarchy) is reassigned independently
+    jobs = []
+    for s in samples:
+        for hierarchy, af in s["all_files"].items():
+            if len(s["all_files"]) == 1:
+                output_file = s["output_prefix"] + ".one"
+            else:
+                output_file = s["output_prefix"] + "." + hierarchy + ".one"
+            if cfg.output_compression:
+                output_file += compression_ext[cfg.output_compression]
+            jobs.append((af, hierarchy, output_file))
+
+    if len(jobs) > 1 and cfg.threads > 1:
+        # Parallel jobs with one thread each, logging only results
+        job_cfg = copy(cfg)
+        job_cfg.threads = 1
+        job_cfg.quiet = True
+        with ProcessPoolExecutor(max_workers=min(cfg.threads, len(jobs))) as executor:
+            results = list(executor.map(reassign_file, *zip(*jobs), repeat(prior), repeat(job_cfg)))
+        for (af, hierarchy, output_file), res in zip(jobs, results):
+            print_log(af + (" [" + hierarchy + "]" if hierarchy else "") + ": " +
+                      str(res["reassigned_reads"]) + " reassigned reads" +
+                      (" to " + output_file if not cfg.skip_one else ""), cfg.quiet)
+    else:
+        results = [reassign_file(af, hierarchy, output_file, prior, cfg) for af, hierarchy, output_file in jobs]
+
+    results = iter(results)
+    for s in samples:
+        write_outputs(s, [next(results) for _ in s["all_files"]], cfg.output_compression, cfg.quiet)
+
+        if cfg.remove_all:
+            for af in s["all_files"].values():
+                os.remove(af)
+
+    return True
+
+
+def find_files(input_prefix, quiet):
+    """
+    Look for .rep and matching .all files (in case of multi level hierarchy) for an input prefix
+    Returns {"all_files": {hierarchy: file}, "rep_file": file, "rep_file_info": [lines]} or None if not found
+    """
     all_files = {}
-    rep_file = cfg.input_prefix + ".rep"
-    rep_file_out = cfg.output_prefix + ".rep"
+    rep_file = compressed_file(input_prefix + ".rep")
     rep_file_info = []
 
-    if check_file(rep_file):
+    if rep_file:
 
-        print_log("Ganon report output found: " + rep_file, cfg.quiet)
+        print_log("Ganon report output found: " + rep_file, quiet)
         # look for hierarchies
-        with open(rep_file) as rep:
+        with open_file(rep_file) as rep:
             for line in rep:
                 if line[0] != "#":
                     all_files[line.split("\t")[0]] = ""
@@ -30,170 +102,692 @@ def reassign(cfg):
                     rep_file_info.append([line.rstrip()])
 
         for h in all_files.keys():
-            if check_file(cfg.input_prefix + "." + h + ".all"):
+            if compressed_file(input_prefix + "." + h + ".all"):
                 # Check individual .all for multi-level hierarchy
-                all_files[h] = cfg.input_prefix + "." + h + ".all"
-            elif check_file(cfg.input_prefix + ".all"):
+                all_files[h] = compressed_file(input_prefix + "." + h + ".all")
+            elif compressed_file(input_prefix + ".all"):
                 # Check unique file for for multi-level hierarchy with --output-single
                 all_files = {}
-                all_files[""] = cfg.input_prefix + ".all"
+                all_files[""] = compressed_file(input_prefix + ".all")
                 break
             else:
                 print_log(
-                    "No matching files for given .rep [" + cfg.input_prefix + ".all]", cfg.quiet)
-                return False
+                    "No matching files for given .rep [" + input_prefix + ".all]", quiet)
+                return None
     else:
-        print_log("No .rep file found " + rep_file, cfg.quiet)
-        rep_file = ""
-        rep_file_out = ""
-        if check_file(cfg.input_prefix + ".all"):
-            all_files[""] = cfg.input_prefix + ".all"
+        print_log("No .rep file found " + input_prefix + ".rep", quiet)
+        if compressed_file(input_prefix + ".all"):
+            all_files[""] = compressed_file(input_prefix + ".all")
 
     if not all_files:
         print_log("No .rep or .all file(s) found with prefix --input-prefix " +
-                  cfg.input_prefix, cfg.quiet)
-        return False
+                  input_prefix, quiet)
+        return None
+
+    return {"all_files": all_files, "rep_file": rep_file, "rep_file_info": rep_file_info}
+
+
+def reassign_file(af, hierarchy, output_file, prior, cfg):
+    """
+    Run the EM for one .all file and write the reassigned reads to output_file (if not --skip-one)
+    Returns {"counts": {target: reassigned matches}, "prob": [[hierarchy, target, prob]], "reassigned_reads": int}
+    """
+    print_log(
+        af + (" [" + hierarchy + "]" if hierarchy else ""), cfg.quiet)
+
+    if cfg.low_memory:
+        # Stream matches from the .all file, keeping only per-target data in memory
+        # target ids of reads with multiple matches are spilled to disk for the EM iterations
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_file))) as tmp_dir:
+            targets, initial_weight, total_weight, multi_chunks, n_multi, n_classes = spill_all(af, tmp_dir)
+            print_log(" - " + str(n_multi) + " reads with multiple matches in " +
+                      str(n_classes) + " equivalence classes", cfg.quiet)
+            prob, reassigned_matches = em(multi_chunks, initial_weight, total_weight,
+                                          get_prior_prob(prior, hierarchy, targets, cfg.quiet), cfg)
+
+        def all_batches():
+            return iter_all_batches(af, targets)
+    else:
+        # Parse matches into arrays (CSR-like: read offsets, target ids and kcounts)
+        targets, read_ids, offsets, target_ids, kcounts = parse_all(af)
+        initial_weight, multi_offsets, multi_target_ids = split_unique(offsets, target_ids, len(targets))
+        total_weight = len(read_ids)
+        # Reads with the same matches are evaluated once in the EM
+        class_offsets, class_target_ids, class_weights = collapse_classes(multi_offsets, multi_target_ids)
+        print_log(" - " + str(len(multi_offsets)-1) + " reads with multiple matches in " +
+                  str(len(class_weights)) + " equivalence classes", cfg.quiet)
+        prob, reassigned_matches = em(lambda: [(class_offsets, class_target_ids, class_weights)],
+                                      initial_weight, total_weight,
+                                      get_prior_prob(prior, hierarchy, targets, cfg.quiet), cfg)
+
+        def all_batches():
+            return [(read_ids, offsets, target_ids, kcounts)]
+
+    reassigned_matches = reassigned_matches.tolist()
+
+    # Skip .one file (just generate .rep)
+    reassigned_reads = 0
+    if not cfg.skip_one:
+        # .one is written in the same format as the .all file
+        reassigned_reads = write_one(output_file, all_batches(), targets, prob, is_binary(af))
+        print_log(" - " + str(reassigned_reads) +
+                  " reassigned reads to " + output_file, cfg.quiet)
+
+    # Converged probabilities, can be used as --prior in another run
+    prob_out = [[hierarchy, target, repr(float(prob[t]))] for target, t in targets.items() if prob[t] > 0]
+
+    return {"counts": {target: reassigned_matches[t] for target, t in targets.items()},
+            "prob": prob_out,
+            "reassigned_reads": reassigned_reads}
+
+
+def write_outputs(sample, results, output_compression, quiet):
+    """
+    Write .prob and new .rep (if .rep was provided) for a sample with results of reassign_file() for each hierarchy
+    """
+    prob_file_out = sample["output_prefix"] + ".prob"
+    with open(prob_file_out, "w") as prob_file:
+        for res in results:
+            for line in res["prob"]:
+                print(*line, sep="\t", file=prob_file)
+    print_log("Probabilities: " + prob_file_out, quiet)
+
+    if not sample["rep_file"]:
+        return
 
     new_rep = []
-    for hierarchy, af in all_files.items():
-
-        print_log(
-            af + (" [" + hierarchy + "]" if hierarchy else ""), cfg.quiet)
-
-        # Auto-increment dict to save targets (string) into integers, less memory
-        targets = defaultdict(lambda: len(targets))
-
-        prob = {}
-        read_matches = {}
-        initial_weight = {}
-
-        with open(af, "r") as all_file:
-            for line in all_file:
-                readid, target, kcount = line.rstrip().split("\t")
-                if readid not in read_matches:
-                    read_matches[readid] = []
-                read_matches[readid].append((targets[target], int(kcount)))
-
-                # Not all targets have unique matches, initialize all targets with zero weights
-                if targets[target] not in initial_weight:
-                    initial_weight[targets[target]] = 0
-
-        # Assign unique matches as initial weights
-        # Calculate first probabilities based on weights (unique matches)
-        total_weight = len(read_matches)
-        total_initial_weight = 0
-        for matches in read_matches.values():
-            if len(matches) == 1:
-                total_initial_weight += 1
-                initial_weight[matches[0][0]] += 1
-
-        if total_initial_weight == 0:
-            total_initial_weight = 1
-
-        for target, unique in initial_weight.items():
-            prob[target] = unique / total_initial_weight
-
-        # EM loop
-        em_ite_cnt = 0
-        while True:
-
-            # Make copy of initial weights
-            reassigned_matches = initial_weight.copy()
-
-            for matches in read_matches.values():
-                # Skip unique matches
-                if len(matches) > 1:
-                    # Get match with highest probability in this round
-                    t, _ = get_top_match(matches, prob)
-                    reassigned_matches[t] += 1
-
-            diff = 0
-            # Calculate new probabilities based on "simulated" re-distributed reads for the next round
-            for target, count in reassigned_matches.items():
-                new_prob = count / total_weight
-                diff += abs(prob[target] - new_prob)
-                prob[target] = new_prob
-
-            print_log(" - Iteration " + str(em_ite_cnt+1) +
-                      " (" + str(round(diff, 6)) + ")", cfg.quiet)
-
-            # If abs. difference among old and new probabilities already converged (no change)
-            if diff <= cfg.threshold:
-                break
-            if cfg.max_iter > 0 and em_ite_cnt == cfg.max_iter-1:
-                break
-
-            em_ite_cnt += 1
-
-        # Skip .one file (just generate .rep)
-        if not cfg.skip_one:
-            # General output file
-            if len(all_files) == 1:
-                output_file = cfg.output_prefix + ".one"
+    for hierarchy, res in zip(sample["all_files"].keys(), results):
+        with open_file(sample["rep_file"]) as rep:
+            for line in rep:
+                if line[0] != "#":
+                    fields = line.rstrip().split("\t")
+                    hierarchy_name = fields[0]
+                    target = fields[1]
+                    direct_matches = fields[2]
+                    rank = fields[5] if len(fields)>=6 else ""
+                    name = fields[6] if len(fields)>=7 else ""
+                    # Only print line of targets
+                    if (hierarchy == "" or hierarchy_name == hierarchy) and target in res["counts"]:
+                        # LCA matches are zero, since they will be reassigned to other nodes
+                        new_rep.append([hierarchy_name, target, direct_matches,
+                                        res["counts"][target], 0, rank, name])
+
+    rep_file_out = sample["output_prefix"] + ".rep" + compression_ext.get(output_compression, "")
+    with open_file(rep_file_out, "wt") as rep_out:
+        for line in new_rep:
+            print(*line, sep="\t", file=rep_out)
+        for info in sample["rep_file_info"]:
+            print(*info, sep="\t", file=rep_out)
+    print_log("New .rep file: " + rep_file_out, quiet)
+
+
+def parse_prior(prior_file):
+    """
+    Parse initial probabilities from a previous run (.prob: hierarchy, target, prob)
+    or abundances from a report (.tre: rank, target, lineage, name, unique, shared, children, cumulative, ...)
+    Returns {hierarchy: {target: value}}, hierarchy is empty for .tre
+    """
+    prior = {}
+    with open_file(prior_file) as file:
+        for line in file:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) == 1:
+                fields = fields[0].split(",")
+            try:
+                if len(fields) == 3:
+                    hierarchy, target, value = fields[0], fields[1], float(fields[2])
+                elif len(fields) >= 8:
+                    hierarchy, target, value = "", fields[1], float(fields[7])
+                else:
+                    continue
+            except ValueError:
+                continue
+            prior.setdefault(hierarchy, {})[target] = value
+    return prior
+
+
+def get_prior_prob(prior, hierarchy, targets, quiet):
+    """
+    Get initial probabilities for targets {target: id} of a hierarchy from parsed prior
+    Values are normalized among the matching targets, nan for targets not found
+    Returns None if no target was found
+    """
+    if prior is None:
+        return None
+    values = prior[hierarchy] if hierarchy in prior else prior.get("", {})
+    prior_prob = np.full(len(targets), np.nan)
+    for target, t in targets.items():
+        if target in values:
+            prior_prob[t] = values[target]
+    found = ~np.isnan(prior_prob)
+    total = prior_prob[found].sum()
+    if total <= 0:
+        print_log(" - WARNING: no targets found in --prior, using unique matches", quiet)
+        return None
+    print_log(" - " + str(int(found.sum())) + "/" + str(len(targets)) + " targets with initial probabilities", quiet)
+    return prior_prob / total
+
+
+def parse_all(all_file):
+    """
+    Parse .all file into arrays, grouping matches by read (in order of first appearance)
+    Returns targets {target: id}, read ids, read offsets, target ids and kcounts
+    read i has matches in the positions offsets[i]:offsets[i+1] of target_ids and kcounts
+    """
+    if is_binary(all_file):
+        return parse_binary(all_file)
+
+    # Auto-increment dict to save targets (string) into integers, less memory
+    targets = {}
+    read_ids = {}
+    read_idx = array("Q")
+    target_ids = array("Q")
+    kcounts = array("Q")
+    with open_file(all_file) as file:
+        for line in file:
+            readid, target, kcount = line.rstrip().split("\t")
+            if readid not in read_ids:
+                read_ids[readid] = len(read_ids)
+            if target not in targets:
+                targets[target] = len(targets)
+            read_idx.append(read_ids[readid])
+            target_ids.append(targets[target])
+            kcounts.append(int(kcount))
+
+    read_idx = np.frombuffer(read_idx, dtype=np.uint64) if read_idx else np.zeros(0, dtype=np.uint64)
+    target_ids = np.frombuffer(target_ids, dtype=np.uint64) if target_ids else np.zeros(0, dtype=np.uint64)
+    kcounts = np.frombuffer(kcounts, dtype=np.uint64) if kcounts else np.zeros(0, dtype=np.uint64)
+
+    # Matches of a read are usually written consecutively, sort only if necessary (stable, keeps match order)
+    if len(read_idx) and np.any(read_idx[1:] < read_idx[:-1]):
+        order = np.argsort(read_idx, kind="stable")
+        read_idx = read_idx[order]
+        target_ids = target_ids[order]
+        kcounts = kcounts[order]
+
+    offsets = np.zeros(len(read_ids)+1, dtype=np.int64)
+    np.cumsum(np.bincount(read_idx.astype(np.int64), minlength=len(read_ids)), out=offsets[1:])
+
+    return targets, list(read_ids), offsets, target_ids.astype(np.int64), kcounts
+
+
+def parse_binary(all_file):
+    """
+    Parse binary .all file into arrays, same as parse_all()
+    Matches of a read are grouped in binary files
+    """
+    targets = {}
+    read_ids = []
+    read_len = [np.zeros(0, dtype=np.int64)]
+    target_ids = [np.zeros(0, dtype=np.int64)]
+    kcounts = [np.zeros(0, dtype=np.uint64)]
+    for batch_read_ids, batch_offsets, batch_target_ids, batch_kcounts in iter_binary(all_file, targets):
+        read_ids.extend(batch_read_ids)
+        read_len.append(np.diff(batch_offsets))
+        target_ids.append(batch_target_ids)
+        kcounts.append(batch_kcounts)
+
+    offsets = np.zeros(len(read_ids)+1, dtype=np.int64)
+    np.cumsum(np.concatenate(read_len), out=offsets[1:])
+    return targets, read_ids, offsets, np.concatenate(target_ids), np.concatenate(kcounts)
+
+
+def em(multi_chunks, initial_weight, total_weight, prior_prob, cfg):
+    """
+    EM algorithm for reads with multiple matches (--em-mode hard or soft)
+    multi_chunks() returns an iterable of (offsets, target_ids, weights) for the equivalence classes
+    of reads with multiple matches, weights being the number of reads in each class
+    prior_prob are initial probabilities for each target (nan if not available) or None
+    Returns final probabilities and reassigned matches (counts) for each target
+    """
+    n_targets = len(initial_weight)
+
+    # Calculate first probabilities based on weights (unique matches)
+    total_initial_weight = int(initial_weight.sum())
+    if total_initial_weight == 0:
+        total_initial_weight = 1
+    prob = initial_weight / total_initial_weight
+
+    # Targets with a prior start from it (warm start), others from unique matches
+    if prior_prob is not None:
+        prob = np.where(np.isnan(prior_prob), prob, prior_prob)
+        prob = prob / prob.sum()
+
+    # Partitions of each chunk are evaluated in parallel, sharing the same prob
+    executor = ThreadPoolExecutor(max_workers=cfg.threads) if cfg.threads > 1 else None
+
+    if cfg.em_mode == "soft":
+        prob = em_soft(multi_chunks, initial_weight, total_weight, prob, executor, cfg)
+        # Reads are assigned to the top match based on the final probabilities
+        reassigned_matches = initial_weight.copy()
+        for counts in map_chunks(lambda o, t, w: count_top_matches(o, t, w, prob, n_targets),
+                                 multi_chunks, executor, cfg.threads):
+            reassigned_matches += counts
+    elif cfg.low_memory:
+        prob, reassigned_matches = em_hard(multi_chunks, initial_weight, total_weight, prob, executor, cfg)
+    else:
+        # Active set keeps the current assignment of every class in memory, not used with --low-memory
+        prob, reassigned_matches = em_hard_active(multi_chunks, initial_weight, total_weight, prob, executor, cfg)
+
+    if executor:
+        executor.shutdown()
+
+    return prob, reassigned_matches
+
+
+def em_hard(multi_chunks, initial_weight, total_weight, prob, executor, cfg):
+    """
+    EM with hard assignments: each read with multiple matches is assigned to its top match in each iteration
+    """
+    n_targets = len(initial_weight)
+    em_ite_cnt = 0
+    while True:
+
+        # Get match with highest probability in this round and add to initial weights
+        reassigned_matches = initial_weight.copy()
+        for counts in map_chunks(lambda o, t, w: count_top_matches(o, t, w, prob, n_targets),
+                                 multi_chunks, executor, cfg.threads):
+            reassigned_matches += counts
+
+        # Calculate new probabilities based on "simulated" re-distributed reads for the next round
+        new_prob = reassigned_matches / total_weight
+        diff = float(np.abs(prob - new_prob).sum())
+        prob = new_prob
+
+        print_log(" - Iteration " + str(em_ite_cnt+1) +
+                  " (" + str(round(diff, 6)) + ")", cfg.quiet)
+
+        # If abs. difference among old and new probabilities already converged (no change)
+        if diff <= cfg.threshold:
+            break
+        if cfg.max_iter > 0 and em_ite_cnt == cfg.max_iter-1:
+            break
+
+        em_ite_cnt += 1
+
+    return prob, reassigned_matches
+
+
+def em_hard_active(multi_chunks, initial_weight, total_weight, prob, executor, cfg):
+    """
+    EM with hard assignments, re-evaluating only classes with at least one target which counts changed
+    in the last iteration (active set). Classes without changes keep their top match.
+    Targets without counts after the first iteration can not be top matches anymore and are removed from classes
+    Same results as em_hard()
+    """
+    n_targets = len(initial_weight)
+    classes = [{"offsets": offsets,
+                "target_ids": target_ids,
+                "weights": weights,
+                "top": np.zeros(len(weights), dtype=np.int64)} for offsets, target_ids, weights in multi_chunks()]
+    changed = None
+
+    em_ite_cnt = 0
+    while True:
+
+        # Get match with highest probability in this round (for active classes) and add to initial weights
+        reassigned_matches = initial_weight.copy()
+        for c in classes:
+            active = get_active_classes(c["offsets"], c["target_ids"], changed)
+            if active is None:
+                offsets, target_ids, weights = c["offsets"], c["target_ids"], c["weights"]
             else:
-                file_pre = os.path.splitext(os.path.basename(af))[0]
-                output_file = cfg.output_prefix + "." + hierarchy + ".one"
-
-            # reverse string target <-> integer id
-            targets_rev = {val: key for (key, val) in targets.items()}
-            reassigned_reads = 0
-            with open(output_file, "w") as out_file:
-                for readid, matches in read_matches.items():
-                    if len(matches) == 1:
-                        print(readid, targets_rev[matches[0][0]], matches[0]
-                              [1], sep="\t", file=out_file)
-                    else:
-                        reassigned_reads += 1
-                        target, kcount = get_top_match(matches, prob)
-                        print(readid, targets_rev[target],
-                              kcount, sep="\t", file=out_file)
-
-            print_log(" - " + str(reassigned_reads) +
-                      " reassigned reads to " + output_file, cfg.quiet)
-
-        if rep_file_out:
-            with open(rep_file, "r") as rep:
-                for line in rep:
-                    if line[0] != "#":
-                        fields = line.rstrip().split("\t")
-                        hierarchy_name = fields[0]
-                        target = fields[1]
-                        direct_matches = fields[2]
-                        rank = fields[5] if len(fields)>=6 else ""
-                        name = fields[6] if len(fields)>=7 else ""
-                        # Only print line of targets
-                        if (hierarchy == "" or hierarchy_name == hierarchy) and targets[target] in reassigned_matches:
-                            # LCA matches are zero, since they will be reassigned to other nodes
-                            new_rep.append([hierarchy_name, target, direct_matches,
-                                            reassigned_matches[targets[target]], 0, rank, name])
-
-    if rep_file_out:
-        with open(rep_file_out, "w") as rep_out:
-            for line in new_rep:
-                print(*line, sep="\t", file=rep_out)
-            for info in rep_file_info:
-                print(*info, sep="\t", file=rep_out)
-        print_log("New .rep file: " + rep_file_out, cfg.quiet)
-
-    if cfg.remove_all:
-        for af in all_files.values():
-            os.remove(af)
-
-    return True
-
-
-def get_top_match(matches, prob):
-    # Get top match based on prob
-    # In case all targets have equal probabilities (max_p==0 at the end)
-    # set first match as target (also the case for no unique matches)
-    target = matches[0][0]
-    kcount = matches[0][1]
-
-    max_p = 0
-    for m, k in matches:
-        if prob[m] > max_p:
-            max_p = prob[m]
-            target = m
-            kcount = k
-
-    return target, kcount
+                offsets, target_ids = select_ranges(c["offsets"], c["target_ids"], active)
+                weights = c["weights"][active]
+            if len(weights):
+                top = np.concatenate(list(map_chunks(lambda o, t, w: t[get_top_match(o, t, prob)],
+                                                     lambda: [(offsets, target_ids, weights)],
+                                                     executor, cfg.threads)))
+                if active is None:
+                    c["top"] = top
+                else:
+                    c["top"][active] = top
+            reassigned_matches += np.bincount(c["top"], weights=c["weights"], minlength=n_targets).astype(np.int64)
+
+        # Calculate new probabilities based on "simulated" re-distributed reads for the next round
+        new_prob = reassigned_matches / total_weight
+        diff = float(np.abs(prob - new_prob).sum())
+        changed = prob != new_prob
+        prob = new_prob
+
+        # After the first iteration every class has at least one match with counts (its top match)
+        # targets without counts will not be assigned anymore
+        if em_ite_cnt == 0:
+            for c in classes:
+                c["offsets"], c["target_ids"] = prune_classes(c["offsets"], c["target_ids"], reassigned_matches)
+
+        print_log(" - Iteration " + str(em_ite_cnt+1) +
+                  " (" + str(round(diff, 6)) + ")", cfg.quiet)
+
+        # If abs. difference among old and new probabilities already converged (no change)
+        if diff <= cfg.threshold:
+            break
+        if cfg.max_iter > 0 and em_ite_cnt == cfg.max_iter-1:
+            break
+
+        em_ite_cnt += 1
+
+    return prob, reassigned_matches
+
+
+def get_active_classes(offsets, target_ids, changed, max_active: float=0.5):
+    """
+    Get classes with at least one changed target
+    Returns None if all classes should be evaluated (first iteration or too many active classes)
+    """
+    if changed is None or len(offsets) == 1:
+        return None
+    active = np.flatnonzero(np.logical_or.reduceat(changed[target_ids], offsets[:-1]))
+    return None if len(active) > max_active * (len(offsets)-1) else active
+
+
+def select_ranges(offsets, values, idx):
+    """
+    Select ranges values[offsets[i]:offsets[i+1]] for every i in idx
+    Returns offsets and values of the selected ranges
+    """
+    sel_len = offsets[idx+1] - offsets[idx]
+    sel_offsets = np.concatenate(([0], np.cumsum(sel_len)))
+    pos = np.repeat(offsets[idx] - sel_offsets[:-1], sel_len) + np.arange(sel_offsets[-1])
+    return sel_offsets, values[pos]
+
+
+def prune_classes(offsets, target_ids, counts):
+    """
+    Remove targets without counts from classes, keeping at least one target (with counts) per class
+    """
+    keep = counts[target_ids] > 0
+    if len(keep) == 0:
+        return offsets, target_ids
+    class_len = np.add.reduceat(keep.astype(np.int64), offsets[:-1])
+    return np.concatenate(([0], np.cumsum(class_len))), target_ids[keep]
+
+
+def em_soft(multi_chunks, initial_weight, total_weight, prob, executor, cfg):
+    """
+    EM with soft assignments: reads with multiple matches are distributed among their matches
+    proportionally to prob. Accelerated with SQUAREM (Varadhan & Roland, 2008), each iteration
+    makes three passes over the matches (plus one initial pass).
+    Converges on the relative change of the log-likelihood
+    """
+    n_targets = len(initial_weight)
+    unique_targets = initial_weight > 0
+    threshold = cfg.threshold if cfg.threshold else 1e-6
+
+    def em_step(prob):
+        # Returns the next probabilities and the log-likelihood of the given prob
+        counts = initial_weight.astype(np.float64)
+        with np.errstate(divide="ignore"):
+            loglik = float((initial_weight[unique_targets] * np.log(prob[unique_targets])).sum())
+        for class_counts, class_loglik in map_chunks(lambda o, t, w: soft_counts(o, t, w, prob, n_targets),
+                                                     multi_chunks, executor, cfg.threads):
+            counts += class_counts
+            loglik += class_loglik
+        return counts / total_weight, loglik
+
+    # First step without acceleration, so all targets of all classes have positive probabilities
+    # and the log-likelihood is comparable between iterations
+    prob, _ = em_step(prob)
+
+    em_ite_cnt = 0
+    while True:
+        prob1, loglik0 = em_step(prob)
+        prob2, loglik1 = em_step(prob1)
+
+        # Extrapolate based on the last two steps
+        r = prob1 - prob
+        v = prob2 - prob1 - r
+        norm_v = np.sqrt((v*v).sum())
+        alpha = -np.sqrt((r*r).sum()) / norm_v if norm_v > 0 else -1
+        alpha = min(alpha, -1)
+        prob_sq = np.clip(prob - 2*alpha*r + alpha*alpha*v, 0, None)
+        prob_sq = prob_sq / prob_sq.sum()
+
+        # Stabilization step, keep the extrapolation only if the log-likelihood did not decrease
+        prob3, loglik_sq = em_step(prob_sq)
+        if loglik_sq >= loglik1:
+            new_prob, new_loglik = prob3, loglik_sq
+        else:
+            new_prob, new_loglik = prob2, loglik1
+
+        diff = (new_loglik - loglik0) / abs(loglik0) if loglik0 else 0
+        prob = new_prob
+
+        print_log(" - Iteration " + str(em_ite_cnt+1) +
+                  " (" + str(round(diff, 6)) + ")", cfg.quiet)
+
+        # If relative difference of the log-likelihood already converged
+        if diff <= threshold:
+            break
+        if cfg.max_iter > 0 and em_ite_cnt == cfg.max_iter-1:
+            break
+
+        em_ite_cnt += 1
+
+    return prob
+
+
+def map_chunks(func, multi_chunks, executor, threads):
+    """
+    Apply func(offsets, target_ids, weights) to every chunk of classes, yielding the results
+    If executor is set, chunks are split in partitions and evaluated in parallel
+    """
+    for chunk in multi_chunks():
+        if executor:
+            yield from executor.map(lambda p: func(*p), split_chunk(*chunk, threads))
+        else:
+            yield func(*chunk)
+
+
+def count_top_matches(offsets, target_ids, weights, prob, n_targets):
+    """
+    Sum weights of the top match of each class into counts for each target
+    """
+    top = get_top_match(offsets, target_ids, prob)
+    return np.bincount(target_ids[top], weights=weights, minlength=n_targets).astype(np.int64)
+
+
+def soft_counts(offsets, target_ids, weights, prob, n_targets):
+    """
+    Distribute weights of each class among its targets proportionally to prob
+    Classes where all targets have zero probability are distributed equally
+    Returns (fractional) counts for each target and the log-likelihood of the classes
+    """
+    if len(offsets) <= 1:
+        return np.zeros(n_targets), 0
+    class_len = np.diff(offsets)
+    p = prob[target_ids]
+    class_p = np.add.reduceat(p, offsets[:-1])
+    zero_p = class_p == 0
+    p = np.where(np.repeat(zero_p, class_len), 1, p)
+    class_p_norm = np.where(zero_p, class_len, class_p)
+    resp = p * np.repeat(weights / class_p_norm, class_len)
+    loglik = float((weights[~zero_p] * np.log(class_p[~zero_p])).sum())
+    return np.bincount(target_ids, weights=resp, minlength=n_targets), loglik
+
+
+def split_chunk(offsets, target_ids, weights, n):
+    """
+    Split a chunk of classes in n partitions with approximately the same number of matches
+    """
+    bounds = np.unique(np.searchsorted(offsets, np.linspace(0, offsets[-1], n+1)))
+    partitions = []
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        partitions.append((offsets[a:b+1]-offsets[a], target_ids[offsets[a]:offsets[b]], weights[a:b]))
+    return partitions
+
+
+def split_unique(offsets, target_ids, n_targets):
+    """
+    Count unique matches for each target (initial weights)
+    and return offsets and target ids only for reads with multiple matches
+    """
+    read_len = np.diff(offsets)
+    unique_reads = read_len == 1
+    # Not all targets have unique matches, initialize all targets with zero weights
+    initial_weight = np.bincount(target_ids[offsets[:-1][unique_reads]], minlength=n_targets)
+    multi_len = read_len[~unique_reads]
+    multi_target_ids = target_ids[np.repeat(~unique_reads, read_len)]
+    multi_offsets = np.concatenate(([0], np.cumsum(multi_len)))
+    return initial_weight, multi_offsets, multi_target_ids
+
+
+def collapse_classes(offsets, target_ids):
+    """
+    Collapse reads with the same matches into equivalence classes
+    Targets are kept in the same order of the matches, since ties are solved by the first match
+    Returns offsets and target ids of each class and weights (number of reads in each class)
+    """
+    read_len = np.diff(offsets)
+    class_len = [np.zeros(0, dtype=np.int64)]
+    class_target_ids = [np.zeros(0, dtype=np.int64)]
+    class_weights = [np.zeros(0, dtype=np.int64)]
+    # Reads with the same number of matches as a 2D array, one read per row
+    for n in np.unique(read_len):
+        rows = target_ids[np.repeat(read_len == n, read_len)].reshape(-1, n)
+        unique_rows, weights = np.unique(rows, axis=0, return_counts=True)
+        class_len.append(np.full(len(unique_rows), n, dtype=np.int64))
+        class_target_ids.append(unique_rows.ravel())
+        class_weights.append(weights)
+    class_len = np.concatenate(class_len)
+    return (np.concatenate(([0], np.cumsum(class_len))),
+            np.concatenate(class_target_ids),
+            np.concatenate(class_weights))
+
+
+def iter_all_batches(all_file, targets, batch_size: int=1000000):
+    """
+    Stream a .all file in batches of reads, assuming matches of a read are written in consecutive lines
+    New targets are added to targets {target: id}
+    Yields read ids, read offsets, target ids and kcounts for each batch
+    """
+    if is_binary(all_file):
+        # Binary files are already grouped by read in blocks
+        yield from iter_binary(all_file, targets)
+        return
+
+    read_ids = []
+    read_len = array("Q")
+    target_ids = array("Q")
+    kcounts = array("Q")
+    prev_readid = None
+    with open_file(all_file) as file:
+        for line in file:
+            readid, target, kcount = line.rstrip().split("\t")
+            if readid != prev_readid:
+                if len(read_ids) == batch_size:
+                    yield batch_arrays(read_ids, read_len, target_ids, kcounts)
+                    read_ids = []
+                    read_len = array("Q")
+                    target_ids = array("Q")
+                    kcounts = array("Q")
+                read_ids.append(readid)
+                read_len.append(0)
+                prev_readid = readid
+            if target not in targets:
+                targets[target] = len(targets)
+            read_len[-1] += 1
+            target_ids.append(targets[target])
+            kcounts.append(int(kcount))
+    if read_ids:
+        yield batch_arrays(read_ids, read_len, target_ids, kcounts)
+
+
+def batch_arrays(read_ids, read_len, target_ids, kcounts):
+    offsets = np.zeros(len(read_len)+1, dtype=np.int64)
+    np.cumsum(np.frombuffer(read_len, dtype=np.uint64), out=offsets[1:])
+    return (read_ids,
+            offsets,
+            np.frombuffer(target_ids, dtype=np.uint64).astype(np.int64),
+            np.frombuffer(kcounts, dtype=np.uint64))
+
+
+def spill_all(all_file, tmp_dir, batch_size: int=1000000):
+    """
+    Stream a .all file, counting unique matches (initial weights) and writing the
+    equivalence classes of reads with multiple matches (collapsed by batch) to tmp_dir
+    Returns targets, initial weights, total number of reads, a function to iterate over
+    the spilled classes in chunks of (offsets, target_ids, weights),
+    number of reads with multiple matches and number of classes
+    """
+    targets = {}
+    initial_weight = np.zeros(0, dtype=np.int64)
+    total_weight = 0
+    n_multi = 0
+    len_file = os.path.join(tmp_dir, "len.bin")
+    tid_file = os.path.join(tmp_dir, "tid.bin")
+    wgt_file = os.path.join(tmp_dir, "wgt.bin")
+    with open(len_file, "wb") as lf, open(tid_file, "wb") as tf, open(wgt_file, "wb") as wf:
+        for read_ids, offsets, target_ids, _ in iter_all_batches(all_file, targets, batch_size):
+            batch_weight, multi_offsets, multi_target_ids = split_unique(offsets, target_ids, len(targets))
+            # targets may have been added in this batch
+            initial_weight = np.concatenate((initial_weight, np.zeros(len(targets)-len(initial_weight), dtype=np.int64)))
+            initial_weight += batch_weight
+            total_weight += len(read_ids)
+            n_multi += len(multi_offsets)-1
+            class_offsets, class_target_ids, class_weights = collapse_classes(multi_offsets, multi_target_ids)
+            np.diff(class_offsets).astype(np.uint32).tofile(lf)
+            class_target_ids.astype(np.uint32).tofile(tf)
+            class_weights.astype(np.uint32).tofile(wf)
+
+    class_len = np.memmap(len_file, dtype=np.uint32, mode="r") if check_file(len_file) else np.zeros(0, dtype=np.uint32)
+    class_tids = np.memmap(tid_file, dtype=np.uint32, mode="r") if check_file(tid_file) else np.zeros(0, dtype=np.uint32)
+    class_wgts = np.memmap(wgt_file, dtype=np.uint32, mode="r") if check_file(wgt_file) else np.zeros(0, dtype=np.uint32)
+
+    def multi_chunks():
+        start = 0
+        for i in range(0, len(class_len), batch_size):
+            chunk_len = class_len[i:i+batch_size].astype(np.int64)
+            offsets = np.concatenate(([0], np.cumsum(chunk_len)))
+            yield (offsets,
+                   class_tids[start:start+offsets[-1]].astype(np.int64),
+                   class_wgts[i:i+batch_size].astype(np.int64))
+            start += offsets[-1]
+
+    return targets, initial_weight, total_weight, multi_chunks, n_multi, len(class_len)
+
+
+def write_one(output_file, all_batches, targets, prob, binary: bool=False):
+    """
+    Write top match of every read to a .one file (text or binary)
+    Returns number of reassigned reads (with multiple matches)
+    """
+    # reverse string target <-> integer id
+    targets_rev = list(targets.keys())
+    # targets already defined in the binary file
+    file_ids = np.full(len(targets), -1, dtype=np.int64)
+    reassigned_reads = 0
+    with open_file(output_file, "wb" if binary else "wt") as out_file:
+        if binary:
+            write_binary_header(out_file)
+        for read_ids, offsets, target_ids, kcounts in all_batches:
+            # Top match for every read (unique matches return themselves)
+            top = get_top_match(offsets, target_ids, prob)
+            if binary:
+                write_binary_block(out_file, read_ids, np.arange(len(top)+1), target_ids[top], kcounts[top],
+                                   targets_rev, file_ids)
+            else:
+                top_targets = target_ids[top].tolist()
+                top_kcounts = kcounts[top].tolist()
+                for i, readid in enumerate(read_ids):
+                    out_file.write(readid + "\t" + targets_rev[top_targets[i]] + "\t" + str(top_kcounts[i]) + "\n")
+            reassigned_reads += int(np.count_nonzero(np.diff(offsets) > 1))
+    return reassigned_reads
+
+
+def get_top_match(offsets, target_ids, prob):
+    """
+    Get top match based on prob for every read (matches in target_ids[offsets[i]:offsets[i+1]])
+    Returns the positions of the top matches in target_ids
+    In case all targets have equal probabilities (max_p==0 at the end)
+    set first match as target (also the case for no unique matches)
+    Ties are solved by the first match with the highest probability
+    """
+    if len(offsets) <= 1:
+        return np.zeros(0, dtype=np.int64)
+    starts = offsets[:-1]
+    p = prob[target_ids]
+    max_p = np.maximum.reduceat(p, starts)
+    # Position of each match, or invalid position (len) if not the max. of the read
+    pos = np.where(p == np.repeat(max_p, np.diff(offsets)), np.arange(len(p)), len(p))
+    return np.minimum.reduceat(pos, starts)
@@ -1,11 +1,22 @@
+import sys
 import time
 import os
+import numpy as np
 from math import floor, ceil
 
-from copy import deepcopy
+from copy import copy
+from io import StringIO
+from itertools import repeat
+from contextlib import redirect_stderr
+from multiprocessing import get_context, get_all_start_methods
+from concurrent.futures import ProcessPoolExecutor
 from ganon.util import validate_input_files
 from ganon.util import print_log
+from ganon.util import open_file, remove_compression_ext, compression_ext
 from ganon.tax_util import get_genome_size, parse_genome_size_tax
+from ganon.tax_index import TaxIndex, accumulate, check_multitax
+from ganon.tax_cache import load_tax, CompiledTx
+from ganon.report_cache import report_tax_key, report_cache_file, load_report_cache, save_report_cache
 
 from multitax import CustomTx, NcbiTx, GtdbTx, DummyTx
 
@@ -15,8 +26,146 @@ def report(cfg):
     print_log("", cfg.quiet)
 
     # validate input input files
-    rep_files = validate_input_files(cfg.input, cfg.input_extension, cfg.quiet)
+    rep_files = list(validate_input_files(cfg.input, cfg.input_extension, cfg.quiet))
 
+    cache_files = [None] * len(rep_files)
+    if cfg.report_cache:
+        tax_key = report_tax_key(cfg)
+        cache_files = [report_cache_file(cfg, rep_file, tax_key) for rep_file in rep_files]
+
+    # Taxonomy is always loaded, cached reports only store the entries and the used subset is rebuilt from it
+    tax, genome_sizes = load_report_tax(cfg)
+    if tax is None:
+        return False
+
+    if cfg.threads > 1 and len(rep_files) > 1 and "fork" in get_all_start_methods():
+        # Reports built in forked processes, sharing the parsed taxonomy and genome sizes without copying
+        # log of each file is kept and printed in the input order
+        with ProcessPoolExecutor(max_workers=min(cfg.threads, len(rep_files)),
+                                 mp_context=get_context("fork"),
+                                 initializer=init_report_worker,
+                                 initargs=(tax, genome_sizes)) as executor:
+            results = []
+            for r, log in executor.map(report_worker, rep_files, cache_files, repeat(len(rep_files)), repeat(cfg)):
+                sys.stderr.write(log)
+                sys.stderr.flush()
+                results.append(r)
+    else:
+        results = [report_file(rep_file, cache_file, len(rep_files), tax, genome_sizes, cfg)
+                   for rep_file, cache_file in zip(rep_files, cache_files)]
+
+    return any(results)
+
+
+def init_report_worker(tax, genome_sizes):
+    """
+    Set taxonomy and genome sizes for report_worker() (inherited on fork)
+    """
+    global worker_tax, worker_genome_sizes
+    worker_tax = tax
+    worker_genome_sizes = genome_sizes
+
+
+def report_worker(rep_file, cache_file, n_files, cfg):
+    """
+    Run report_file() in a worker process, returns its result and log
+    """
+    log = StringIO()
+    with redirect_stderr(log):
+        r = report_file(rep_file, cache_file, n_files, worker_tax, worker_genome_sizes, cfg)
+    return r, log.getvalue()
+
+
+def report_file(rep_file, cache_file, n_files, tax, genome_sizes, cfg):
+    """
+    Build and write report(s) for a .rep file, returns True if any report was written
+    """
+    any_rep = False
+
+    trees = load_report_cache(cache_file, cfg.quiet) if cache_file else None
+    if trees is None:
+        trees = build_trees(rep_file, tax, genome_sizes, cfg)
+        if cache_file and trees is not None:
+            # Only entries are cached, taxonomy view is rebuilt when loaded
+            save_report_cache(cache_file, [(h, {k: v for k, v in tree.items() if k not in ["tax", "ti"]})
+                                           for h, tree in trees], cfg.quiet)
+    else:
+        for _, tree in trees:
+            tree["tax"], tree["ti"], _ = build_tax_view(tax, tree["merged_rep"].keys())
+        print_log(" - cached report loaded for " + rep_file, cfg.quiet)
+
+    if trees is None:
+        print_log(" - nothing to report for " + rep_file, cfg.quiet)
+        return False
+
+    # General output file
+    output_file = get_output_file(cfg.output_prefix, rep_file, n_files)
+    # Several formats are written from the same report, with the format in the file name
+    output_formats = list(dict.fromkeys(cfg.output_format))
+    output_ext = ".tre" + compression_ext.get(cfg.output_compression, "")
+
+    if cfg.split_hierarchy:
+        for h, tree in trees:
+            default_ranks, fixed_ranks = get_report_ranks(cfg, tree["tax"])
+            rep = select_report(tree, fixed_ranks, default_ranks, cfg)
+            if not rep:
+                print_log(" - nothing to report for hierarchy " +
+                          h + " in the " + rep_file, cfg.quiet)
+                continue
+            else:
+                for output_format in output_formats:
+                    output_file_h = output_file + "." + h + ("." + output_format if len(output_formats) > 1 else "") + output_ext
+                    write_report(rep, output_file_h, output_format, cfg, rep_file)
+                    print_log(" - report saved to " +
+                              output_file_h, cfg.quiet)
+                any_rep = True
+
+    else:
+        _, tree = trees[0]
+        default_ranks, fixed_ranks = get_report_ranks(cfg, tree["tax"])
+        rep = select_report(tree, fixed_ranks, default_ranks, cfg)
+        if not rep:
+            print_log(" - nothing to report for " + rep_file, cfg.quiet)
+            return False
+        else:
+            for output_format in output_formats:
+                output_file_f = output_file + ("." + output_format if len(output_formats) > 1 else "") + output_ext
+                write_report(rep, output_file_f, output_format, cfg, rep_file)
+                print_log(" - report saved to " + output_file_f, cfg.quiet)
+            any_rep = True
+    print_log("", cfg.quiet)
+
+    return any_rep
+
+
+def build_trees(rep_file, tax, genome_sizes, cfg):
+    """
+    Parse .rep file and build trees (before filters) for each hierarchy (--split-hierarchy) or for all
+    Returns a list of (hierarchy, tree) or None if nothing to report
+    """
+    reports, counts = parse_rep(rep_file, cfg.normalize)
+
+    if not reports:
+        return None
+
+    # If skipping/keeping hiearchies, remove all assignments from reports
+    if cfg.skip_hierarchy or cfg.keep_hierarchy:
+        reports = remove_hierarchy(
+            reports, counts, cfg.skip_hierarchy, cfg.keep_hierarchy, cfg.quiet)
+
+    default_ranks, _ = get_report_ranks(cfg, tax)
+    if cfg.split_hierarchy:
+        return [(h, build_tree({h: reports[h]}, counts, tax, genome_sizes, default_ranks, cfg))
+                for h in reports if h not in cfg.skip_hierarchy]
+    else:
+        return [(None, build_tree(reports, counts, tax, genome_sizes, default_ranks, cfg))]
+
+
+def load_report_tax(cfg):
+    """
+    Load taxonomy (from .tax files, files or download) and genome sizes for reports
+    Returns None, None if genome sizes are required and not available
+    """
     # Parse taxonomy or download new
     tax_args = {"undefined_node": "",
                 "undefined_rank": "na",
@@ -34,17 +183,24 @@ def report(cfg):
             else:
                 dbp.append(prefix+".tax")
 
-        tax = CustomTx(files=dbp,
-                       cols=["node", "parent", "rank", "name"],
-                       **tax_args)
+        if cfg.taxonomy_cache:
+            tax = load_tax(CustomTx, dbp, cfg.taxonomy_cache, cfg.quiet, genome_sizes=True,
+                           cols=["node", "parent", "rank", "name"], **tax_args)
+        else:
+            tax = CustomTx(files=dbp,
+                           cols=["node", "parent", "rank", "name"],
+                           **tax_args)
 
         if cfg.report_type in ["abundance", "corr"]:
             try:
-                genome_sizes = parse_genome_size_tax(dbp)
+                if isinstance(tax, CompiledTx):
+                    genome_sizes = tax.genome_sizes()
+                else:
+                    genome_sizes = parse_genome_size_tax(dbp)
             except ValueError:
                 print_log(
                     "Failed to get genome sizes from .tax files, run ganon report without -d/--db-prefix")
-                return False
+                return None, None
     else:
         if cfg.taxonomy == "skip":
             tax = DummyTx(**tax_args)
@@ -56,18 +212,26 @@ def report(cfg):
                 print_log("Downloading and parsing " +
                           cfg.taxonomy + " taxonomy", cfg.quiet)
 
-            if cfg.taxonomy == "ncbi":
-                tax = NcbiTx(files=cfg.taxonomy_files, **tax_args)
-            elif cfg.taxonomy == "gtdb":
-                tax = GtdbTx(files=cfg.taxonomy_files, **tax_args)
+            tax_class = NcbiTx if cfg.taxonomy == "ncbi" else GtdbTx
+            if cfg.taxonomy_files and cfg.taxonomy_cache:
+                tax = load_tax(tax_class, cfg.taxonomy_files, cfg.taxonomy_cache, cfg.quiet, **tax_args)
+            else:
+                tax = tax_class(files=cfg.taxonomy_files, **tax_args)
 
             print_log(" - done in " + str("%.2f" %
                                           (time.time() - tx)) + "s.\n", cfg.quiet)
 
         # In case no tax was provided, generate genome sizes (for the full tree)
         if cfg.report_type in ["abundance", "corr"]:
-            genome_sizes = get_genome_size(cfg, tax.leaves(), tax, "./")
+            genome_sizes = get_genome_size(cfg, None, tax, "./")
+
+    return tax, genome_sizes
 
+
+def get_report_ranks(cfg, tax):
+    """
+    Returns default ranks and ranks to report (empty for all)
+    """
     default_ranks = [tax.root_name] + cfg.choices_default_ranks
 
     # define fixed_ranks or leave it empty for all
@@ -79,64 +243,25 @@ def report(cfg):
         else:
             fixed_ranks = [tax.root_name] + cfg.ranks
 
-    any_rep = False
-    
-    # Parse report file
-    for rep_file in rep_files:
-        
-        reports, counts = parse_rep(rep_file, cfg.normalize)
+    return default_ranks, fixed_ranks
 
-        if not reports:
-            print_log(" - nothing to report for " + rep_file, cfg.quiet)
-            continue
-
-        # If skipping/keeping hiearchies, remove all assignments from reports
-        if cfg.skip_hierarchy or cfg.keep_hierarchy:
-            reports = remove_hierarchy(
-                reports, counts, cfg.skip_hierarchy, cfg.keep_hierarchy, cfg.quiet)
-
-        # General output file
-        if len(rep_files) == 1:
-            output_file = cfg.output_prefix
-        else:
-            file_pre = os.path.splitext(os.path.basename(rep_file))[0]
-            output_file = cfg.output_prefix+file_pre
-
-        if cfg.split_hierarchy:
-            for h in reports:
-                if h not in cfg.skip_hierarchy:
-                    output_file_h = output_file + "." + h + ".tre"
-                    r = build_report(
-                        {h: reports[h]}, counts, tax, genome_sizes, output_file_h, fixed_ranks, default_ranks, cfg, rep_file)
-                    if not r:
-                        print_log(" - nothing to report for hierarchy " +
-                                  h + " in the " + rep_file, cfg.quiet)
-                        continue
-                    else:
-                        print_log(" - report saved to " +
-                                  output_file_h, cfg.quiet)
-                        any_rep = True
-
-        else:
-            output_file = output_file + ".tre"
-            r = build_report(reports, counts, tax, genome_sizes,
-                             output_file, fixed_ranks, default_ranks, cfg, rep_file)
-            if not r:
-                print_log(" - nothing to report for " + rep_file, cfg.quiet)
-                continue
-            else:
-                print_log(" - report saved to " + output_file, cfg.quiet)
-                any_rep = True
-        print_log("", cfg.quiet)
 
-    return True if any_rep else False
+def get_output_file(output_prefix, rep_file, n_files):
+    """
+    Output file for a .rep file (without .tre), base input filename is appended for multiple files
+    """
+    if n_files == 1:
+        return output_prefix
+    else:
+        file_pre = os.path.splitext(os.path.basename(remove_compression_ext(rep_file)))[0]
+        return output_prefix + file_pre
 
 
 def parse_rep(rep_file, normalize):
     counts = {}
     reports = {}
     total_direct_matches = 0
-    with open(rep_file, 'r') as rep_file:
+    with open_file(rep_file) as rep_file:
         for line in rep_file:
             fields = line.rstrip().split("\t")
             if fields[0] == "#total_classified":
@@ -178,7 +303,20 @@ def parse_rep(rep_file, normalize):
     return reports, counts
 
 
-def build_report(reports, counts, full_tax, genome_sizes, output_file, fixed_ranks, default_ranks, cfg, rep_file):
+def build_report(reports, counts, full_tax, genome_sizes, fixed_ranks, default_ranks, cfg):
+    """
+    Build a report from parsed .rep entries
+    Returns a dict with the filtered and sorted entries or None if nothing to report
+    """
+    tree = build_tree(reports, counts, full_tax, genome_sizes, default_ranks, cfg)
+    return select_report(tree, fixed_ranks, default_ranks, cfg)
+
+
+def build_tree(reports, counts, full_tax, genome_sizes, default_ranks, cfg):
+    """
+    Build cumulative counts and percentages on the tree from parsed .rep entries
+    Depends only on the input, taxonomy and report type (not on filters), can be re-used with select_report()
+    """
 
     # total
     if cfg.report_type == "matches":
@@ -192,78 +330,146 @@ def build_report(reports, counts, full_tax, genome_sizes, output_file, fixed_ran
     else:
         merged_rep = merge_reports(reports)
 
-    # Copy full tax and only keep used subset (for consistency with downloaded taxonomy)
-    tax = deepcopy(full_tax)
-    tax.filter(list(merged_rep.keys()))
-
-    orphan_nodes = set()
-    # Add orphan nodes to taxonomy
-    for node in merged_rep.keys():
-        if tax.latest(node) == tax.undefined_node:
-            tax.add(node, tax.root_node)
-            orphan_nodes.add(node)
-    tax.check_consistency()
-    # Pre-build lineages for performance
-    tax.build_lineages()
+    tax, ti, orphan_nodes = build_tax_view(full_tax, merged_rep.keys())
 
     # Re-distribute lca reads to leaf nodes based on unique matches or shared
     if cfg.report_type in ["abundance", "dist"]:
-        redistribute_shared_reads(merged_rep, tax)
+        redistribute_shared_reads(merged_rep, ti)
 
     # Count data from merged_rep into a final count per target, depending on report type
     target_counts = count_targets(merged_rep, cfg.report_type)
 
     # Cummulatively sum leaf counts to its lineage parents
-    tree_cum_counts = cummulative_sum_tree(target_counts, tax)
+    tree_cum_counts = cummulative_sum_tree(target_counts, ti)
 
     if cfg.report_type in ["abundance", "corr"]:
         # Correct counts based on estimated genome sizes for default ranks
         # returns tree_cum_counts with corrected FRACTION of counts and use it to calculate the abundances
         # still reports original counts for user
         corr_tree_cum_counts = correct_genome_size(
-            target_counts, genome_sizes, tax, default_ranks)
+            target_counts, genome_sizes, ti, default_ranks)
         tree_cum_perc = cummulative_perc_tree(corr_tree_cum_counts, total)
     else:
         # Simple percentage calculation
         tree_cum_perc = cummulative_perc_tree(tree_cum_counts, total)
 
+    return {"hierarchies": list(reports.keys()),
+            "tax": tax,
+            "ti": ti,
+            "orphan_nodes": orphan_nodes,
+            "merged_rep": merged_rep,
+            "total": total,
+            "unclassified": counts["total"]["unclassified"],
+            "cum_counts": tree_cum_counts,
+            "cum_perc": tree_cum_perc}
+
+
+def build_tax_view(full_tax, nodes):
+    """
+    View of full tax with only used subset (for consistency with downloaded taxonomy) and orphan nodes
+    Returns the taxonomy view, its integer indexed taxonomy (TaxIndex) and the set of orphan nodes
+    """
+    tax = filter_tax(full_tax, nodes)
+
+    orphan_nodes = set()
+    # Add orphan nodes to taxonomy
+    for node in nodes:
+        if tax.latest(node) == tax.undefined_node:
+            tax.add(node, tax.root_node)
+            orphan_nodes.add(node)
+    tax.check_consistency()
+    # Integer indexed taxonomy for operations over the tree
+    return tax, TaxIndex(tax), orphan_nodes
+
+
+def select_report(tree, fixed_ranks, default_ranks, cfg):
+    """
+    Filter and sort entries of a tree from build_tree()
+    Returns a dict with the filtered and sorted entries or None if nothing to report
+    """
+    tax = tree["tax"]
+    ti = tree["ti"]
+    orphan_nodes = tree["orphan_nodes"]
+    merged_rep = tree["merged_rep"]
+    tree_cum_counts = tree["cum_counts"]
+    tree_cum_perc = tree["cum_perc"]
+
     # filter with fixed ranks and user parameters (names, taxid)
     # filtered_cum_counts[node] = cum_count
     filtered_cum_counts = filter_report(
-        tree_cum_counts, tree_cum_perc, tax, fixed_ranks, default_ranks, orphan_nodes, cfg)
+        tree_cum_counts, tree_cum_perc, ti, fixed_ranks, default_ranks, orphan_nodes, cfg)
 
     if not filtered_cum_counts:
-        return False
+        return None
 
     # sort entries based on report or user-defined
     # sorted_nodes = ["1", "1224", ...]
     sorted_nodes = sort_report(
-        filtered_cum_counts, tree_cum_perc, cfg.sort, fixed_ranks, tax, merged_rep)
+        filtered_cum_counts, tree_cum_perc, cfg.sort, fixed_ranks, ti, merged_rep)
+
+    if orphan_nodes and not cfg.no_orphan:
+        print_log(" - WARNING: " + str(len(orphan_nodes)) + " not found in the taxonomy (orphan nodes). " +
+                  "\n   Orphan nodes are reported with 'na' rank with root as a direct parent node. " +
+                  "\n   Too show them, use 'na' in --ranks or set --ranks all"
+                  "\n   Too ommit them, use --no-orphan", cfg.quiet)
+    print_log(" - " + str(len(sorted_nodes)) + " entries reported", cfg.quiet)
+
+    return {"hierarchies": tree["hierarchies"],
+            "tax": tax,
+            "ti": ti,
+            "merged_rep": merged_rep,
+            "total": tree["total"],
+            "unclassified": tree["unclassified"],
+            "sorted_nodes": sorted_nodes,
+            "cum_counts": filtered_cum_counts,
+            "cum_perc": tree_cum_perc,
+            "fixed_ranks": fixed_ranks,
+            "fixed_lineages": ti.ranked_lineages(fixed_ranks) if fixed_ranks else None,
+            "lineages": {}}
+
+
+def report_lineage(rep, node):
+    """
+    Returns lineage of a node in the report, only with fixed ranks if defined
+    Kept in the report to be re-used when writing several output formats
+    """
+    if node not in rep["lineages"]:
+        ti = rep["ti"]
+        if rep["fixed_ranks"]:
+            r = rep["fixed_ranks"].index(rep["tax"].rank(node))
+            rep["lineages"][node] = ti.get_nodes(rep["fixed_lineages"][ti.index[node], :r+1])
+        else:
+            rep["lineages"][node] = ti.get_nodes(ti.lineage(ti.index[node]))
+    return rep["lineages"][node]
+
+
+def write_report(rep, output_file, output_format, cfg, rep_file):
+    """
+    Write report from build_report() to output_file (.tre) in the output_format [text, tsv, csv, bioboxes]
+    output_file is compressed if it ends with .gz or .zst
+    """
+    tax = rep["tax"]
+    tree_cum_perc = rep["cum_perc"]
+    sorted_nodes = rep["sorted_nodes"]
+    fixed_ranks = rep["fixed_ranks"]
 
     # Output file
-    tre_file = open(output_file, 'w')
+    tre_file = open_file(output_file, "wt")
 
-    if cfg.output_format == "bioboxes":
+    if output_format == "bioboxes":
         print("@Version:0.10.0", file=tre_file)
-        print("@SampleID:" + rep_file + " " + ",".join(reports.keys()), file=tre_file)
+        print("@SampleID:" + rep_file + " " + ",".join(rep["hierarchies"]), file=tre_file)
         print("@Ranks:" + "|".join(fixed_ranks[1:]), file=tre_file)
         print("@Taxonomy:" + ",".join(tax.sources), file=tre_file)
         print("@@TAXID\tRANK\tTAXPATH\tTAXPATHSN\tPERCENTAGE", file=tre_file)
         for node in sorted_nodes:
-            cum_perc = tree_cum_perc[node]*100
             # Do not report root
             if node == tax.root_node:
                 continue
 
             cum_perc = tree_cum_perc[node]*100
-
-            if fixed_ranks:
-                r = fixed_ranks.index(tax.rank(node))
-                lineage = tax.lineage(node, ranks=fixed_ranks[:r+1])
-                name_lineage = tax.name_lineage(node, ranks=fixed_ranks[:r+1])
-            else:
-                lineage = tax.lineage(node)
-                name_lineage = tax.name_lineage(node)
+            lineage = report_lineage(rep, node)
+            name_lineage = [tax.name(n) for n in lineage]
 
             out_line = [node,
                         tax.rank(node),
@@ -274,63 +480,16 @@ def build_report(reports, counts, full_tax, genome_sizes, output_file, fixed_ran
 
     else:
         output_rows = []
-        # Reporting reads, first line prints unclassified entries
-        if cfg.report_type != "matches" and not cfg.normalize:
-            unclassified_line = ["unclassified",
-                                 "-",
-                                 "-",
-                                 "unclassified",
-                                 "0",
-                                 "0",
-                                 "0",
-                                 str(counts["total"]["unclassified"]),
-                                 str("%.5f" % ((counts["total"]["unclassified"]/total)*100))]
-            if cfg.output_format in ["tsv", "csv"]:
-                print(*unclassified_line, file=tre_file,
-                      sep="\t" if cfg.output_format == "tsv" else ",")
-            else:
-                output_rows.append(unclassified_line)
-
-        # All entries
-        for node in sorted_nodes:
-            cum_count = filtered_cum_counts[node]
-            cum_perc = tree_cum_perc[node]*100
-            unique = 0
-            shared = 0
-            children = cum_count
-            if node in merged_rep:
-                unique = merged_rep[node]['unique_reads']
-                if cfg.report_type == "matches":
-                    shared = merged_rep[node]['direct_matches'] - \
-                        merged_rep[node]['unique_reads']
-                else:
-                    shared = merged_rep[node]['lca_reads']
-
-            children = children - unique - shared
-
-            if fixed_ranks:
-                r = fixed_ranks.index(tax.rank(node))
-                lineage = tax.lineage(node, ranks=fixed_ranks[:r+1])
-            else:
-                lineage = tax.lineage(node)
-
-            out_line = [tax.rank(node),
-                        node,
-                        "|".join(lineage),
-                        tax.name(node),
-                        str(unique),
-                        str(shared),
-                        str(children),
-                        str(cum_count),
-                        str("%.5f" % cum_perc)]
-            if cfg.output_format in ["tsv", "csv"]:
+        for row in report_rows(rep, cfg):
+            out_line = [str(v) for v in row[:-1]] + [str("%.5f" % row[-1])]
+            if output_format in ["tsv", "csv"]:
                 print(*out_line, file=tre_file,
-                      sep="\t" if cfg.output_format == "tsv" else ",")
+                      sep="\t" if output_format == "tsv" else ",")
             else:
                 output_rows.append(out_line)
 
         # Print formated text
-        if cfg.output_format == "text":
+        if output_format == "text":
             # Check max width for each col
             max_width = [0]*len(output_rows[0])
             for row in output_rows:
@@ -343,16 +502,81 @@ def build_report(reports, counts, full_tax, genome_sizes, output_file, fixed_ran
                 print("\t".join(['{0: <{width}}'.format(field, width=max_width[i]) for i, field in enumerate(row)]),
                       file=tre_file)
 
-    if output_file:
-        tre_file.close()
+    tre_file.close()
 
-    if orphan_nodes and not cfg.no_orphan:
-        print_log(" - WARNING: " + str(len(orphan_nodes)) + " not found in the taxonomy (orphan nodes). " +
-                  "\n   Orphan nodes are reported with 'na' rank with root as a direct parent node. " +
-                  "\n   Too show them, use 'na' in --ranks or set --ranks all"
-                  "\n   Too ommit them, use --no-orphan", cfg.quiet)
-    print_log(" - " + str(len(sorted_nodes)) + " entries reported", cfg.quiet)
-    return True
+
+def report_rows(rep, cfg):
+    """
+    Returns the rows of a report from build_report() as written in the .tre file (tsv, csv, text)
+    [rank, target, lineage, name, unique, shared, children, cumulative, cumulative_perc] with values not formatted
+    """
+    tax = rep["tax"]
+    total = rep["total"]
+    merged_rep = rep["merged_rep"]
+    tree_cum_perc = rep["cum_perc"]
+    filtered_cum_counts = rep["cum_counts"]
+
+    rows = []
+    # Reporting reads, first line prints unclassified entries
+    if cfg.report_type != "matches" and not cfg.normalize:
+        rows.append(["unclassified", "-", "-", "unclassified", 0, 0, 0,
+                     rep["unclassified"], (rep["unclassified"]/total)*100])
+
+    # All entries
+    for node in rep["sorted_nodes"]:
+        cum_count = filtered_cum_counts[node]
+        cum_perc = tree_cum_perc[node]*100
+        unique = 0
+        shared = 0
+        children = cum_count
+        if node in merged_rep:
+            unique = merged_rep[node]['unique_reads']
+            if cfg.report_type == "matches":
+                shared = merged_rep[node]['direct_matches'] - \
+                    merged_rep[node]['unique_reads']
+            else:
+                shared = merged_rep[node]['lca_reads']
+
+        children = children - unique - shared
+
+        rows.append([tax.rank(node),
+                     node,
+                     "|".join(report_lineage(rep, node)),
+                     tax.name(node),
+                     unique,
+                     shared,
+                     children,
+                     cum_count,
+                     cum_perc])
+    return rows
+
+
+def filter_tax(full_tax, nodes):
+    """
+    Returns a view of full_tax keeping only the lineages of the given nodes (same as multitax filter)
+    Only the small node/name/rank dicts are new, anything else is shared and full_tax is left untouched
+    """
+    if isinstance(full_tax, CompiledTx):
+        return full_tax.filter(nodes)
+
+    keep = set([full_tax.root_node])
+    for node in nodes:
+        # Walk up until a node already kept (its lineage reaches root), skip nodes without valid lineage
+        path = []
+        while node not in keep and node != full_tax.undefined_node:
+            path.append(node)
+            node = full_tax.parent(node)
+        if node in keep:
+            keep.update(path)
+
+    # Private multitax attributes, only for the tested version
+    check_multitax(full_tax)
+    tax = copy(full_tax)
+    tax._nodes = {node: full_tax._nodes[node] for node in keep}
+    tax._names = {node: full_tax._names[node] for node in keep if node in full_tax._names}
+    tax._ranks = {node: full_tax._ranks[node] for node in keep if node in full_tax._ranks}
+    tax._reset_aux_data()
+    return tax
 
 
 def merge_reports(reports):
@@ -383,43 +607,45 @@ def count_targets(merged_rep, report_type):
     return res
 
 
-def redistribute_shared_reads(merged_rep, tax):
+def redistribute_shared_reads(merged_rep, ti):
     """
     change merged_rep with redistributed reads
     only move counts of lca_reads
     """
+    # Leaves with unique reads (or direct matches) sorted by pre-order position in the tree
+    # leaves under a target are in the interval of its subtree, with totals as differences of cumulative sums
+    redist_leaves = {}
+    for redist_field in ["unique_reads", "direct_matches"]:
+        idx = ti.get_index([node for node, v in merged_rep.items() if v[redist_field] > 0 and node in ti.index])
+        idx = idx[ti.size[idx] == 1]
+        idx = idx[np.argsort(ti.pre[idx])]
+        leaves = ti.get_nodes(idx)
+        cum_values = np.zeros(len(leaves)+1, dtype=np.int64)
+        np.cumsum(np.array([merged_rep[leaf][redist_field] for leaf in leaves], dtype=np.int64), out=cum_values[1:])
+        redist_leaves[redist_field] = (ti.pre[idx], leaves, cum_values.tolist())
+
     for target in merged_rep.keys():
 
         # if there are shared reads to redistribute among leaves
         if merged_rep[target]["lca_reads"] > 0:
 
-            # Get leaves or return itself in case of target is already a leaf
-            leaves = tax.leaves(target)
-
-            # If returned itself, no redistribution necessary / not found in tax, skip
-            if not leaves or leaves == [target]:
+            # Not found in tax or target is already a leaf, no redistribution necessary
+            if target not in ti.index or ti.size[ti.index[target]] == 1:
                 continue
 
             # Distribute shared reads among leaves with unique reads
-            redist_field = "unique_reads"
-            total_leaves = 0
-            leaves_unique = set()
-            for leaf in leaves:
-                if leaf in merged_rep and merged_rep[leaf]["unique_reads"] > 0:
-                    leaves_unique.add(leaf)
-                    total_leaves += merged_rep[leaf]["unique_reads"]
-
             # If leaves of this target got no unique assignments, use the shared matches to redistribute reads
-            if len(leaves_unique) == 0:
-                redist_field = "direct_matches"
-                for leaf in leaves:
-                    if leaf in merged_rep and merged_rep[leaf]["direct_matches"] > 0:
-                        leaves_unique.add(leaf)
-                        total_leaves += merged_rep[leaf]["direct_matches"]
-
-            # If no leaves could be found, skip
-            if len(leaves_unique) == 0:
+            i = ti.index[target]
+            for redist_field in ["unique_reads", "direct_matches"]:
+                pre, leaves, cum_values = redist_leaves[redist_field]
+                start, end = np.searchsorted(pre, [ti.pre[i], ti.pre[i] + ti.size[i]]).tolist()
+                if end > start:
+                    break
+            else:
+                # If no leaves could be found, skip
                 continue
+            leaves_unique = leaves[start:end]
+            total_leaves = cum_values[end] - cum_values[start]
 
             total_redist = 0
             for leaf in leaves_unique:
@@ -427,9 +653,6 @@ def redistribute_shared_reads(merged_rep, tax):
                 red = floor(merged_rep[target]["lca_reads"] *
                             (merged_rep[leaf][redist_field]/total_leaves))
                 total_redist += red
-                if leaf not in merged_rep:
-                    merged_rep[leaf] = {'unique_reads': 0,
-                                        'lca_reads': 0, 'direct_matches': 0}
                 merged_rep[leaf]['lca_reads'] += red
 
             # If there are left overs to redistribute
@@ -444,86 +667,78 @@ def redistribute_shared_reads(merged_rep, tax):
             merged_rep[target]["lca_reads"] = 0
 
 
-def correct_genome_size(target_counts, genome_sizes, tax, default_ranks):
+def correct_genome_size(target_counts, genome_sizes, ti, default_ranks):
     """
     Correct counts with genome sizes based only on default ranks.
     Leaf or nodes in between are counted for its closest default parent
     Other ranks are ignored on the correction but re-inserted later
     Correct counts (allowing fractions) independently for each tax. level and regenerate cum tree at the end
     """
-    ranked_counts = {}
-    lost_targets = {}
-    no_genome_size_cnt = 0
-    total_rank_ratio = {r: 0 for r in default_ranks}
-    total_rank_count = {r: 0 for r in default_ranks}
-    for target, count in target_counts.items():
-
-        # Define closest parent based on default ranks and save count
-        closest_parent = tax.closest_parent(target, ranks=default_ranks)
-        if closest_parent not in ranked_counts:
-            ranked_counts[closest_parent] = 0
-        ranked_counts[closest_parent] += count
-
-        # Keep track of targets merged into default ranks
-        if closest_parent != target:
-            lost_targets[target] = closest_parent
-
-        # Sum total counts for each default rank
-        gs = genome_sizes[closest_parent] if closest_parent in genome_sizes else genome_sizes[tax.root_node]
-        # Keep track of genome sizes = 1 (no genome size available)
-        if gs==1:
-            no_genome_size_cnt+=1
-        closest_rank = tax.rank(closest_parent)
-        total_rank_ratio[closest_rank] += count/gs
-        total_rank_count[closest_rank] += count
-
-    # Warning, some genomes have no proper size
+    targets = ti.get_index(target_counts.keys())
+    counts = np.array(list(target_counts.values()))
+
+    # Define closest parent based on default ranks and sum counts
+    closest_parents = ti.closest_parent(default_ranks)[targets]
+    assert (closest_parents >= 0).all(), "nodes without parent in the default ranks"
+    ranked_nodes, ranked_counts = accumulate(closest_parents, counts)
+
+    # Genome sizes of the default rank nodes
+    root_gs = genome_sizes[ti.tax.root_node]
+    ranked_gs = np.array([genome_sizes[node] if node in genome_sizes else root_gs for node in ti.get_nodes(ranked_nodes)])
+    gs = np.zeros(len(ti.nodes), dtype=ranked_gs.dtype)
+    gs[ranked_nodes] = ranked_gs
+
+    # Sum total counts for each default rank
+    closest_ranks = ti.rank[closest_parents]
+    total_rank_ratio = np.zeros(len(ti.ranks))
+    total_rank_count = np.zeros(len(ti.ranks), dtype=counts.dtype)
+    rank_codes, rank_ratio = accumulate(closest_ranks, counts/gs[closest_parents])
+    total_rank_ratio[rank_codes] = rank_ratio
+    rank_codes, rank_count = accumulate(closest_ranks, counts)
+    total_rank_count[rank_codes] = rank_count
+
+    # Warning, some genomes have no proper size (genome sizes = 1)
+    no_genome_size_cnt = int(np.count_nonzero(gs[closest_parents] == 1))
     if no_genome_size_cnt > 0 and len(target_counts) != no_genome_size_cnt:
         print_log(" - WARNING: " + str(no_genome_size_cnt) + " genomes without proper genome size, abundance estimation may be biased. Use a --report-type without genome size correction or omit --db-prefix on ganon report to re-generate genome sizes.")
 
     # Correct counts by the genome sizes (only default ranks)
-    corr_counts = {t: 0 for t in ranked_counts.keys()}
-    for node in ranked_counts.keys():
-        rank_node = tax.rank(node)
-        gs = genome_sizes[node] if node in genome_sizes else genome_sizes[tax.root_node]
-        corr_counts[node] = total_rank_count[rank_node] * \
-            ((ranked_counts[node]/gs)/total_rank_ratio[rank_node])
+    ranked_ranks = ti.rank[ranked_nodes]
+    corr_counts = total_rank_count[ranked_ranks] * \
+        ((ranked_counts/ranked_gs)/total_rank_ratio[ranked_ranks])
 
     # Corrected counts should match original
     assert sum(target_counts.values()) == round(
-        sum(corr_counts.values())), "invalid number of counts after correction"
+        sum(corr_counts.tolist())), "invalid number of counts after correction"
 
     # Generate cumulative tree based on corrected counts
-    corr_tree = cummulative_sum_tree(corr_counts, tax)
+    corr_tree = cummulative_sum_tree(dict(zip(ti.get_nodes(ranked_nodes), corr_counts.tolist())), ti)
 
     # Re-insert lost targets in the tree
     # They can be either leaf or ranks in between default ranks (e.g. strain or suborder)
     # Step necessary to report any rank in abundance node (default rank nodes are unchanged)
-    for target, closest_parent in lost_targets.items():
-        # all ranks in between default ranks will receive proportional counts from parent
-        for t in tax.lineage(target, root_node=closest_parent)[1:]:
-            # In case of a leaf node, re-add to the tree
-            if t not in corr_tree:
-                corr_tree[t] = 0
-            # Sum proportional amount of reads of default parent node to all nodes in between
-            corr_tree[t] += target_counts[target] * \
-                (corr_counts[closest_parent]/ranked_counts[closest_parent])
+    # all ranks in between default ranks will receive proportional counts from parent
+    lost = closest_parents != targets
+    corr_ratio = np.zeros(len(ti.nodes))
+    corr_ratio[ranked_nodes] = corr_counts/ranked_counts
+    pos, idx = ti.lineage_pairs(targets[lost], stop=closest_parents[lost])
+    lost_counts = counts[lost]*corr_ratio[closest_parents[lost]]
 
-    return corr_tree
+    # Sum proportional amount of reads of default parent node to all nodes in between (in order after the cum. tree)
+    nodes, sums = accumulate(np.concatenate([ti.get_index(corr_tree.keys()), idx]),
+                             np.concatenate([np.array(list(corr_tree.values()), dtype=float), lost_counts[pos]]))
+    return dict(zip(ti.get_nodes(nodes), sums.tolist()))
 
 
-def cummulative_sum_tree(target_count, tax):
+def cummulative_sum_tree(target_count, ti):
     """
     Iterate over the taxonomic tree and sum the values of a dict cummulatively {node: value}
     """
-    cum_counts = {}
-    for target, count in target_count.items():
-        # Cummulative sum of all nodes up to root
-        for t in tax.lineage(target):
-            if t not in cum_counts:
-                cum_counts[t] = 0
-            cum_counts[t] += count
-    return cum_counts
+    targets = [target for target in target_count if target in ti.index]
+    pos, idx = ti.lineage_pairs(ti.get_index(targets))
+    values = np.array([target_count[target] for target in targets])
+    nodes, sums = accumulate(idx, values[pos])
+    return dict(zip(ti.get_nodes(nodes), sums.tolist()))
 
 
 def cummulative_perc_tree(tree_cum_counts, total):
@@ -537,12 +752,10 @@ def cummulative_perc_tree(tree_cum_counts, total):
     return tree_cum_perc
 
 
-def filter_report(tree_cum_counts, tree_cum_perc, tax, fixed_ranks, default_ranks, orphan_nodes, cfg):
+def filter_report(tree_cum_counts, tree_cum_perc, ti, fixed_ranks, default_ranks, orphan_nodes, cfg):
     """
     filter with fixed ranks and user parameters (names, taxid)
     """
-    filtered_cum_counts = {}
-
     filter_counts_msg = {}
     filter_counts_msg["orphan"] = {"count": 0, "msg": "orphan entries removed"}
     filter_counts_msg["ranks"] = {"count": 0, "msg": "entries removed not in --ranks [" + (",".join(fixed_ranks[1:]) if fixed_ranks else "") + "]"}
@@ -553,76 +766,65 @@ def filter_report(tree_cum_counts, tree_cum_perc, tax, fixed_ranks, default_rank
     filter_counts_msg["names"] = {"count": 0, "msg": "entries removed not in --names [" + ",".join(cfg.names) + "]"}
     filter_counts_msg["names_with"] = {"count": 0, "msg": "entries removed not in --names-with [" + ",".join(cfg.names_with) + "]"}
 
+    nodes = list(tree_cum_counts.keys())
+    idx = ti.get_index(nodes)
+    ranks = ti.rank[idx]
+    cum_counts = np.array(list(tree_cum_counts.values()))
+    cum_perc = np.array([tree_cum_perc[node] for node in nodes])
 
-    rank_cutoff_percentile = {}
-    # Detect cut-off for top percentile
-    if cfg.top_percentile:
-        rank_perc = {r: [] for r in default_ranks}
-        # Sorted percentages/abundance by rank (only default)
-        for node, perc in sorted(tree_cum_perc.items(), key=lambda x: x[1], reverse=True):
-            rank = tax.rank(node)
-            if rank in default_ranks:
-                rank_perc[rank].append(perc)
-        # Define threhsold for percentile
-
-        for rank, perc_list in rank_perc.items():
-            top = ceil(cfg.top_percentile * len(perc_list))
-            if top < len(perc_list):
-                rank_cutoff_percentile[rank] = perc_list[top]
+    # always keep root
+    keep = np.ones(len(nodes), dtype=bool)
+    root = idx == ti.root
 
-    for node, cum_count in tree_cum_counts.items():
-        rank = tax.rank(node)
-        # always keep root
-        if node == tax.root_node:
-            filtered_cum_counts[node] = cum_count
-            continue
-
-        # Skip orphan nodes
-        if node in orphan_nodes and cfg.no_orphan:
-            filter_counts_msg["orphan"]["count"]+=1
-            continue
+    def remove(f, mask):
+        mask = mask & keep & ~root
+        filter_counts_msg[f]["count"] = int(np.count_nonzero(mask))
+        keep[mask] = False
 
-        # skip if not in fixed ranks
-        if fixed_ranks and rank not in fixed_ranks:
-            filter_counts_msg["ranks"]["count"]+=1
-            continue
+    # Skip orphan nodes
+    if cfg.no_orphan:
+        remove("orphan", np.isin(idx, ti.get_index(orphan_nodes)))
 
-        # Filter by top percentile (if rank_cutoff_percentile is populated)
-        if rank in rank_cutoff_percentile and tree_cum_perc[node] <= rank_cutoff_percentile[rank]:
-            filter_counts_msg["percentile"]["count"]+=1
-            continue
+    # skip if not in fixed ranks
+    if fixed_ranks:
+        remove("ranks", ti.rank_codes(fixed_ranks)[ranks] < 0)
 
-        # Filter by value
-        if cfg.min_count:
-            if cfg.min_count > 1 and cum_count < cfg.min_count:
-                filter_counts_msg["min_count"]["count"]+=1
-                continue
-            elif cfg.min_count < 1 and tree_cum_perc[node] < cfg.min_count:
-                filter_counts_msg["min_count"]["count"]+=1
-                continue
+    # Detect cut-off for top percentile (by rank, only default) and filter
+    if cfg.top_percentile:
+        rank_cutoff_percentile = np.full(len(ti.ranks), np.nan)
+        perc_ranks = ti.rank[ti.get_index(tree_cum_perc.keys())]
+        perc = np.array(list(tree_cum_perc.values()))
+        for rank in set(default_ranks).intersection(ti.ranks):
+            # Sorted percentages/abundance
+            perc_list = np.sort(perc[perc_ranks == ti.ranks.index(rank)])[::-1]
+            top = ceil(cfg.top_percentile * len(perc_list))
+            if top < len(perc_list):
+                rank_cutoff_percentile[ti.ranks.index(rank)] = perc_list[top]
+        remove("percentile", cum_perc <= rank_cutoff_percentile[ranks])
 
-        if cfg.max_count:
-            if cfg.max_count > 1 and cum_count > cfg.max_count:
-                filter_counts_msg["max_count"]["count"]+=1
-                continue
-            elif cfg.max_count < 1 and tree_cum_perc[node] > cfg.max_count:
-                filter_counts_msg["max_count"]["count"]+=1
-                continue
+    # Filter by value
+    if cfg.min_count:
+        if cfg.min_count > 1:
+            remove("min_count", cum_counts < cfg.min_count)
+        elif cfg.min_count < 1:
+            remove("min_count", cum_perc < cfg.min_count)
 
-        if cfg.taxids and not any(t in cfg.taxids for t in tax.lineage(node)):
-            filter_counts_msg["taxids"]["count"]+=1
-            continue
+    if cfg.max_count:
+        if cfg.max_count > 1:
+            remove("max_count", cum_counts > cfg.max_count)
+        elif cfg.max_count < 1:
+            remove("max_count", cum_perc > cfg.max_count)
 
-        if cfg.names and not tax.name(node) in cfg.names:
-            filter_counts_msg["names"]["count"]+=1
-            continue
+    if cfg.taxids:
+        remove("taxids", ~ti.in_subtrees(cfg.taxids, idx))
 
-        if cfg.names_with and not any(n in tax.name(node) for n in cfg.names_with):
-            filter_counts_msg["names_with"]["count"]+=1
-            continue
+    if cfg.names:
+        remove("names", np.array([ti.tax.name(node) not in cfg.names for node in nodes], dtype=bool))
 
-        filtered_cum_counts[node] = cum_count
+    if cfg.names_with:
+        remove("names_with", np.array([not any(n in ti.tax.name(node) for n in cfg.names_with) for node in nodes], dtype=bool))
 
+    filtered_cum_counts = {node: cum_count for (node, cum_count), k in zip(tree_cum_counts.items(), keep.tolist()) if k}
 
     for f in filter_counts_msg.keys():
         if filter_counts_msg[f]["count"] > 0:
@@ -631,48 +833,40 @@ def filter_report(tree_cum_counts, tree_cum_perc, tax, fixed_ranks, default_rank
     return filtered_cum_counts
 
 
-def sort_report(filtered_cum_counts, tree_cum_perc, sort, fixed_ranks, tax, merged_rep):
+def sort_report(filtered_cum_counts, tree_cum_perc, sort, fixed_ranks, ti, merged_rep):
     # Always keep root at the top
     # Sort report entries, return sorted keys of the dict
+    nodes = list(filtered_cum_counts.keys())
+    idx = ti.get_index(nodes)
+    cum_perc = np.array([tree_cum_perc[node] for node in nodes])
+    if fixed_ranks:
+        # Add undefined node to fixed ranks in case of reporting
+        sort_fixed_ranks = fixed_ranks + [ti.tax.undefined_rank]
+        rank_order = ti.rank_codes(sort_fixed_ranks)[ti.rank[idx]]
+    else:
+        # order of the ranks is not known, sort them alphabetically
+        sorted_ranks = sorted(ti.ranks)
+        rank_order = np.array([sorted_ranks.index(rank) for rank in ti.ranks])[ti.rank[idx]]
+
+    # np.lexsort and stable argsort keep ties in the original order as sorted()
     if not sort:  # not user-defined, use defaults
         if not fixed_ranks:
-            sorted_nodes = sorted(filtered_cum_counts,
-                                  key=lambda k: tax.lineage(k))
+            order = np.argsort(ti.pre[idx], kind="stable")
         else:
-            # Add undefined node to fixed ranks in case of reporting
-            sort_fixed_ranks = fixed_ranks + [tax.undefined_rank]
-            sorted_nodes = sorted(filtered_cum_counts,
-                                  key=lambda k: (sort_fixed_ranks.index(
-                                      tax.rank(k)), -tree_cum_perc[k]),
-                                  reverse=False)
+            order = np.lexsort((-cum_perc, rank_order))
     else:  # user-defined
         if sort == "lineage":
-            sorted_nodes = sorted(filtered_cum_counts,
-                                  key=lambda k: tax.lineage(k))
+            order = np.argsort(ti.pre[idx], kind="stable")
         elif sort == "rank":
-            # if sorting by rank showing all ranks
-            # order of the ranks is not known, sort them alphabetically
-            if not fixed_ranks:
-                sorted_nodes = sorted(filtered_cum_counts,
-                                      key=lambda k: (
-                                          tax.rank(k), -tree_cum_perc[k]),
-                                      reverse=False)
-            else:
-                # Add undefined node to fixed ranks in case of reporting
-                sort_fixed_ranks = fixed_ranks + [tax.undefined_rank]
-                sorted_nodes = sorted(filtered_cum_counts,
-                                      key=lambda k: (sort_fixed_ranks.index(
-                                          tax.rank(k)), -tree_cum_perc[k]),
-                                      reverse=False)
+            order = np.lexsort((-cum_perc, rank_order))
         elif sort == "unique":
-            sorted_nodes = sorted(filtered_cum_counts,
-                                  key=lambda k: (-merged_rep[k]['unique']
-                                                 if k in merged_rep else 0, -tree_cum_perc[k]),
-                                  reverse=False)
+            order = sorted(range(len(nodes)),
+                           key=lambda k: (-merged_rep[nodes[k]]['unique']
+                                          if nodes[k] in merged_rep else 0, -cum_perc[k]),
+                           reverse=False)
         elif sort == "count":
-            sorted_nodes = sorted(filtered_cum_counts,
-                                  key=lambda k: -filtered_cum_counts[k],
-                                  reverse=False)
+            order = np.argsort(-np.array(list(filtered_cum_counts.values())), kind="stable")
+    sorted_nodes = [nodes[i] for i in order]
 
     # Move root to the front to print always first first
     sorted_nodes.insert(0, sorted_nodes.pop(sorted_nodes.index("1")))
@@ -0,0 +1,75 @@
+import os
+import json
+import pickle
+import hashlib
+import tempfile
+
+from ganon.util import print_log
+from ganon.tax_cache import files_hash
+
+
+def report_tax_key(cfg):
+    """
+    Key identifying the taxonomy/genome size files used to build the trees (by content)
+    Returns None if the taxonomy can not be identified (downloaded)
+    """
+    if cfg.db_prefix:
+        return files_hash([prefix if prefix.endswith(".tax") else prefix + ".tax" for prefix in cfg.db_prefix])
+    elif cfg.taxonomy == "skip":
+        return "skip"
+    elif cfg.taxonomy_files:
+        tax_key = [cfg.taxonomy, files_hash(cfg.taxonomy_files)]
+        if cfg.report_type in ["abundance", "corr"]:
+            if cfg.skip_genome_size:
+                tax_key.append("skip_genome_size")
+            elif cfg.genome_size_files:
+                tax_key.append(files_hash(cfg.genome_size_files))
+            else:
+                # Genome sizes downloaded
+                return None
+        return tax_key
+    else:
+        # Taxonomy downloaded
+        return None
+
+
+def report_cache_file(cfg, rep_file, tax_key):
+    """
+    Cache file for the trees built from a .rep file (before filters) or None if the taxonomy can not be identified
+    Keyed by the content of the .rep file, taxonomy/genome size files (tax_key) and options used to build the trees
+    """
+    if tax_key is None:
+        return None
+
+    key = [cfg.version, files_hash([rep_file])[0], tax_key, cfg.report_type, cfg.normalize,
+           cfg.split_hierarchy, sorted(cfg.skip_hierarchy), sorted(cfg.keep_hierarchy)]
+    return os.path.join(cfg.report_cache, hashlib.sha1(json.dumps(key).encode()).hexdigest() + ".pkl")
+
+
+def load_report_cache(cache_file, quiet):
+    """
+    Returns trees stored in the cache file or None if not available, warns if not readable or not compatible
+    (e.g. truncated or written by another version, trees are built again)
+    """
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with open(cache_file, "rb") as file:
+            return pickle.load(file)
+    except Exception as e:
+        print_log(" - WARNING: could not read report cache " + cache_file + " (" + str(e) + ")", quiet)
+        return None
+
+
+def save_report_cache(cache_file, trees, quiet):
+    """
+    Write trees to the cache file, only warns if not possible
+    """
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+        with os.fdopen(fd, "wb") as file:
+            pickle.dump(trees, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print_log(" - WARNING: could not write report cache to " + cache_file + " (" + str(e) + ")", quiet)
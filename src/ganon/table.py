@@ -1,23 +1,115 @@
+import os
+import tempfile
+import numpy as np
+from copy import copy
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+
 from ganon.util import validate_input_files
 from ganon.util import print_log
+from ganon.util import open_file, remove_compression_ext
+from ganon.tax_index import expand_ranges
+from ganon.table_matrix import TableMatrix
+from ganon.table_cache import table_cache_file, table_cache_key, load_table_cache, cached_sample, save_table_cache
+from ganon.report import load_report_tax, get_report_ranks, get_output_file, parse_rep, remove_hierarchy, build_report, write_report, report_lineage
 
 
 def table(cfg):
     #validate input input files
-    tre_files = validate_input_files(cfg.input, cfg.input_extension, cfg.quiet)
+    input_files = validate_input_files(cfg.input, cfg.input_extension, cfg.quiet)
+    rep_files = [f for f in input_files if remove_compression_ext(f).endswith(".rep")]
+
+    if rep_files and len(rep_files) < len(input_files):
+        print_log("ERROR: input files should be either .tre or .rep files", cfg.quiet)
+        return False
+
+    if rep_files and cfg.incremental:
+        print_log("ERROR: --incremental is only available for .tre files", cfg.quiet)
+        return False
+
+    if rep_files and cfg.low_memory:
+        print_log("ERROR: --low-memory is only available for .tre files", cfg.quiet)
+        return False
 
     print_log("Generating table", cfg.quiet)
 
+    if cfg.low_memory:
+        # Files are parsed in batches, keeping only data for each taxon in memory
+        if cfg.split_rank:
+            for rank in cfg.rank:
+                print_log("Table for rank " + rank, cfg.quiet)
+                rank_cfg = copy(cfg)
+                rank_cfg.rank = [rank]
+                write_table_low_memory(input_files, get_rank_output_file(cfg.output_file, rank), rank_cfg)
+        else:
+            write_table_low_memory(input_files, cfg.output_file, cfg)
+        return True
+
     # Reports are parsed with cumulative counts
-    reports, total_taxa = parse_reports(tre_files, cfg.rank)
-    root_node = set()
-    for rep in reports.values():
-        root_node.add(rep["root_node"])
+    if rep_files:
+        reports, total_taxa = build_reports(rep_files, cfg)
+        if not reports:
+            print_log(" - No reports built from .rep files", cfg.quiet)
+            return False
+    else:
+        reports, total_taxa = parse_reports(input_files, cfg)
+
+    if cfg.split_rank:
+        for rank, out_table in make_rank_tables(reports, cfg):
+            if out_table:
+                output_file = get_rank_output_file(cfg.output_file, rank)
+                lines, cols = write_tsv(out_table, output_file, cfg.output_format)
+                print_log(" - " + str(lines) + "x" + str(cols) + " table saved to " + output_file, cfg.quiet)
+    else:
+        out_table = make_table(reports, total_taxa, cfg)
+        if out_table:
+            lines, cols = write_tsv(out_table, cfg.output_file, cfg.output_format)
+            print_log(" - " + str(lines) + "x" + str(cols) + " table saved to " + cfg.output_file, cfg.quiet)
+
+    return True
+
+
+def get_root_node(root_nodes, quiet):
+    """
+    Root node shared by all samples or set of root nodes (not used in filters) if several
+    """
+    root_node = set(root_nodes)
     if len(root_node) > 1:
         print_log("ERROR: input files should share the same root node, but " + str(len(root_node)) +
-                  " root nodes were found: " ",".join(root_node), cfg.quiet)
+                  " root nodes were found: " ",".join(root_node), quiet)
     else:
         root_node = root_node.pop()
+    return root_node
+
+
+def make_rank_tables(reports, cfg):
+    """
+    Yields (rank, table) for each --rank, filtered and built independently (see make_table()) from the same parsed reports
+    """
+    ranks = np.array(reports.ranks, dtype=object)[reports.variant]
+    for rank in cfg.rank:
+        print_log("Table for rank " + rank, cfg.quiet)
+        rank_cfg = copy(cfg)
+        rank_cfg.rank = [rank]
+        rank_reports = reports.select(ranks == rank)
+        yield rank, make_table(rank_reports, rank_reports.n_taxa(), rank_cfg)
+
+
+def get_rank_output_file(output_file, rank):
+    """
+    Output file for a rank with --split-rank (e.g. table.tsv.gz -> table.species.tsv.gz)
+    """
+    file = remove_compression_ext(output_file)
+    base, ext = os.path.splitext(file)
+    return base + "." + rank + ext + output_file[len(file):]
+
+
+def make_table(reports, total_taxa, cfg):
+    """
+    Filter reports (TableMatrix from parse_reports() or build_reports()) and build the table (see build_table())
+    Returns None if no taxa are left
+    """
+    root_node = get_root_node(reports.root_nodes, cfg.quiet)
 
     print_log(" - " + str(len(reports)) + " files parsed", cfg.quiet)
     print_log(" - " + str(total_taxa) + " taxa parsed", cfg.quiet)
@@ -49,7 +141,7 @@ def table(cfg):
                   " taxa (--min-frequency " + str(cfg.min_frequency) + ")", cfg.quiet)
         filtered_total_taxa = min_frequency_total_taxa
 
-    if not cfg.rank:
+    if len(cfg.rank) != 1:
         # remove cumulative values from multiple ranks
         # step should be at the end after filters were applied on the cumulative counts
         # if requested, counts directed to root are remove to unclassified
@@ -57,66 +149,386 @@ def table(cfg):
 
     # remove root from lineages
     if cfg.no_root:
-        for file, rep in reports.items():
-            for t in rep["count"]:
-                del rep["lineage"][t][0]
+        for v in reports.present_variants().tolist():
+            reports.lineages[v] = reports.lineages[v][1:]
 
     if not filtered_total_taxa:
         print_log(" - No taxa left to report", cfg.quiet)
-    else:
-        # build table in a list of lists
-        out_table = build_table(reports, cfg)
+        return None
+
+    # build sparse table with files as rows
+    out_table = build_table(reports, cfg)
+
+    # "--skip-zeros" trim table on lines and cols
+    if cfg.skip_zeros:
+        l = len(out_table["rows"])
+        # trim rows and cols
+        out_table = trim_table(out_table)
+        if len(out_table["rows"]) < l:
+            print_log(" - Skipped " + str(l-len(out_table["rows"])) + " files with only zero counts", cfg.quiet)
+        c = len(out_table["cols"])
+        out_table = transpose(trim_table(transpose(out_table)))
+        if len(out_table["cols"]) < c:
+            print_log(" - Skipped " + str(c-len(out_table["cols"])) + " taxa with only zero counts", cfg.quiet)
+
+    # "--transpose" table (by default is already transposed)
+    if not cfg.transpose:
+        out_table = transpose(out_table)
 
-        # "--skip-zeros" trim table on lines and cols
-        if cfg.skip_zeros:
-            l = len(out_table)
-            # trim rows and cols
-            out_table = trim_table(out_table)
-            if len(out_table) < l:
-                print_log(" - Skipped " + str(l-len(out_table)) + " files with only zero counts", cfg.quiet)
-            c = len(out_table[0])
-            out_table = transpose(trim_table(transpose(out_table)))
-            if len(out_table[0]) < c:
-                print_log(" - Skipped " + str(c-len(out_table[0])) + " taxa with only zero counts", cfg.quiet)
-
-        # "--transpose" table (by default is already transposed)
-        if not cfg.transpose:
-            out_table = transpose(out_table)
-
-        lines, cols = write_tsv(out_table, cfg.output_file, cfg.output_format)
-        print_log(" - " + str(lines) + "x" + str(cols) + " table saved to " + cfg.output_file, cfg.quiet)
+    return out_table
 
-    return True
 
+def write_table_low_memory(tre_files, output_file, cfg):
+    """
+    Same as make_table() and write_tsv() for .tre files parsed in batches of --batch-size files
+    First pass: taxa left after the filters of each sample and their sum of percentages/frequency for --top-all and
+    --min-frequency. Second pass: entries of the selected taxa with counts adjusted (files sorted by label),
+    stored in temporary files and written at the end in the output orientation
+    """
+    tre_files = list(tre_files)
+    root_node = get_root_node(map_files(parse_tre_root, tre_files, cfg.threads), cfg.quiet)
 
-def parse_reports(tre_files, rank):
-    reports = {}
+    # First pass, in input order. Taxa left after filters are indexed in order of first occurrence
     total_taxa = set()
-    for tre_file in tre_files:
-        reports[tre_file] = {}
-        count, lineage, name, total, unclassified, root_node = parse_tre_rank(tre_file, rank)
-        total_taxa.update(count.keys())
-        reports[tre_file]["label"] = tre_file
-        reports[tre_file]["count"] = count
-        reports[tre_file]["lineage"] = lineage
-        reports[tre_file]["name"] = name
-        reports[tre_file]["total"] = total
-        reports[tre_file]["unclassified"] = unclassified
-        reports[tre_file]["filtered"] = 0
-        reports[tre_file]["root_node"] = root_node
-    return reports, len(total_taxa)
-
-
-def parse_tre_rank(tre_file, selected_rank):
+    filtered_taxa = set()
+    top_sample_taxa = set()
+    index = {}
+    sum_percentage = np.zeros(0)
+    frequency = np.zeros(0, dtype=np.int64)
+    for b in range(0, len(tre_files), cfg.batch_size):
+        reports, _ = parse_reports(tre_files[b:b+cfg.batch_size], cfg)
+        total_taxa.update(reports.taxa)
+        filter_reports(reports, cfg, root_node)
+        for t in reports.present_taxa().tolist():
+            filtered_taxa.add(reports.taxa[t])
+            index.setdefault(reports.taxa[t], len(index))
+        taxon = np.array([index.get(taxid, -1) for taxid in reports.taxa], dtype=np.int64)[reports.taxon]
+        sum_percentage = np.concatenate([sum_percentage, np.zeros(len(index) - len(sum_percentage))])
+        frequency = np.concatenate([frequency, np.zeros(len(index) - len(frequency), dtype=np.int64)])
+        # summed in the same order as get_total_counts()
+        np.add.at(sum_percentage, taxon, reports.count/reports.total[reports.sample])
+        if cfg.top_sample:
+            select_top_sample(reports, cfg.top_sample, root_node)
+            root = root_index(reports, root_node)
+            top_sample_taxa.update(reports.taxa[t] for t in np.unique(reports.taxon[reports.taxon != root]).tolist())
+            taxon = np.array([index.get(taxid, -1) for taxid in reports.taxa], dtype=np.int64)[reports.taxon]
+        np.add.at(frequency, taxon, 1)
+
+    print_log(" - " + str(len(tre_files)) + " files parsed", cfg.quiet)
+    print_log(" - " + str(len(total_taxa)) + " taxa parsed", cfg.quiet)
+
+    filtered_total_taxa = len(filtered_taxa)
+    if len(total_taxa) - filtered_total_taxa:
+        print_log(" - Skipped " + str(len(total_taxa) - filtered_total_taxa) + " taxa with filters", cfg.quiet)
+
+    # Selected taxa, same steps as in make_table()
+    selected = np.ones(len(index), dtype=bool)
+    if cfg.top_sample:
+        top_sample_total_taxa = len(set(root_node) | top_sample_taxa)
+        print_log(" - Skipped " + str(filtered_total_taxa - top_sample_total_taxa) +
+                  " taxa (--top-sample " + str(cfg.top_sample)+")", cfg.quiet)
+        filtered_total_taxa = top_sample_total_taxa
+        selected = frequency > 0
+    elif cfg.top_all:
+        root = index.get(root_node, -1) if isinstance(root_node, str) else -1
+        selected = get_top_taxa(np.arange(len(index)), sum_percentage, cfg.top_all, root, root_node, index)
+        top_all_total_taxa = int(selected.sum())
+        print_log(" - Skipped " + str(filtered_total_taxa - top_all_total_taxa) +
+                  " taxa (--top-all " + str(cfg.top_all)+")", cfg.quiet)
+        filtered_total_taxa = top_all_total_taxa
+
+    if cfg.min_frequency:
+        if cfg.min_frequency < 1:
+            mf = int(len(tre_files)*cfg.min_frequency)
+        else:
+            mf = cfg.min_frequency
+        selected &= frequency >= mf
+        min_frequency_total_taxa = int(selected.sum())
+        print_log(" - Skipped " + str(filtered_total_taxa - min_frequency_total_taxa) +
+                  " taxa (--min-frequency " + str(cfg.min_frequency) + ")", cfg.quiet)
+        filtered_total_taxa = min_frequency_total_taxa
+
+    if not filtered_total_taxa:
+        print_log(" - No taxa left to report", cfg.quiet)
+        return None
+
+    # Selected taxa sorted by taxid as cols (before --skip-zeros), followed by unclassified/filtered cols
+    taxa = list(index)
+    sorted_taxa = sorted(np.flatnonzero(selected).tolist(), key=lambda t: taxa[t])
+    col = np.full(len(index), -1, dtype=np.int64)
+    col[sorted_taxa] = np.arange(len(sorted_taxa))
+    extra_labels = get_extra_labels(cfg)
+    n_cols = len(sorted_taxa) + len(extra_labels)
+
+    # Files sorted by label as rows, headers from the last file with the taxon in input order
+    labels = sorted(tre_files)
+    position = {label: p for p, label in enumerate(tre_files)}
+    header = [None] * len(sorted_taxa)
+    header_position = np.full(len(sorted_taxa), -1, dtype=np.int64)
+    present_cols = np.zeros(n_cols, dtype=bool)
+    present_cols[len(sorted_taxa):] = True
+    nonzero_rows = np.zeros(len(labels), dtype=bool)
+    nonzero_cols = np.zeros(n_cols, dtype=bool)
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_file))) as tmp_dir:
+        # Second pass, entries of each batch sorted in the output orientation
+        batches = []
+        for b in range(0, len(labels), cfg.batch_size):
+            reports, _ = parse_reports(labels[b:b+cfg.batch_size], cfg)
+            filter_reports(reports, cfg, root_node)
+            if cfg.top_sample:
+                select_top_sample(reports, cfg.top_sample, root_node)
+            taxa_col = np.array([col[index[taxid]] if taxid in index else -1 for taxid in reports.taxa], dtype=np.int64)
+            reports.remove(taxa_col[reports.taxon] < 0)
+            if len(cfg.rank) != 1:
+                adjust_counts_ranks(reports, cfg.no_root, root_node)
+            if cfg.no_root:
+                for v in reports.present_variants().tolist():
+                    reports.lineages[v] = reports.lineages[v][1:]
+
+            # Keep header of the last entry of each taxon in input order
+            entry_position = np.array([position[label] for label in reports.labels], dtype=np.int64)[reports.sample]
+            order = np.lexsort((entry_position, reports.taxon))
+            last = order[np.append(reports.taxon[order][1:] != reports.taxon[order][:-1], True)] if len(order) else order
+            update = last[entry_position[last] > header_position[taxa_col[reports.taxon[last]]]]
+            update_cols = taxa_col[reports.taxon[update]]
+            header_position[update_cols] = entry_position[update]
+            for c, h in zip(update_cols.tolist(), get_header(reports, reports.taxon[update].tolist(),
+                                                             reports.variant[update].tolist(), cfg.header)):
+                header[c] = h
+
+            row = np.arange(b, b + len(reports), dtype=np.int64)
+            entry_row, entry_col, value = get_entries(reports, row, taxa_col, len(sorted_taxa), cfg)
+            present_cols[entry_col] = True
+            nonzero_rows[entry_row[value > 0]] = True
+            nonzero_cols[entry_col[value > 0]] = True
+            order = np.lexsort((entry_col, entry_row)) if cfg.transpose else np.lexsort((entry_row, entry_col))
+            batch_prefix = os.path.join(tmp_dir, str(len(batches)))
+            entry_row[order].tofile(batch_prefix + ".row")
+            entry_col[order].tofile(batch_prefix + ".col")
+            value[order].tofile(batch_prefix + ".value")
+            batches.append((batch_prefix, len(order), b, b + len(reports), value.dtype))
+
+        # "--skip-zeros" trim rows and cols
+        keep_rows = nonzero_rows if cfg.skip_zeros else np.ones(len(labels), dtype=bool)
+        keep_cols = present_cols & nonzero_cols if cfg.skip_zeros else present_cols
+        if cfg.skip_zeros:
+            if keep_rows.sum() < len(labels):
+                print_log(" - Skipped " + str(len(labels) - keep_rows.sum()) + " files with only zero counts", cfg.quiet)
+            if keep_cols.sum() < present_cols.sum():
+                print_log(" - Skipped " + str(present_cols.sum() - keep_cols.sum()) + " taxa with only zero counts", cfg.quiet)
+        row_pos = np.cumsum(keep_rows) - 1
+        col_pos = np.cumsum(keep_cols) - 1
+        header += extra_labels
+        rows = [label for label, k in zip(labels, keep_rows.tolist()) if k]
+        cols = [h for h, k in zip(header, keep_cols.tolist()) if k]
+
+        sep = "\t" if cfg.output_format == "tsv" else ","
+        out_file = open_file(output_file, "wt")
+        if cfg.transpose:
+            # files as rows, written for each batch
+            print("", *cols, sep=sep, file=out_file)
+            for batch_prefix, n_entries, start, end, dtype in batches:
+                entry_row, entry_col, value = load_entries(batch_prefix, n_entries, dtype)
+                keep = keep_rows[entry_row] & keep_cols[entry_col]
+                first = row_pos[start] + (0 if keep_rows[start] else 1)
+                write_lines({"rows": [label for label, k in zip(labels[start:end], keep_rows[start:end].tolist()) if k],
+                             "cols": cols,
+                             "row": row_pos[entry_row[keep]] - first,
+                             "col": col_pos[entry_col[keep]],
+                             "value": value[keep]}, out_file, sep)
+        else:
+            # taxa as rows, written in blocks of cols with entries of all batches
+            print("", *rows, sep=sep, file=out_file)
+            max_entries = max([n_entries for _, n_entries, _, _, _ in batches] + [1])
+            block_size = max(1, max_entries // max(1, len(labels)))
+            entries = [load_entries(*batch[:2], batch[4]) for batch in batches]
+            for start in range(0, n_cols, block_size):
+                end = min(start + block_size, n_cols)
+                block = [(entry_row[s:e], entry_col[s:e], value[s:e]) for entry_row, entry_col, value in entries
+                         for s, e in [np.searchsorted(entry_col, [start, end]).tolist()]]
+                entry_row, entry_col, value = [np.concatenate(e) for e in zip(*block)] if block else [np.zeros(0, dtype=np.int64)] * 3
+                keep = keep_rows[entry_row] & keep_cols[entry_col]
+                first = col_pos[start] + (0 if keep_cols[start] else 1)
+                write_lines({"rows": [h for h, k in zip(header[start:end], keep_cols[start:end].tolist()) if k],
+                             "cols": rows,
+                             "row": col_pos[entry_col[keep]] - first,
+                             "col": row_pos[entry_row[keep]],
+                             "value": value[keep]}, out_file, sep)
+        out_file.close()
+
+    print_log(" - " + str(len(rows) if cfg.transpose else len(cols)) + "x" + str(len(cols) if cfg.transpose else len(rows)) +
+              " table saved to " + output_file, cfg.quiet)
+
+
+def load_entries(batch_prefix, n_entries, dtype):
+    """
+    Entries (row, col, value) of a batch stored by write_table_low_memory(), memory mapped
+    """
+    if not n_entries:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=dtype)
+    return (np.memmap(batch_prefix + ".row", dtype=np.int64, mode="r"),
+            np.memmap(batch_prefix + ".col", dtype=np.int64, mode="r"),
+            np.memmap(batch_prefix + ".value", dtype=dtype, mode="r"))
+
+
+def parse_reports(tre_files, cfg):
+    """
+    Parse .tre files (only entries of --rank, if any) into a TableMatrix, in parallel with --threads
+    Samples are added in the input order, independent of the number of threads
+    With --incremental, only files not in the cache (new or changed) are parsed and the cache is updated
+    """
+    cache = None
+    if cfg.incremental:
+        cache_file = table_cache_file(cfg.output_file)
+        cache_key = table_cache_key(cfg)
+        cache = load_table_cache(cache_file, cache_key)
+
+    cached = [cached_sample(cache, tre_file) for tre_file in tre_files]
+    parse_files = [tre_file for tre_file, sample in zip(tre_files, cached) if sample is None]
+    if cfg.incremental:
+        print_log(" - " + str(len(tre_files) - len(parse_files)) + " files loaded from " + cache_file +
+                  ", " + str(len(parse_files)) + " new or changed files", cfg.quiet)
+
+    reports = TableMatrix()
+    # Cached entries refer to the keys stored in the cache
+    cache_variants = reports.variant_ids(cache["keys"]) if len(parse_files) < len(tre_files) else None
+    parsed = map_files(parse_tre_rank, parse_files, cfg.threads, cfg.rank)
+    for tre_file, sample in zip(tre_files, cached):
+        if sample is None:
+            reports.add(tre_file, *next(parsed))
+        else:
+            reports.add_variants(tre_file, cache_variants[sample["variant"]], sample["count"],
+                                 sample["total"], sample["unclassified"], sample["root_node"])
+
+    # Re-write cache only if samples changed
+    if cfg.incremental and (cache is None or parse_files or len(cache["samples"]) != len(tre_files)):
+        save_table_cache(cache_file, cache_key, tre_files, reports, cfg.quiet)
+
+    reports.build()
+    return reports, len(reports.taxa)
+
+
+def map_files(func, files, threads, *args):
+    """
+    Yields func(file, *args) for each file in order, evaluated in sub-processes with threads > 1
+    """
+    if threads > 1 and len(files) > 1:
+        workers = min(threads, len(files))
+        # chunks of files per task reduce inter-process communication with many small files
+        chunksize = max(1, len(files) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(func, files, *[repeat(a) for a in args], chunksize=chunksize)
+    else:
+        for file in files:
+            yield func(file, *args)
+
+
+def build_reports(rep_files, cfg):
+    """
+    Build reports from .rep files in memory with the same values as parse_reports() for the .tre files
+    Taxonomy is loaded once and files are parsed in parallel with --threads
+    """
+    tax, genome_sizes = load_report_tax(cfg)
+    if tax is None:
+        return TableMatrix().build(), 0
+    parsed = ((rep_file, *p) for rep_file, p in zip(rep_files, map_files(parse_rep, rep_files, cfg.threads, cfg.normalize)))
+    return rank_reports(parsed, len(rep_files), tax, genome_sizes, cfg)
+
+
+def rank_reports(parsed, n_reports, tax, genome_sizes, cfg):
+    """
+    Build reports from parsed .rep entries [(label, reports, counts), ...] with the same values as parse_reports()
+    .tre files are written only with --output-prefix
+    """
+    default_ranks, fixed_ranks = get_report_ranks(cfg, tax)
+    report_cfg = get_table_report_cfg(cfg)
+
+    reports = TableMatrix()
+    for label, parsed_reps, counts in parsed:
+        if not parsed_reps:
+            print_log(" - nothing to report for " + label, cfg.quiet)
+            continue
+
+        if cfg.skip_hierarchy or cfg.keep_hierarchy:
+            parsed_reps = remove_hierarchy(parsed_reps, counts, cfg.skip_hierarchy, cfg.keep_hierarchy, cfg.quiet)
+
+        rep = build_report(parsed_reps, counts, tax, genome_sizes, fixed_ranks, default_ranks, report_cfg)
+        if not rep:
+            print_log(" - nothing to report for " + label, cfg.quiet)
+            continue
+
+        if cfg.output_prefix:
+            output_file = get_output_file(cfg.output_prefix, label, n_reports) + ".tre"
+            write_report(rep, output_file, "tsv", report_cfg, label)
+            print_log(" - report saved to " + output_file, cfg.quiet)
+
+        reports.add(label, *report_rank(rep, cfg.rank, cfg.report_type))
+    return reports.build(), len(reports.taxa)
+
+
+def get_table_report_cfg(cfg):
+    """
+    Filters are applied on the table, reports are built (and written) with defaults
+    """
+    report_cfg = copy(cfg)
+    report_cfg.min_count = 0
+    report_cfg.max_count = 0
+    report_cfg.taxids = []
+    report_cfg.names = []
+    report_cfg.names_with = []
+    report_cfg.sort = ""
+    return report_cfg
+
+
+def report_rank(rep, selected_ranks, report_type):
+    """
+    Same as parse_tre_rank() for a report from build_report()
+    """
+    tax = rep["tax"]
+    count = {}
+    lineage = {}
+    name = {}
+    ranks = {}
+    # unclassified entry is written only when reporting reads
+    unclassified = rep["unclassified"] if report_type != "matches" else 0
+    classified = 0
+    root_node = "1"
+
+    for taxid in rep["sorted_nodes"]:
+        rank = tax.rank(taxid)
+        if rank == tax.root_rank:
+            classified = int(rep["cum_counts"][taxid])
+            root_node = taxid
+            if selected_ranks:
+                continue  # do not include root to the report when using specific ranks
+        elif selected_ranks and rank not in selected_ranks:
+            continue
+
+        lineage[taxid] = "|".join(report_lineage(rep, taxid))
+        name[taxid] = tax.name(taxid)
+        ranks[taxid] = rank
+        count[taxid] = int(rep["cum_counts"][taxid])
+
+    total = unclassified + classified
+    return count, lineage, name, ranks, total, unclassified, root_node
+
+
+def parse_tre_rank(tre_file, selected_ranks):
+    """
+    Parse cumulative counts of a .tre file (only selected_ranks, if defined)
+    Lineages are kept as in the file ("|" separated) and split only once for each distinct value in TableMatrix
+    """
     count = {}
     lineage = {}
     name = {}
+    ranks = {}
     unclassified = 0
     classified = 0
     total = 0
     root_node = "1"
 
-    with open(tre_file, "r") as file:
+    with open_file(tre_file) as file:
         for line in file:
             rank, taxid, lin, taxa_name, unique_assign, shared_assign, children_assign, cum_assign, cum_perc = line.rstrip().split("\t")
             if rank == "unclassified":
@@ -125,130 +537,125 @@ def parse_tre_rank(tre_file, selected_rank):
             elif rank == "root":
                 classified = int(cum_assign)
                 root_node = taxid
-                if selected_rank:
-                    continue  # do not include root to the report when using single rank
-            elif selected_rank and rank != selected_rank:
+                if selected_ranks:
+                    continue  # do not include root to the report when using specific ranks
+            elif selected_ranks and rank not in selected_ranks:
                 continue
 
-            lineage[taxid] = lin.split("|")
+            lineage[taxid] = lin
             name[taxid] = taxa_name
+            ranks[taxid] = rank
             count[taxid] = int(cum_assign)
 
     total = unclassified + classified
-    return count, lineage, name, total, unclassified, root_node
+    return count, lineage, name, ranks, total, unclassified, root_node
+
+
+def parse_tre_root(tre_file):
+    """
+    Root node of a .tre file as in parse_tre_rank(), reading only until the root entry
+    """
+    with open_file(tre_file) as file:
+        for line in file:
+            rank, taxid = line.split("\t", 2)[:2]
+            if rank == "root":
+                return taxid
+    return "1"
+
+
+def root_index(reports, root_node):
+    """
+    Index of the root node in the matrix, -1 if not found or several root nodes
+    """
+    return reports.index.get(root_node, -1) if isinstance(root_node, str) else -1
 
 
 def filter_reports(reports, cfg, root_node):
-    filtered_total_taxa = set()
-    for file, rep in reports.items():
-        for taxid in list(rep["count"]):
-            count = rep["count"][taxid]
-            filtered = False
-            if cfg.min_count:
-                if cfg.min_count > 1 and count < cfg.min_count:
-                    filtered = True
-                elif cfg.min_count < 1 and (count/rep["total"]) < cfg.min_count:
-                    filtered = True
-
-            if cfg.max_count:
-                if cfg.max_count > 1 and count > cfg.max_count:
-                    filtered = True
-                elif cfg.max_count < 1 and (count/rep["total"]) > cfg.max_count:
-                    filtered = True
-
-            if cfg.taxids and not any(t in cfg.taxids for t in rep["lineage"][taxid]):
-                filtered = True
-            elif cfg.names and not rep["name"][taxid] in cfg.names:
-                filtered = True
-            elif cfg.names_with and not any(n in rep["name"][taxid] for n in cfg.names_with):
-                filtered = True
-
-            # do not filter root node
-            if filtered and taxid != root_node:
-                rep["filtered"] += count
-                del rep["count"][taxid]
-                del rep["lineage"][taxid]
-                del rep["name"][taxid]
-            else:
-                filtered_total_taxa.add(taxid)
-
-    return len(filtered_total_taxa)
+    count = reports.count
+    total = reports.total[reports.sample]
+    filtered = np.zeros(len(count), dtype=bool)
+    if cfg.min_count:
+        if cfg.min_count > 1:
+            filtered |= count < cfg.min_count
+        elif cfg.min_count < 1:
+            filtered |= (count/total) < cfg.min_count
+
+    if cfg.max_count:
+        if cfg.max_count > 1:
+            filtered |= count > cfg.max_count
+        elif cfg.max_count < 1:
+            filtered |= (count/total) > cfg.max_count
+
+    if cfg.taxids or cfg.names or cfg.names_with:
+        # Filters on names and lineages are checked once for each variant
+        taxids = set(cfg.taxids)
+        filtered_variants = np.zeros(len(reports.names), dtype=bool)
+        for v in reports.present_variants().tolist():
+            name = reports.names[v]
+            if taxids and not any(n in taxids for n in reports.lineages[v]):
+                filtered_variants[v] = True
+            elif cfg.names and not name in cfg.names:
+                filtered_variants[v] = True
+            elif cfg.names_with and not any(n in name for n in cfg.names_with):
+                filtered_variants[v] = True
+        filtered |= filtered_variants[reports.variant]
+
+    # do not filter root node
+    filtered &= reports.taxon != root_index(reports, root_node)
+    reports.remove(filtered)
+    return reports.n_taxa()
 
 
 def select_top_sample(reports, top_sample, root_node):
-    top_sample_total_taxa = set(root_node)  # always keep root
-    for file, rep in reports.items():
-        i = 0
-        for taxid, count in sorted(rep["count"].items(), key=lambda x: x[1], reverse=True):  # sorted by count
-            if taxid == root_node:  # do not count root as an top entry
-                continue
-            if i < top_sample:
-                top_sample_total_taxa.add(taxid)
-                i += 1
-                continue
-            rep["filtered"] += count
-            del rep["count"][taxid]
-            del rep["lineage"][taxid]
-            del rep["name"][taxid]
+    root = root_index(reports, root_node)
+    # entries of each sample sorted by count, ties kept in the order of the report
+    entries = np.lexsort((np.arange(len(reports.count)), -reports.count, reports.sample))
+    entries = entries[reports.taxon[entries] != root]  # do not count root as an top entry
+    sample = reports.sample[entries]
+    top = np.arange(len(entries)) - np.searchsorted(sample, sample)
+    remove = np.zeros(len(reports.count), dtype=bool)
+    remove[entries[top >= top_sample]] = True
+    reports.remove(remove)
 
+    top_sample_total_taxa = set(root_node)  # always keep root
+    top_sample_total_taxa.update(reports.taxa[t] for t in np.unique(reports.taxon[reports.taxon != root]).tolist())
     return len(top_sample_total_taxa)
 
 
 def select_top_all(reports, top_all, root_node):
-    total_taxa = set()
-    total_counts = get_total_counts(reports)
-    top_taxids = set(root_node)  # always keep root
-    i = 0
-    for taxid in sorted(total_counts, key=lambda kv: total_counts[kv]["sum_percentage"], reverse=True):
-        if taxid == root_node:  # do not count root as an top entry
-            continue
-        elif i < top_all:
-            top_taxids.add(taxid)
-            i += 1
-
-    for file, rep in reports.items():
-        for taxid in list(rep["count"]):
-            if taxid in top_taxids:
-                total_taxa.add(taxid)
-                continue
-            rep["filtered"] += rep["count"][taxid]
-            del rep["count"][taxid]
-            del rep["lineage"][taxid]
-            del rep["name"][taxid]
-
-    return len(total_taxa)
+    sum_percentage, _ = get_total_counts(reports)
+    top_taxa = get_top_taxa(reports.present_taxa(), sum_percentage, top_all,
+                            root_index(reports, root_node), root_node, reports.index)
+    reports.remove(~top_taxa[reports.taxon])
+    return reports.n_taxa()
+
+
+def get_top_taxa(taxa, sum_percentage, top_all, root, root_node, index):
+    """
+    Returns a mask with top_all taxa (in order of first occurrence) by sum of percentages and root
+    """
+    # taxa sorted by sum of percentages, ties kept in order of first occurrence
+    taxa = taxa[np.argsort(-sum_percentage[taxa], kind="stable")]
+    top_taxa = np.zeros(len(sum_percentage), dtype=bool)
+    top_taxa[taxa[taxa != root][:top_all]] = True  # do not count root as an top entry
+    for node in set(root_node):  # always keep root
+        if node in index:
+            top_taxa[index[node]] = True
+    return top_taxa
 
 
 def select_frequency(reports, min_frequency):
-    min_occ_taxids = []
-    for taxid, val in get_total_counts(reports).items():
-        if val["frequency"] >= min_frequency:
-            min_occ_taxids.append(taxid)
-
-    min_frequency_total_taxa = set()
-    for file, rep in reports.items():
-        for taxid in list(rep["count"]):
-            if taxid in min_occ_taxids:
-                min_frequency_total_taxa.add(taxid)
-                continue
-            rep["filtered"] += rep["count"][taxid]
-            del rep["count"][taxid]
-            del rep["lineage"][taxid]
-            del rep["name"][taxid]
-
-    return len(min_frequency_total_taxa)
+    _, frequency = get_total_counts(reports)
+    reports.remove(frequency[reports.taxon] < min_frequency)
+    return reports.n_taxa()
 
 
 def get_total_counts(reports):
-    # return sum of % of all samples
-    total_counts = {}
-    for d in reports.values():
-        for taxid, count in d["count"].items():
-            if taxid not in total_counts:
-                total_counts[taxid] = {"sum_percentage": 0, "frequency": 0}
-            total_counts[taxid]["sum_percentage"] += count/d["total"]
-            total_counts[taxid]["frequency"] += 1
-    return total_counts
+    # return sum of % of all samples and frequency for each taxon
+    sum_percentage = np.bincount(reports.taxon, weights=reports.count/reports.total[reports.sample],
+                                 minlength=len(reports.taxa))
+    frequency = np.bincount(reports.taxon, minlength=len(reports.taxa))
+    return sum_percentage, frequency
 
 
 def adjust_counts_ranks(reports, no_root, root_node):
@@ -259,100 +666,141 @@ def adjust_counts_ranks(reports, no_root, root_node):
     # be in the report (e.g. assignment to a rank not listed)
     # Going from leaf to root, all reported counts removed from parent ranks counts,
     # and left over are unique matches for the target + unaccounted
-    for file, rep in reports.items():
-        # Start from higher ranks
-        for t in sorted(rep["lineage"], key=lambda k: len(rep["lineage"][k]), reverse=True):
-            # Remove already reported count from all parents in its lineage
-            for parent in rep["lineage"][t][:-1]:
-                if parent in rep["count"]:
-                    rep["count"][parent] -= rep["count"][t]
-
-        # Move left over counts at root to unclassified
-        if no_root:
-            rep["unclassified"] += rep["count"][root_node]
-            del rep["count"][root_node]
-            del rep["lineage"][root_node]
-            del rep["name"][root_node]
+    ptr, ancestors = reports.ancestors()
+    lineage_len = np.array([len(lineage) for lineage in reports.lineages], dtype=np.int64)[reports.variant]
+    # Start from higher ranks, entries with the same lineage length are independent
+    for length in np.unique(lineage_len)[::-1].tolist():
+        entries = np.flatnonzero(lineage_len == length)
+        starts = ptr[reports.variant[entries]]
+        ends = ptr[reports.variant[entries]+1]
+        # Remove already reported count from all parents in its lineage
+        child = np.repeat(entries, ends - starts)
+        parent = reports.lookup(reports.sample[child], ancestors[expand_ranges(starts, ends)])
+        np.subtract.at(reports.count, parent[parent >= 0], reports.count[child[parent >= 0]])
+
+    # Move left over counts at root to unclassified
+    if no_root:
+        at_root = reports.taxon == root_index(reports, root_node)
+        np.add.at(reports.unclassified, reports.sample[at_root], reports.count[at_root])
+        reports.remove(at_root, filtered=False)
 
 
 def build_table(reports, cfg):
-    total_counts = get_total_counts(reports)
-
+    """
+    Build table as a sparse matrix with files as rows (sorted by label) and taxa as cols (sorted by taxid)
+    followed by unclassified/filtered cols. Returns dict with labels (rows, cols) and entries (row, col, value)
+    """
     # Sort by taxid
-    sorted_taxids = sorted(total_counts.keys())
-
-    # Generate headers
-    if cfg.header == "taxid":
-        header = [""] + list(sorted_taxids)
-    elif cfg.header == "name":
-        # Merge all possible names
-        names = {}
-        for file in reports:
-            names.update(reports[file]["name"])
-        header = [""] + [names[taxid] for taxid in sorted_taxids]
-    elif cfg.header == "lineage":
-        # Merge all possible lineages
-        lineages = {}
-        for file in reports:
-            lineages.update(reports[file]["lineage"])
-        header = [""] + ["|".join(lineages[taxid]) for taxid in sorted_taxids]
-    if cfg.unclassified_label:
-        header.append(cfg.unclassified_label)
-    if cfg.filtered_label and cfg.filtered_label != cfg.unclassified_label:
-        header.append(cfg.filtered_label)
-
-    # generate output as a list of lists with each file in one line
-    out_table = []
-    out_table.append(header)
-    for file in sorted(reports):
-        res = reports[file]
-        out_line = [res["label"]]
-        for taxid in sorted_taxids:
-            if taxid in res["count"]:
-                v = res["count"][taxid]
-                if cfg.output_value == "percentage":
-                    v = v/res["total"]
-            else:
-                v = 0
-            out_line.append(v)
-
-        # Add unclassified/filtered at the end in the according labels
-        if cfg.unclassified_label:
-            unc = res["unclassified"]/res["total"] if cfg.output_value == "percentage" else res["unclassified"]
-            if cfg.unclassified_label != cfg.filtered_label:
-                out_line.append(unc)
-        if cfg.filtered_label:
-            fil = res["filtered"]/res["total"] if cfg.output_value == "percentage" else res["filtered"]
-            if cfg.filtered_label == cfg.unclassified_label:
-                out_line.append(unc+fil)
-            else:
-                out_line.append(fil)
-
-        out_table.append(out_line)
-    return out_table
+    sorted_taxa = sorted(reports.present_taxa().tolist(), key=lambda t: reports.taxa[t])
+    col = np.full(len(reports.taxa), -1, dtype=np.int64)
+    col[sorted_taxa] = np.arange(len(sorted_taxa))
+
+    # Generate headers, names and lineages from the last file with the taxon
+    header = get_header(reports, sorted_taxa, reports.last_variants(sorted_taxa).tolist(), cfg.header)
+
+    # Files sorted by label
+    sorted_samples = sorted(range(len(reports)), key=lambda s: reports.labels[s])
+    row = np.empty(len(sorted_samples), dtype=np.int64)
+    row[sorted_samples] = np.arange(len(sorted_samples))
+
+    entry_row, entry_col, value = get_entries(reports, row, col, len(sorted_taxa), cfg)
+    return {"rows": [reports.labels[s] for s in sorted_samples],
+            "cols": header + get_extra_labels(cfg),
+            "row": entry_row,
+            "col": entry_col,
+            "value": value}
+
+
+def get_header(reports, taxa, variants, header):
+    """
+    Header of taxa with names and lineages of the given variants
+    """
+    if header == "taxid":
+        return [reports.taxa[t] for t in taxa]
+    elif header == "name":
+        return [reports.names[v] for v in variants]
+    elif header == "lineage":
+        return ["|".join(reports.lineages[v]) for v in variants]
+
+
+def get_extra_labels(cfg):
+    """
+    Labels of the unclassified/filtered cols added after the taxa
+    """
+    extra_labels = []
+    if cfg.unclassified_label and cfg.unclassified_label != cfg.filtered_label:
+        extra_labels.append(cfg.unclassified_label)
+    if cfg.filtered_label:
+        extra_labels.append(cfg.filtered_label)
+    return extra_labels
+
+
+def get_entries(reports, row, col, n_taxa, cfg):
+    """
+    Table entries (row, col, value) with row of each sample and col of each taxon
+    followed by unclassified/filtered values of each sample in the cols after n_taxa
+    """
+    if cfg.output_value == "percentage":
+        value = reports.count/reports.total[reports.sample]
+        unc = reports.unclassified/reports.total
+        fil = reports.filtered/reports.total
+    else:
+        value = reports.count
+        unc = reports.unclassified
+        fil = reports.filtered
+
+    # Add unclassified/filtered at the end in the according labels
+    extra_cols = []
+    if cfg.unclassified_label and cfg.unclassified_label != cfg.filtered_label:
+        extra_cols.append(unc)
+    if cfg.filtered_label:
+        extra_cols.append(unc+fil if cfg.filtered_label == cfg.unclassified_label else fil)
+
+    return (np.concatenate([row[reports.sample]] + [row] * len(extra_cols)),
+            np.concatenate([col[reports.taxon]] + [np.full(len(row), n_taxa+i, dtype=np.int64)
+                                                   for i in range(len(extra_cols))]),
+            np.concatenate([value] + extra_cols))
 
 
 def write_tsv(out_table, output_file, output_format):
-    # Write file
-    out_file = open(output_file, "w")
-    lines = 0
-    for line in out_table:
-        print(*line, sep="\t" if output_format == "tsv" else ",", file=out_file)
-        lines += 1
-    cols = len(line)
+    # Write file, dense lines from sorted entries
+    sep = "\t" if output_format == "tsv" else ","
+    out_file = open_file(output_file, "wt")
+    print("", *out_table["cols"], sep=sep, file=out_file)
+    write_lines(out_table, out_file, sep)
     out_file.close()
 
-    return lines-1, cols-1
+    return len(out_table["rows"]), len(out_table["cols"])
+
+
+def write_lines(table, out_file, sep):
+    # Write a dense line for each row of the table (or part of it) from its entries
+    order = np.lexsort((table["col"], table["row"]))
+    col = table["col"][order]
+    value = table["value"][order]
+    ptr = np.searchsorted(table["row"][order], np.arange(len(table["rows"])+1))
+    for i, label in enumerate(table["rows"]):
+        line = [0] * len(table["cols"])
+        for c, v in zip(col[ptr[i]:ptr[i+1]].tolist(), value[ptr[i]:ptr[i+1]].tolist()):
+            line[c] = v
+        print(label, *line, sep=sep, file=out_file)
 
 
 def trim_table(table):
-    trimmed_table = [table[0]]  # get header
-    for line in table[1:]:
-        values = line[1:]  # skip header on each line
-        if max(values) > 0:
-            trimmed_table.append(line)  # keep non-zero line
-    return trimmed_table
+    # keep rows with non-zero values
+    keep = np.zeros(len(table["rows"]), dtype=bool)
+    keep[table["row"][table["value"] > 0]] = True
+    entries = keep[table["row"]]
+    return {"rows": [r for r, k in zip(table["rows"], keep.tolist()) if k],
+            "cols": table["cols"],
+            "row": (np.cumsum(keep) - 1)[table["row"][entries]],
+            "col": table["col"][entries],
+            "value": table["value"][entries]}
 
 
 def transpose(table):
-    return list(map(list, zip(*table)))
+    return {"rows": table["cols"],
+            "cols": table["rows"],
+            "row": table["col"],
+            "col": table["row"],
+            "value": table["value"]}
@@ -0,0 +1,72 @@
+import os
+import pickle
+import tempfile
+import numpy as np
+
+from ganon.util import print_log
+from ganon.tax_cache import files_key
+
+
+def table_cache_file(output_file):
+    """
+    Sidecar file next to the output table storing the parsed samples (--incremental)
+    """
+    return output_file + ".cache"
+
+
+def table_cache_key(cfg):
+    """
+    Parsed samples depend on the version and selected ranks only, other options are applied on the table
+    """
+    return [cfg.version, sorted(cfg.rank)]
+
+
+def load_table_cache(cache_file, key):
+    """
+    Returns the cache {"key": key, "keys": [variant keys], "samples": {file: sample}} or None if not available
+    or created with a different key
+    """
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with open(cache_file, "rb") as file:
+            cache = pickle.load(file)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+    return cache if cache.get("key") == key else None
+
+
+def cached_sample(cache, tre_file):
+    """
+    Returns the sample cached for a file or None if not available or the file changed (path, size and modification time)
+    """
+    if cache is None:
+        return None
+    sample = cache["samples"].get(os.path.abspath(tre_file))
+    if sample is None or sample["file"] != files_key([tre_file])[0]:
+        return None
+    return sample
+
+
+def save_table_cache(cache_file, key, tre_files, reports, quiet):
+    """
+    Write the samples of a TableMatrix (before build) parsed from tre_files to the cache file, only warns if not possible
+    Variant keys are stored once and entries of each sample as positions in the keys
+    """
+    keys, entries = reports.sample_variants()
+    samples = {}
+    for s, tre_file in enumerate(tre_files):
+        variant, count = entries[s]
+        samples[os.path.abspath(tre_file)] = {"file": files_key([tre_file])[0],
+                                               "total": reports.total[s],
+                                               "unclassified": reports.unclassified[s],
+                                               "root_node": reports.root_nodes[s],
+                                               "variant": variant.astype(np.int32),
+                                               "count": count}
+    try:
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_file)))
+        with os.fdopen(fd, "wb") as file:
+            pickle.dump({"key": key, "keys": keys, "samples": samples}, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print_log(" - WARNING: could not write table cache to " + cache_file + " (" + str(e) + ")", quiet)
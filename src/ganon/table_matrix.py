@@ -0,0 +1,182 @@
+import numpy as np
+from copy import copy
+
+
+class TableMatrix:
+    """
+    Counts of several reports as a sparse [samples x taxa] matrix in coordinate format
+    sample[i], taxon[i] and count[i] for each entry, ordered by sample and by the order of entries in each report
+    Name, rank and lineage of the entries are stored once for each distinct value of a taxon (variant[i])
+    """
+
+    def __init__(self):
+        self.labels = []
+        self.total = []
+        self.unclassified = []
+        self.root_nodes = []
+
+        self.taxa = []
+        self.index = {}
+
+        self.variants = {}
+        self.variant_taxon = []
+        self.names = []
+        self.ranks = []
+        self.lineages = []
+
+        self.sample = []
+        self.variant = []
+        self.count = []
+
+    def __len__(self):
+        return len(self.labels)
+
+    def add(self, label, count, lineage, name, rank, total, unclassified, root_node):
+        """
+        Add a sample with values from parse_tre_rank() or report_rank() (lineages as "|" separated str)
+        """
+        variant = self.variant_ids([(taxid, name[taxid], rank[taxid], lineage[taxid]) for taxid in count])
+        self.add_variants(label, variant, np.array(list(count.values()), dtype=np.int64), total, unclassified, root_node)
+
+    def add_variants(self, label, variant, count, total, unclassified, root_node):
+        """
+        Add a sample with entries as variants (from variant_ids()) and counts
+        """
+        self.labels.append(label)
+        self.total.append(total)
+        self.unclassified.append(unclassified)
+        self.root_nodes.append(root_node)
+        self.sample.append(np.full(len(variant), len(self.labels)-1, dtype=np.int64))
+        self.variant.append(variant)
+        self.count.append(count)
+
+    def variant_ids(self, keys):
+        """
+        Returns the variant of each key (taxid, name, rank, lineage), adding new variants and taxa
+        """
+        variant = []
+        for key in keys:
+            v = self.variants.get(key)
+            if v is None:
+                v = self.variants[key] = len(self.variant_taxon)
+                taxid, name, rank, lineage = key
+                if taxid not in self.index:
+                    self.index[taxid] = len(self.taxa)
+                    self.taxa.append(taxid)
+                self.variant_taxon.append(self.index[taxid])
+                self.names.append(name)
+                self.ranks.append(rank)
+                self.lineages.append(lineage.split("|"))
+            variant.append(v)
+        return np.array(variant, dtype=np.int64)
+
+    def sample_variants(self):
+        """
+        Returns the keys of the variants with entries and the entries of each sample [(variant, count), ...]
+        with variants as positions in the keys, to be added again with variant_ids() and add_variants()
+        Should be called before build()
+        """
+        keys = list(self.variants)
+        used = np.unique(np.concatenate(self.variant)) if self.variant else np.zeros(0, dtype=np.int64)
+        pos = np.full(len(keys), -1, dtype=np.int64)
+        pos[used] = np.arange(len(used))
+        return [keys[v] for v in used.tolist()], [(pos[v], c) for v, c in zip(self.variant, self.count)]
+
+    def build(self):
+        """
+        Concatenate entries of all samples, should be called once after adding samples
+        """
+        self.variants = None
+        self.variant_taxon = np.array(self.variant_taxon, dtype=np.int64)
+        self.total = np.array(self.total, dtype=np.int64)
+        self.unclassified = np.array(self.unclassified, dtype=np.int64)
+        self.filtered = np.zeros(len(self.labels), dtype=np.int64)
+        self.sample = np.concatenate(self.sample) if self.sample else np.zeros(0, dtype=np.int64)
+        self.variant = np.concatenate(self.variant) if self.variant else np.zeros(0, dtype=np.int64)
+        self.count = np.concatenate(self.count) if self.count else np.zeros(0, dtype=np.int64)
+        self.taxon = self.variant_taxon[self.variant]
+        self.sorted_keys = None
+
+        # Keep only taxa with entries in order of first occurrence, as if samples were added only with add()
+        taxa = self.present_taxa()
+        if len(taxa) < len(self.taxa) or (taxa != np.arange(len(taxa))).any():
+            pos = np.full(len(self.taxa), -1, dtype=np.int64)
+            pos[taxa] = np.arange(len(taxa))
+            self.taxa = [self.taxa[t] for t in taxa.tolist()]
+            self.index = {taxid: t for t, taxid in enumerate(self.taxa)}
+            self.variant_taxon = pos[self.variant_taxon]
+            self.taxon = pos[self.taxon]
+        return self
+
+    def remove(self, mask, filtered: bool=True):
+        """
+        Remove entries in mask, accounting their counts as filtered
+        """
+        if filtered:
+            np.add.at(self.filtered, self.sample[mask], self.count[mask])
+        keep = ~mask
+        self.sample = self.sample[keep]
+        self.variant = self.variant[keep]
+        self.taxon = self.taxon[keep]
+        self.count = self.count[keep]
+        self.sorted_keys = None
+
+    def select(self, keep):
+        """
+        Returns a copy with only the entries in keep, sharing taxa and variants
+        """
+        selected = copy(self)
+        selected.total = self.total.copy()
+        selected.unclassified = self.unclassified.copy()
+        selected.filtered = np.zeros(len(self.labels), dtype=np.int64)
+        selected.lineages = list(self.lineages)
+        selected.sample = self.sample[keep]
+        selected.variant = self.variant[keep]
+        selected.taxon = self.taxon[keep]
+        selected.count = self.count[keep]
+        selected.sorted_keys = None
+        return selected
+
+    def present_taxa(self):
+        """
+        Returns taxa with entries in order of first occurrence
+        """
+        unique, first = np.unique(self.taxon, return_index=True)
+        return unique[np.argsort(first)]
+
+    def present_variants(self):
+        return np.unique(self.variant)
+
+    def last_variants(self, taxa):
+        """
+        Returns the variant of the last entry of each taxon
+        """
+        last = np.full(len(self.taxa), -1, dtype=np.int64)
+        np.maximum.at(last, self.taxon, np.arange(len(self.taxon)))
+        return self.variant[last[taxa]]
+
+    def n_taxa(self):
+        return len(np.unique(self.taxon))
+
+    def ancestors(self):
+        """
+        Returns the ancestors of each variant (in its lineage and in the matrix) in CSR format (ptr, ancestors)
+        """
+        anc = [[self.index[node] for node in lineage[:-1] if node in self.index] for lineage in self.lineages]
+        ptr = np.zeros(len(anc)+1, dtype=np.int64)
+        np.cumsum([len(a) for a in anc], out=ptr[1:])
+        return ptr, np.array([a for lin in anc for a in lin], dtype=np.int64)
+
+    def lookup(self, sample, taxon):
+        """
+        Returns the position of the entries (sample, taxon), -1 if not found
+        """
+        if self.sorted_keys is None:
+            keys = self.sample * len(self.taxa) + self.taxon
+            self.sorted_order = np.argsort(keys, kind="stable")
+            self.sorted_keys = keys[self.sorted_order]
+        query = sample * len(self.taxa) + taxon
+        if not len(self.sorted_keys):
+            return np.full(len(query), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.sorted_keys, query), len(self.sorted_keys)-1)
+        return np.where(self.sorted_keys[pos] == query, self.sorted_order[pos], -1)
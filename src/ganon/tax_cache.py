@@ -0,0 +1,381 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from copy import copy
+
+from ganon.util import print_log
+from ganon.tax_util import parse_genome_size_tax
+from ganon.tax_index import TaxIndex, check_multitax
+
+from multitax import CustomTx, NcbiTx, GtdbTx
+
+tax_classes = {tax_class.__name__: tax_class for tax_class in [CustomTx, NcbiTx, GtdbTx]}
+
+
+def load_tax(tax_class, files, cache_folder, quiet, genome_sizes: bool=False, **tax_args):
+    """
+    Load taxonomy from files re-using a compiled version stored in cache_folder
+    Compiled taxonomies are keyed by class, arguments and the content of the files
+    Returns a CompiledTx or the parsed tax if the cache could not be written
+    """
+    key = [tax_class.__name__, sorted(tax_args.items())] + files_hash(files)
+    folder = os.path.join(cache_folder, hashlib.sha1(json.dumps(key).encode()).hexdigest())
+
+    if not os.path.isdir(folder):
+        tx = time.time()
+        tax = tax_class(files=files, **tax_args)
+        gs = None
+        if genome_sizes:
+            # Genome sizes from the last column of .tax files, not available for other formats
+            try:
+                gs = parse_genome_size_tax(files)
+            except ValueError:
+                pass
+        try:
+            os.makedirs(cache_folder, exist_ok=True)
+            compile_tax(tax, folder, gs)
+        except OSError as e:
+            print_log(" - WARNING: could not write compiled taxonomy to " + cache_folder + " (" + str(e) + ")", quiet)
+            return tax
+        print_log(" - compiled taxonomy saved to " + folder + " in " + str("%.2f" % (time.time() - tx)) + "s", quiet)
+
+    return CompiledTx(folder)
+
+
+def files_key(files):
+    """
+    Returns a list identifying files by path, size and modification time
+    """
+    key = []
+    for file in files:
+        st = os.stat(file)
+        key.append([os.path.abspath(file), st.st_size, st.st_mtime_ns])
+    return key
+
+
+def files_hash(files):
+    """
+    Returns a list identifying files by the hash of their content
+    """
+    key = []
+    for file in files:
+        file_hash = hashlib.sha1()
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                file_hash.update(chunk)
+        key.append(file_hash.hexdigest())
+    return key
+
+
+def compile_tax(tax, folder, genome_sizes: dict=None):
+    """
+    Write a multitax taxonomy to folder as arrays sorted by node: nodes, parents (index), ranks (code),
+    position in the original order and names in a blob (original order, one per line) with start/end positions
+    """
+    # Private multitax attributes, only for the tested version
+    check_multitax(tax)
+    nodes = list(tax._nodes)
+    enc_nodes = np.array([node.encode() for node in nodes], dtype=bytes)
+    sort = np.argsort(enc_nodes, kind="stable")
+    # position of each node (in original order) in the sorted arrays
+    order = np.empty(len(nodes), dtype=np.int64)
+    order[sort] = np.arange(len(nodes))
+    index = dict(zip(nodes, order.tolist()))
+
+    parents = np.empty(len(nodes), dtype=np.int64)
+    parents[order] = [index.get(parent, -1) for parent in tax._nodes.values()]
+    rank_codes = {}
+    ranks = np.empty(len(nodes), dtype=np.int64)
+    ranks[order] = [rank_codes.setdefault(tax._ranks[node], len(rank_codes)) if node in tax._ranks else -1 for node in nodes]
+
+    enc_names = [tax._names[node].encode() if node in tax._names else b"" for node in nodes]
+    ends = np.cumsum([len(name)+1 for name in enc_names], dtype=np.int64) - 1
+    name_pos = np.empty((len(nodes), 2), dtype=np.int64)
+    name_pos[order, 0] = ends - [len(name) for name in enc_names]
+    name_pos[order, 1] = ends
+    name_pos[order[[node not in tax._names for node in nodes]]] = -1
+
+    tmp_folder = tempfile.mkdtemp(dir=os.path.dirname(folder))
+    np.save(os.path.join(tmp_folder, "nodes.npy"), enc_nodes[sort])
+    np.save(os.path.join(tmp_folder, "original.npy"), sort)
+    np.save(os.path.join(tmp_folder, "parents.npy"), parents)
+    np.save(os.path.join(tmp_folder, "ranks.npy"), ranks)
+    np.save(os.path.join(tmp_folder, "name_pos.npy"), name_pos)
+    with open(os.path.join(tmp_folder, "names.bin"), "wb") as file:
+        file.write(b"\n".join(enc_names))
+
+    if hasattr(tax, "_merged"):
+        merged = sorted((node.encode(), latest.encode()) for node, latest in tax._merged.items())
+        np.save(os.path.join(tmp_folder, "merged.npy"), np.array(merged, dtype=bytes).reshape(-1, 2))
+
+    if genome_sizes is not None:
+        gs = np.full(len(nodes), -1, dtype=np.int64)
+        gs[order] = [genome_sizes.get(node, -1) for node in nodes]
+        np.save(os.path.join(tmp_folder, "genome_sizes.npy"), gs)
+
+    info = {"class": tax.__class__.__name__,
+            "version": tax.version,
+            "sources": tax.sources,
+            "ranks": list(rank_codes),
+            "root_node": tax.root_node,
+            "root_parent": tax.root_parent,
+            "root_name": tax.root_name,
+            "root_rank": tax.root_rank,
+            "undefined_node": tax.undefined_node,
+            "undefined_name": tax.undefined_name,
+            "undefined_rank": tax.undefined_rank}
+    with open(os.path.join(tmp_folder, "info.json"), "w") as file:
+        json.dump(info, file)
+
+    try:
+        os.rename(tmp_folder, folder)
+    except OSError:
+        # Compiled in parallel by another run
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        if not os.path.isdir(folder):
+            raise
+
+
+class CompiledTx:
+    """
+    Taxonomy loaded from a compiled folder (see compile_tax) with memory-mapped arrays
+    Only the nodes requested with filter() or single node methods are decoded and only their names are read
+    Operations on the full tree use the arrays (tax_index())
+    """
+
+    def __init__(self, folder):
+        with open(os.path.join(folder, "info.json")) as file:
+            info = json.load(file)
+        self.folder = folder
+        self.version = info["version"]
+        self.sources = info["sources"]
+        self.ranks = info["ranks"]
+        self.root_node = info["root_node"]
+        self.root_parent = info["root_parent"]
+        self.root_name = info["root_name"]
+        self.root_rank = info["root_rank"]
+        self.undefined_node = info["undefined_node"]
+        self.undefined_name = info["undefined_name"]
+        self.undefined_rank = info["undefined_rank"]
+
+        self.nodes = self.load("nodes")
+        self.original = self.load("original")
+        self.parents = self.load("parents")
+        self.rank_codes = self.load("ranks")
+        self.name_pos = self.load("name_pos")
+        names_file = os.path.join(folder, "names.bin")
+        self.names = np.memmap(names_file, dtype=np.uint8, mode="r") if os.path.getsize(names_file) else np.zeros(0, dtype=np.uint8)
+        self.merged = self.load("merged")
+        self.genome_size = self.load("genome_sizes")
+
+        # Empty instance of the original class with the same root and undefined values
+        self.template = tax_classes[info["class"]](empty=True,
+                                                   root_node=self.root_node,
+                                                   root_parent=self.root_parent,
+                                                   root_name=self.root_name,
+                                                   root_rank=self.root_rank,
+                                                   undefined_node=self.undefined_node,
+                                                   undefined_name=self.undefined_name,
+                                                   undefined_rank=self.undefined_rank)
+        self.template.version = self.version
+        self.template.sources = self.sources
+
+    def load(self, name):
+        file = os.path.join(self.folder, name + ".npy")
+        return np.load(file, mmap_mode="r") if os.path.isfile(file) else None
+
+    def lookup(self, nodes, sorted_nodes=None):
+        """
+        Returns array with the position of nodes in sorted_nodes (default self.nodes), -1 if not found
+        """
+        if sorted_nodes is None:
+            sorted_nodes = self.nodes
+        enc_nodes = np.array([node.encode() for node in nodes], dtype=bytes)
+        if not len(enc_nodes) or not len(sorted_nodes):
+            return np.full(len(enc_nodes), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(sorted_nodes, enc_nodes), len(sorted_nodes)-1)
+        return np.where(sorted_nodes[pos] == enc_nodes, pos, -1)
+
+    def decode(self, idx):
+        return [node.decode() for node in self.nodes[idx].tolist()]
+
+    def get_names(self, idx):
+        """
+        Returns names of the nodes in idx (None if not defined)
+        """
+        # Read the whole blob at once for many names, slicing the memory-mapped file is slower
+        names = self.names if len(idx) < 100000 else bytes(self.names)
+        return [bytes(names[s:e]).decode() if s >= 0 else None for s, e in self.name_pos[idx].tolist()]
+
+    def filter(self, nodes):
+        """
+        Returns a taxonomy (same class as the compiled) keeping only the lineages of the given nodes
+        Same as filter_tax() for a multitax taxonomy, nodes are kept in their original order
+        """
+        idx = self.lookup(nodes)
+        keep = np.zeros(len(self.nodes), dtype=bool)
+        root = self.lookup([self.root_node])[0]
+        keep[root] = True
+        cur = idx[idx >= 0]
+        while len(cur):
+            cur = np.unique(cur[~keep[cur]])
+            keep[cur] = True
+            cur = self.parents[cur]
+            cur = cur[cur >= 0]
+        kept = np.flatnonzero(keep)
+        kept = kept[np.argsort(self.original[kept])]
+        return self.build_tax(kept, missing=[node for node, i in zip(nodes, idx.tolist()) if i < 0])
+
+    def build_tax(self, idx, missing: list=None):
+        """
+        Returns taxonomy with the nodes in idx
+        missing nodes are checked in the merged entries (if any)
+        """
+        tax = copy(self.template)
+        nodes = self.decode(idx)
+        parents = self.parents[idx].tolist()
+        parent_idx = np.unique(self.parents[idx])
+        parent_idx = parent_idx[parent_idx >= 0]
+        parent_nodes = dict(zip(parent_idx.tolist(), self.decode(parent_idx)))
+        # Only root has no parent in the tree
+        tax._nodes = {node: parent_nodes.get(parent, self.root_parent) for node, parent in zip(nodes, parents)}
+        tax._ranks = {node: self.ranks[r] for node, r in zip(nodes, self.rank_codes[idx].tolist()) if r >= 0}
+        tax._names = {node: name for node, name in zip(nodes, self.get_names(idx)) if name is not None}
+        if self.merged is not None and missing:
+            merged_pos = self.lookup(missing, self.merged[:, 0])
+            tax._merged = {node: self.merged[pos, 1].decode() for node, pos in zip(missing, merged_pos.tolist()) if pos >= 0}
+        tax._reset_aux_data()
+        return tax
+
+    def tax_index(self):
+        """
+        Returns a TaxIndex of the full taxonomy built from the arrays, without decoding nodes
+        """
+        return CompiledTaxIndex(self)
+
+    def genome_sizes(self):
+        """
+        Returns a dict-like object with genome sizes of the nodes {node: size}
+        """
+        if self.genome_size is None:
+            raise ValueError("Genome sizes not available")
+        return CompiledNodeValues(self, self.genome_size)
+
+    def position(self, node):
+        """
+        Returns the position of a single node in the arrays, -1 if not found
+        """
+        return int(self.lookup([node])[0]) if isinstance(node, str) else -1
+
+    def latest(self, node):
+        """
+        Same as tax.latest(node): node if found, merged node (if any) or undefined_node
+        """
+        if self.position(node) >= 0:
+            return node
+        if self.merged is not None and isinstance(node, str):
+            pos = self.lookup([node], self.merged[:, 0])[0]
+            if pos >= 0:
+                return self.merged[pos, 1].decode()
+        return self.undefined_node
+
+    def name(self, node):
+        """
+        Same as tax.name(node)
+        """
+        pos = self.position(node)
+        name = self.get_names([pos])[0] if pos >= 0 else None
+        return name if name is not None else self.undefined_name
+
+    def lineage(self, node):
+        """
+        Same as tax.lineage(node)
+        """
+        lineage = []
+        pos = self.position(node)
+        while pos >= 0:
+            lineage.append(pos)
+            pos = int(self.parents[pos])
+        return self.decode(lineage[::-1])
+
+    def parent_rank(self, node, rank):
+        """
+        Same as tax.parent_rank(node, rank): top node of the given rank in the lineage of node
+        """
+        if rank not in self.ranks:
+            return self.undefined_node
+        code = self.ranks.index(rank)
+        parent = -1
+        pos = self.position(node)
+        while pos >= 0:
+            if self.rank_codes[pos] == code:
+                parent = pos
+            pos = int(self.parents[pos])
+        return self.decode([parent])[0] if parent >= 0 else self.undefined_node
+
+
+class CompiledTaxIndex(TaxIndex):
+    """
+    TaxIndex of the full taxonomy of a CompiledTx built from its arrays
+    Nodes are only decoded when requested (get_nodes or node_values for some nodes)
+    """
+
+    def __init__(self, ctx):
+        self.tax = ctx
+        self.root = int(ctx.lookup([ctx.root_node])[0])
+        self.parent = np.array(ctx.parents, dtype=np.int64)
+        # Nodes without rank have the undefined rank
+        self.ranks = list(ctx.ranks)
+        if ctx.undefined_rank not in self.ranks:
+            self.ranks.append(ctx.undefined_rank)
+        self.rank = np.where(ctx.rank_codes >= 0, ctx.rank_codes, self.ranks.index(ctx.undefined_rank))
+        # Compiled nodes are already sorted
+        self.build_tree(np.arange(len(self.parent)))
+
+    def get_index(self, nodes):
+        idx = self.lookup(nodes)
+        if (idx < 0).any():
+            raise KeyError(list(nodes)[int(np.argmax(idx < 0))])
+        return idx
+
+    def lookup(self, nodes):
+        return self.tax.lookup(list(nodes))
+
+    def get_nodes(self, idx):
+        idx = np.asarray(idx)
+        nodes = iter(self.tax.decode(idx[idx >= 0]))
+        return [next(nodes) if i >= 0 else self.tax.undefined_node for i in idx.tolist()]
+
+    def node_values(self, values, idx=None):
+        """
+        Returns {node: value} for an array of values of every node, only for the nodes in idx
+        Without idx, returns a dict-like object reading from the array (nodes are not decoded)
+        """
+        if idx is None:
+            return CompiledNodeValues(self.tax, values)
+        return super().node_values(values, idx)
+
+
+class CompiledNodeValues:
+    """
+    Read-only access to values of the nodes of a CompiledTx (negative for not available)
+    same lookups as a dict {node: value}
+    """
+
+    def __init__(self, ctx, values):
+        self.ctx = ctx
+        self.values = values
+
+    def __getitem__(self, node):
+        pos = self.ctx.position(node)
+        if pos < 0 or self.values[pos] < 0:
+            raise KeyError(node)
+        return int(self.values[pos])
+
+    def __contains__(self, node):
+        pos = self.ctx.position(node)
+        return pos >= 0 and self.values[pos] >= 0
@@ -0,0 +1,215 @@
+import numpy as np
+import multitax
+
+# Private multitax attributes are accessed directly, only the tested version is supported
+MULTITAX_VERSION = (1, 6)
+
+
+def check_multitax(tax):
+    """
+    Check if the private attributes of multitax (_nodes, _names, _ranks, _reset_aux_data) can be used
+    Raises ImportError if the installed multitax is not the tested version
+    """
+    version = tuple(int(v) for v in multitax.__version__.split(".")[:2] if v.isdigit())
+    if version != MULTITAX_VERSION or \
+       not all(isinstance(getattr(tax, attr, None), dict) for attr in ["_nodes", "_names", "_ranks"]) or \
+       not callable(getattr(tax, "_reset_aux_data", None)):
+        raise ImportError("multitax " + multitax.__version__ + " is not supported, requires multitax " +
+                          ".".join(map(str, MULTITAX_VERSION)) + ".x")
+
+
+class TaxIndex:
+    """
+    Integer indexed copy of a (filtered) multitax taxonomy for vectorized operations over the tree
+    nodes[i] is the node of index i, parent[i] the index of its parent (-1 for root) and rank[i] a code of ranks
+    levels has the indices of the nodes by depth (root first), children sorted by node
+    pre is the position of each node in a pre-order traversal of the tree (same as sorting by lineage)
+    """
+
+    def __init__(self, tax):
+        self.tax = tax
+        check_multitax(tax)
+        self.nodes = list(tax._nodes)
+        self.index = {node: i for i, node in enumerate(self.nodes)}
+        self.root = self.index[tax.root_node]
+
+        self.parent = np.array([self.index.get(p, -1) for p in tax._nodes.values()], dtype=np.int64)
+        rank_codes = {}
+        self.rank = np.array([rank_codes.setdefault(tax.rank(node), len(rank_codes)) for node in self.nodes], dtype=np.int64)
+        self.ranks = list(rank_codes)
+
+        node_key = np.empty(len(self.nodes), dtype=np.int64)
+        node_key[np.argsort(np.array(self.nodes))] = np.arange(len(self.nodes))
+        self.build_tree(node_key)
+
+    def build_tree(self, node_key):
+        """
+        Build children, levels, depth, subtree sizes and pre-order positions from self.parent and self.root
+        node_key is the position of each node when sorted by node
+        """
+        n = len(self.parent)
+        self.parent[self.root] = -1
+        self.parent_list = self.parent.tolist()
+
+        # Children of each node in CSR format, sorted by node (as in lineage comparison)
+        children = np.flatnonzero(self.parent >= 0)
+        self.children = children[np.lexsort((node_key[children], self.parent[children]))]
+        self.children_ptr = np.zeros(n+1, dtype=np.int64)
+        np.cumsum(np.bincount(self.parent[self.children], minlength=n), out=self.children_ptr[1:])
+
+        self.depth = np.zeros(n, dtype=np.int64)
+        self.levels = [np.array([self.root], dtype=np.int64)]
+        while True:
+            level = self.children[expand_ranges(self.children_ptr[self.levels[-1]], self.children_ptr[self.levels[-1]+1])]
+            if not len(level):
+                break
+            self.depth[level] = len(self.levels)
+            self.levels.append(level)
+
+        # Subtree sizes bottom-up and pre-order position top-down
+        self.size = np.ones(n, dtype=np.int64)
+        for level in self.levels[:0:-1]:
+            np.add.at(self.size, self.parent[level], self.size[level])
+        children_size = np.zeros(len(self.children)+1, dtype=np.int64)
+        np.cumsum(self.size[self.children], out=children_size[1:])
+        siblings_size = np.zeros(n, dtype=np.int64)
+        siblings_size[self.children] = children_size[:-1] - children_size[self.children_ptr[self.parent[self.children]]]
+        self.pre = np.zeros(n, dtype=np.int64)
+        for level in self.levels[1:]:
+            self.pre[level] = self.pre[self.parent[level]] + 1 + siblings_size[level]
+
+    def get_index(self, nodes):
+        """
+        Returns array of indices for a list of nodes
+        """
+        return np.array([self.index[node] for node in nodes], dtype=np.int64)
+
+    def lookup(self, nodes):
+        """
+        Returns array of indices for a list of nodes, -1 if not found
+        """
+        return np.array([self.index.get(node, -1) for node in nodes], dtype=np.int64)
+
+    def get_nodes(self, idx):
+        """
+        Returns list of nodes for an array of indices (-1 as undefined node)
+        """
+        return [self.nodes[i] if i >= 0 else self.tax.undefined_node for i in np.asarray(idx).tolist()]
+
+    def node_values(self, values, idx=None):
+        """
+        Returns {node: value} for an array of values of every node, only for the nodes in idx (default all)
+        """
+        if idx is None:
+            return dict(zip(self.nodes, values.tolist()))
+        return dict(zip(self.get_nodes(idx), values[idx].tolist()))
+
+    def lineage(self, i):
+        """
+        Returns list of indices of the lineage of a node (from root to node)
+        """
+        lineage = []
+        while i >= 0:
+            lineage.append(i)
+            i = self.parent_list[i]
+        return lineage[::-1]
+
+    def rank_codes(self, ranks):
+        """
+        Returns array mapping rank codes to the position of its first occurrence in ranks (-1 if not present)
+        """
+        pos = np.full(len(self.ranks), -1, dtype=np.int64)
+        for r, rank in reversed(list(enumerate(ranks))):
+            if rank in self.ranks:
+                pos[self.ranks.index(rank)] = r
+        return pos
+
+    def ranked_lineages(self, ranks):
+        """
+        Returns a matrix [nodes x ranks] with the lineage of each node with only the given ranks (-1 if not defined)
+        Same as tax.lineage(node, ranks=ranks): if several nodes in the lineage share a rank, the top one is kept
+        """
+        rank_pos = self.rank_codes(ranks)[self.rank]
+        lineages = np.full((len(self.parent), len(ranks)), -1, dtype=np.int64)
+        for level in self.levels:
+            if level[0] != self.root:
+                lineages[level] = lineages[self.parent[level]]
+            level = level[rank_pos[level] >= 0]
+            level = level[lineages[level, rank_pos[level]] < 0]
+            lineages[level, rank_pos[level]] = level
+        return lineages
+
+    def closest_parent(self, ranks):
+        """
+        Returns array with the closest parent of each node based on a list of ranks (-1 if not found)
+        Same as tax.closest_parent(node, ranks=ranks)
+        """
+        lineages = self.ranked_lineages(ranks)
+        defined = lineages >= 0
+        last = len(ranks) - 1 - np.argmax(defined[:, ::-1], axis=1)
+        closest = np.where(defined.any(axis=1), lineages[np.arange(len(self.parent)), last], -1)
+        return np.where(self.rank_codes(ranks)[self.rank] >= 0, np.arange(len(self.parent)), closest)
+
+    def lineage_pairs(self, idx, stop: int=-1):
+        """
+        Returns all (position in idx, node) pairs for the lineage of each node in idx
+        sorted by position and from root to node. With stop, lineages are cut before the stop node(s)
+        """
+        pos = np.arange(len(idx))
+        stop = np.broadcast_to(stop, len(idx))
+        lin_pos = [pos[:0]]
+        lin_idx = [idx[:0]]
+        while len(idx):
+            keep = idx != stop[pos]
+            pos = pos[keep]
+            idx = idx[keep]
+            lin_pos.append(pos)
+            lin_idx.append(idx)
+            keep = idx != self.root
+            pos = pos[keep]
+            idx = self.parent[idx[keep]]
+        lin_pos = np.concatenate(lin_pos)
+        lin_idx = np.concatenate(lin_idx)
+        order = np.lexsort((self.depth[lin_idx], lin_pos))
+        return lin_pos[order], lin_idx[order]
+
+    def in_subtrees(self, nodes, idx):
+        """
+        Returns a mask of idx under (or equal to) any of the given nodes
+        Checked with the pre-order interval of each subtree [pre, pre+size)
+        """
+        subtrees = self.lookup(nodes)
+        subtrees = subtrees[subtrees >= 0]
+        if not len(subtrees):
+            return np.zeros(len(idx), dtype=bool)
+        order = np.argsort(self.pre[subtrees])
+        starts = self.pre[subtrees][order]
+        # Intervals are either nested or disjoint, keep the furthest end of the ones starting before each position
+        ends = np.maximum.accumulate(starts + self.size[subtrees][order])
+        pos = np.searchsorted(starts, self.pre[idx], side="right") - 1
+        return (pos >= 0) & (self.pre[idx] < ends[pos])
+
+
+def expand_ranges(starts, ends):
+    """
+    Concatenate ranges starts[i]:ends[i] into one array
+    """
+    lengths = ends - starts
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+
+def accumulate(idx, values):
+    """
+    Sum values by idx sequentially (same result as a loop over a dict)
+    Returns unique idx in order of first occurrence and their sums
+    """
+    if not len(idx):
+        return idx, values
+    unique, first = np.unique(idx, return_index=True)
+    unique = unique[np.argsort(first)]
+    if values.dtype.kind == "f":
+        sums = np.bincount(idx, weights=values)
+    else:
+        sums = np.zeros(idx.max()+1, dtype=values.dtype)
+        np.add.at(sums, idx, values)
+    return unique, sums[unique]
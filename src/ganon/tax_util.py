@@ -3,8 +3,10 @@ import pandas as pd
 import re
 import os
 import gzip
+import numpy as np
 
 from ganon.util import download, run, print_log, rm_files
+from ganon.tax_index import TaxIndex
 from io import StringIO
 
 
@@ -138,65 +140,106 @@ def get_genome_size(cfg, nodes, tax, build_output_folder):
     Estimate genome sizes based on auxiliary files
     Only used nodes and lineage are calculated, based on the full set of values provided
     If information of a certain node is not provided, uses the closest estimate of parent nodes
+    nodes=None calculates all nodes. tax can be a compiled taxonomy (CompiledTx), estimated on its arrays
+    and, for all nodes, returned as a dict-like object without decoding nodes
     """
-    genome_sizes = {}
     if cfg.skip_genome_size:
         # Skipping genome sizes, all set to 1
+        if nodes is None:
+            ti = get_tax_index(tax)
+            return ti.node_values(np.ones(len(ti.parent), dtype=np.int64))
+        genome_sizes = {}
         for node in nodes:
             for t in tax.lineage(node):
                 genome_sizes[t] = 1
-    else:
-        # Download and parse auxiliary files containing genome sizes
-        leaves_sizes = parse_genome_size_files(cfg, build_output_folder)
-
-        tx = time.time()
-        print_log("Estimating genome sizes", cfg.quiet)
+        return genome_sizes
 
-        # Check if entries are on tax and distribute values to available tax. leaves
-        for t in list(leaves_sizes.keys()):
-            if not tax.latest(t):
-                del leaves_sizes[t]
-            else:
-                # Store genome size estimation for all leaf nodes available in the taxonomy
-                for leaf in tax.leaves(t):
-                    leaves_sizes[leaf] = leaves_sizes[t]
+    # Download and parse auxiliary files containing genome sizes
+    leaves_sizes = parse_genome_size_files(cfg, build_output_folder)
 
-        # Calculate genome size estimates for used nodes (and their lineage)
-        # using the complete content of leaves_sizes (keeping approx. the same estimates between different dbs)
-        
-        for node in nodes:
-            # For the lineage of each target node
-            for t in tax.lineage(node):
-                # Skip if already calculated
-                if t not in genome_sizes:
-                    cnt = 0
-                    avg = 0
-                    # Make average of available genome sizes in children leaves
-                    for leaf in tax.leaves(t):
-                        if leaf in leaves_sizes:
-                            cnt += 1
-                            avg += leaves_sizes[leaf]
-                    genome_sizes[t] = int(avg / cnt) if cnt else 0
-
-        # If there is no matching between taxonomy and leaves, average the whole and save to root to be redistributed in the next step
-        if sum(genome_sizes.values())==0:
-            if leaves_sizes:
-                genome_sizes[tax.root_node] = int(sum(leaves_sizes.values())/len(leaves_sizes))
-            else:
-                genome_sizes[tax.root_node] = 1
-        # Check nodes without genome size info (0) and use closest value from parent lineage
-        for node in nodes:
-            if genome_sizes[node] == 0:
-                # Fill lineage of zeros with latest genome size estimation
-                for t in tax.lineage(node):
-                    if genome_sizes[t] == 0:
-                        genome_sizes[t] = genome_sizes[tax.parent(t)]
+    tx = time.time()
+    print_log("Estimating genome sizes", cfg.quiet)
+
+    ti = get_tax_index(tax)
+    n = len(ti.parent)
+    is_leaf = ti.children_ptr[1:] == ti.children_ptr[:-1]
+
+    # Check if entries are on tax (or merged, same as tax.latest) and distribute values to available tax. leaves
+    entry_nodes = list(leaves_sizes)
+    entry_pos = ti.lookup(entry_nodes)
+    valid = np.array([p >= 0 or bool(tax.latest(t)) for t, p in zip(entry_nodes, entry_pos.tolist())], dtype=bool)
+    entry_pos = entry_pos[valid]
+    sizes = np.array(list(leaves_sizes.values()), dtype=np.int64)[valid]
+    # Store genome size estimation for all leaf nodes available in the taxonomy
+    # Same as copying each entry to all leaves below it in order: the last parent entry wins over the leaf entry
+    entry = np.full(n, -1, dtype=np.int64)
+    found = entry_pos >= 0
+    entry[entry_pos[found]] = np.flatnonzero(found)
+    leaf_entry = np.where(is_leaf, entry, -1)
+    parent_entry = np.where(is_leaf, -1, entry)
+    for level in ti.levels[1:]:
+        parent_entry[level] = np.maximum(parent_entry[level], parent_entry[ti.parent[level]])
+    leaf_entry[is_leaf] = np.where(parent_entry[is_leaf] >= 0, parent_entry[is_leaf], leaf_entry[is_leaf])
+    has_size = leaf_entry >= 0
+    leaf_size = np.zeros(n, dtype=np.int64)
+    leaf_size[has_size] = sizes[leaf_entry[has_size]]
+
+    # Calculate genome size estimates for used nodes (and their lineage)
+    # using the complete content of leaves_sizes (keeping approx. the same estimates between different dbs)
+    # Sum and count of available genome sizes in children leaves, bottom-up
+    sum_size = leaf_size.copy()
+    cnt_size = has_size.astype(np.int64)
+    for level in ti.levels[:0:-1]:
+        np.add.at(sum_size, ti.parent[level], sum_size[level])
+        np.add.at(cnt_size, ti.parent[level], cnt_size[level])
+
+    idx = lineages_index(ti, nodes) if nodes is not None else np.arange(n)
+    genome_size = np.zeros(n, dtype=np.int64)
+    genome_size[idx] = np.where(cnt_size[idx] > 0, sum_size[idx] / np.maximum(cnt_size[idx], 1), 0).astype(np.int64)
+
+    # If there is no matching between taxonomy and leaves, average the whole and save to root to be redistributed in the next step
+    if not genome_size[idx].any():
+        if len(sizes):
+            # Average of all entries and leaves with a distributed value
+            not_leaf = ~found
+            not_leaf[found] = ~is_leaf[entry_pos[found]]
+            all_sizes = sizes[not_leaf].tolist() + leaf_size[has_size].tolist()
+            genome_size[ti.root] = int(sum(all_sizes)/len(all_sizes))
+        else:
+            genome_size[ti.root] = 1
+    # Nodes without genome size info (0) use closest value from parent lineage, top-down
+    for level in ti.levels[1:]:
+        genome_size[level] = np.where(genome_size[level] == 0, genome_size[ti.parent[level]], genome_size[level])
 
-        print_log(" - done in " + str("%.2f" % (time.time() - tx)) + "s.\n", cfg.quiet)
+    genome_sizes = ti.node_values(genome_size, idx if nodes is not None else None)
+    print_log(" - done in " + str("%.2f" % (time.time() - tx)) + "s.\n", cfg.quiet)
 
     return genome_sizes
 
 
+def get_tax_index(tax):
+    """
+    Returns a TaxIndex of the taxonomy, compiled taxonomies (CompiledTx) are indexed from their arrays
+    """
+    return tax.tax_index() if hasattr(tax, "tax_index") else TaxIndex(tax)
+
+
+def lineages_index(ti, nodes):
+    """
+    Returns array of indices of the nodes and their lineages (in order of tax.lineage() for each node)
+    """
+    seen = bytearray(len(ti.parent))
+    idx = []
+    for i in ti.get_index(nodes).tolist():
+        lineage = []
+        while i >= 0 and not seen[i]:
+            seen[i] = 1
+            lineage.append(i)
+            i = ti.parent_list[i]
+        idx.extend(reversed(lineage))
+    return np.array(idx, dtype=np.int64)
+
+
 def get_file_info(cfg, info, tax, build_output_folder):
     if cfg.taxonomy == "ncbi" or (cfg.taxonomy == "skip" and cfg.level == "assembly"):
         assembly_summary_urls = []
@@ -255,7 +298,7 @@ def get_gtdb_target_node(tax, level):
     # Create specialization if requested for --level
     if level == "assembly":
         gtdb_target_node["specialization"] = gtdb_target_node.index
-        gtdb_target_node["specialization_name"] = gtdb_target_node["node"].apply(tax.name)
+        gtdb_target_node["specialization_name"] = gtdb_target_node["node"].map({node: tax.name(node) for node in gtdb_target_node["node"].unique()})
 
     return gtdb_target_node
 
@@ -2,9 +2,18 @@ import sys
 import subprocess
 import shlex
 import os
+import shutil
 import urllib.request
+import gzip
+import io
+import queue
+import threading
 from pathlib import Path
 
+# Magic bytes of compressed files
+compression_magic = {"gzip": b"\x1f\x8b", "zstd": b"\x28\xb5\x2f\xfd"}
+compression_ext = {"gzip": ".gz", "zstd": ".zst"}
+
 
 def run(cmd, ret_stdout: bool=False, shell: bool=False, quiet: bool=False):
     errcode = 1
@@ -76,15 +85,17 @@ def validate_input_files(input_files_folder, input_extension, quiet, input_recur
                 continue
             files_in_dir = 0
 
+            # Compressed files (.gz, .zst) with the extension are also valid
+            extensions = tuple([input_extension] + [input_extension + ext for ext in compression_ext.values()])
             if input_recursive:
-                for path in Path(i).rglob('*' + input_extension):
+                for path in Path(i).rglob('*'):
                     f = str(path.joinpath())
-                    if check_file(f):
+                    if f.endswith(extensions) and check_file(f):
                         files_in_dir += 1
                         valid_input_files.add(f)
             else:
                 for file in os.listdir(i):
-                    if file.endswith(input_extension):
+                    if file.endswith(extensions):
                         f = os.path.join(i, file)
                         if check_file(f):
                             files_in_dir += 1
@@ -110,6 +121,131 @@ def check_file(file):
         return False
 
 
+def compressed_file(file):
+    """
+    Return file or its compressed version (.gz or .zst) if found (and not empty), empty string otherwise
+    """
+    for f in [file] + [file + ext for ext in compression_ext.values()]:
+        if check_file(f):
+            return f
+    return ""
+
+
+def remove_compression_ext(file):
+    """
+    Remove compression extension (.gz or .zst) from a file name
+    """
+    for ext in compression_ext.values():
+        if file.endswith(ext):
+            return file[:-len(ext)]
+    return file
+
+
+def open_file(file, mode: str="rt"):
+    """
+    Open plain or compressed (gzip, zstd) files
+    Reading: compression is detected by the content of the file and decompressed in a background thread
+    Writing: compression is defined by the extension of the file (.gz or .zst)
+    """
+    binary = "b" in mode
+    if "r" not in mode:
+        if file.endswith(compression_ext["gzip"]):
+            return gzip.open(file, mode)
+        elif file.endswith(compression_ext["zstd"]):
+            return import_zstd().open(file, mode)
+        return open(file, mode)
+
+    with open(file, "rb") as f:
+        magic = f.read(4)
+    if magic.startswith(compression_magic["gzip"]):
+        stream = gzip.open(file, "rb")
+    elif magic.startswith(compression_magic["zstd"]):
+        stream = import_zstd().open(file, "rb")
+    else:
+        return open(file, mode)
+
+    reader = io.BufferedReader(BackgroundReader(stream))
+    return reader if binary else io.TextIOWrapper(reader)
+
+
+def compress_file(file, compression):
+    """
+    Compress a plain file (gzip, zstd), replacing it by the file with the compression extension
+    Returns the compressed file name
+    """
+    compressed = file + compression_ext[compression]
+    with open(file, "rb") as f_in, open_file(compressed, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out, 1048576)
+    os.remove(file)
+    return compressed
+
+
+def import_zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compressed files require the python package zstandard")
+    return zstandard
+
+
+class BackgroundReader(io.RawIOBase):
+    """
+    Read chunks of a stream (e.g. decompression) in a background thread, overlapping with their parsing
+    """
+    def __init__(self, stream, chunk_size: int=1048576, max_chunks: int=16):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue(max_chunks)
+        self.buffer = memoryview(b"")
+        self.eof = False
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def fill(self):
+        try:
+            while not self.stop.is_set():
+                chunk = self.stream.read(self.chunk_size)
+                self.put(chunk)
+                if not chunk:
+                    break
+        except Exception as e:
+            self.put(e)
+        finally:
+            self.stream.close()
+
+    def put(self, item):
+        # Wait for free space, unless stopped
+        while not self.stop.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.buffer and not self.eof:
+            chunk = self.chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                self.eof = True
+            self.buffer = memoryview(chunk)
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stop.set()
+            self.thread.join()
+        super().close()
+
+
 def check_folder(folder):
     """
     Check if folder exists and it's not empty
@@ -0,0 +1,122 @@
+#pragma once
+
+#include <zlib.h>
+
+#include <fstream>
+#include <ostream>
+#include <streambuf>
+#include <string>
+#include <vector>
+
+/*
+ * Stream buffer writing gzip compressed data with zlib
+ * Appending to an existing file adds a new gzip member, read as one file by gzip tools
+ */
+class GzStreamBuf : public std::streambuf
+{
+public:
+    GzStreamBuf()
+    : m_buffer( 1 << 16 )
+    {
+        setp( m_buffer.data(), m_buffer.data() + m_buffer.size() );
+    }
+
+    ~GzStreamBuf() override
+    {
+        close();
+    }
+
+    bool open( std::string const& file, bool append )
+    {
+        close();
+        m_file = gzopen( file.c_str(), append ? "ab" : "wb" );
+        return m_file != nullptr;
+    }
+
+    bool close()
+    {
+        if ( m_file == nullptr )
+            return true;
+        const bool written = write_buffer();
+        const bool closed  = gzclose( m_file ) == Z_OK;
+        m_file             = nullptr;
+        return written && closed;
+    }
+
+protected:
+    int_type overflow( int_type c ) override
+    {
+        if ( !write_buffer() )
+            return traits_type::eof();
+        if ( !traits_type::eq_int_type( c, traits_type::eof() ) )
+        {
+            *pptr() = traits_type::to_char_type( c );
+            pbump( 1 );
+        }
+        return traits_type::not_eof( c );
+    }
+
+    int sync() override
+    {
+        return write_buffer() ? 0 : -1;
+    }
+
+private:
+    bool write_buffer()
+    {
+        const int len = static_cast< int >( pptr() - pbase() );
+        setp( m_buffer.data(), m_buffer.data() + m_buffer.size() );
+        if ( len == 0 )
+            return true;
+        return m_file != nullptr && gzwrite( m_file, m_buffer.data(), len ) == len;
+    }
+
+    gzFile              m_file = nullptr;
+    std::vector< char > m_buffer;
+};
+
+/*
+ * Output stream to a plain or gzip compressed file, or to another stream buffer (e.g. STDOUT)
+ */
+class OutputFile : public std::ostream
+{
+public:
+    OutputFile()
+    : std::ostream( nullptr )
+    {
+    }
+
+    void open( std::string const& file, bool compressed, bool append = false )
+    {
+        if ( compressed )
+        {
+            rdbuf( &m_gz_buf );
+            if ( !m_gz_buf.open( file, append ) )
+                setstate( std::ios::failbit );
+        }
+        else
+        {
+            rdbuf( &m_file_buf );
+            if ( !m_file_buf.open( file, append ? std::ios::out | std::ios::app : std::ios::out ) )
+                setstate( std::ios::failbit );
+        }
+    }
+
+    void open( std::streambuf* buf )
+    {
+        rdbuf( buf );
+    }
+
+    void close()
+    {
+        flush();
+        if ( !m_gz_buf.close() )
+            setstate( std::ios::badbit );
+        if ( m_file_buf.is_open() && !m_file_buf.close() )
+            setstate( std::ios::badbit );
+    }
+
+private:
+    GzStreamBuf  m_gz_buf;
+    std::filebuf m_file_buf;
+};
@@ -1,5 +1,6 @@
 import unittest
 import sys
+import os
 sys.path.append('src')
 from ganon.config import Config
 
@@ -10,6 +11,7 @@ from utils import build_sanity_check_and_parse
 from utils import classify_sanity_check_and_parse, report_sanity_check_and_parse
 from utils import run_ganon
 from utils import check_files
+from utils import parse_all_one, parse_rep
 data_dir = base_dir + "data/"
 
 from parameterized import parameterized_class
@@ -250,5 +252,47 @@ class TestClassify(unittest.TestCase):
         # There is no .tre output
         self.assertFalse(check_files(params["output_prefix"], "tre"))
 
+    def test_output_compression(self):
+        """
+        Test ganon classify with --output-compression
+        """
+        params = self.default_params.copy()
+        params["output_prefix"] = self.results_dir + "output_compression"
+        params["output_one"] = True
+        params["output_all"] = True
+        params["output_unclassified"] = True
+
+        # Build config from params
+        cfg = Config("classify", **params)
+        # Run
+        self.assertTrue(run_ganon(cfg, params["output_prefix"]), "ganon classify exited with an error")
+        # General sanity check of results
+        res = classify_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res, "ganon classify has inconsistent results")
+
+        def sorted_pd(df):
+            return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+        for compression, ext in [("gzip", ".gz"), ("zstd", ".zst")]:
+            params["output_prefix"] = self.results_dir + "output_compression_" + compression
+            params["output_compression"] = compression
+            cfg = Config("classify", **params)
+            self.assertTrue(run_ganon(cfg, params["output_prefix"]), "ganon classify exited with an error")
+
+            # All outputs are compressed, from the classifier (.rep, .all, .unc), reassign (.one) and report (.tre)
+            outputs = ["rep", "all", "unc", "one", "tre"]
+            self.assertTrue(check_files(params["output_prefix"], [o + ext for o in outputs]),
+                            "ganon classify did not write compressed files")
+            self.assertFalse(any(os.path.isfile(params["output_prefix"] + "." + o) for o in outputs),
+                             "ganon classify wrote uncompressed files")
+
+            # Same results
+            self.assertTrue(sorted_pd(res["all_pd"]).equals(sorted_pd(parse_all_one(params["output_prefix"] + ".all" + ext))),
+                            "ganon classify has different .all output with --output-compression")
+            self.assertTrue(sorted_pd(res["one_pd"]).equals(sorted_pd(parse_all_one(params["output_prefix"] + ".one" + ext))),
+                            "ganon classify has different .one output with --output-compression")
+            self.assertTrue(sorted_pd(res["rep_pd"]).equals(sorted_pd(parse_rep(params["output_prefix"] + ".rep" + ext))),
+                            "ganon classify has different .rep output with --output-compression")
+
 if __name__ == '__main__':
     unittest.main()
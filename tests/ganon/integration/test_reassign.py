@@ -1,8 +1,11 @@
 import unittest
 import sys
 import os
+import gzip
+import shutil
 sys.path.append('src')
 from ganon.config import Config
+from ganon.reassign import parse_all, split_unique, collapse_classes
 
 base_dir = "tests/ganon/"
 sys.path.append(base_dir)
@@ -298,6 +301,443 @@ class TestReassign(unittest.TestCase):
         # Check if all reads got properly reported
         self.assertEqual(total_reads_classified, res["rep_pd"]["unique"].fillna(0).astype(int).sum() + res["rep_pd"]["lca"].fillna(0).astype(int).sum(), "ganon reassign reported wrong number of reads")
 
+    def test_low_memory(self):
+        """
+        Test ganon reassign with --low-memory
+        """
+        params_classify = self.default_params_classify.copy()
+        params_classify["output_prefix"] = self.results_dir + "low_memory"
+
+        # Build config from params
+        cfg = Config("classify", **params_classify)
+        self.assertTrue(run_ganon(
+            cfg, params_classify["output_prefix"]), "ganon classify exited with an error")
+        res = classify_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res, "ganon classify has inconsistent results")
+
+        # Reassign in memory
+        params = {"input_prefix": params_classify["output_prefix"],
+                  "output_prefix": params_classify["output_prefix"] + "_reassigned"}
+        cfg = Config("reassign", **params)
+        self.assertTrue(run_ganon(cfg, params["output_prefix"]), "ganon reassign exited with an error")
+        res = reassign_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res, "ganon reassign has inconsistent results")
+
+        # Reassign streaming
+        params_low_memory = {"input_prefix": params_classify["output_prefix"],
+                             "output_prefix": params_classify["output_prefix"] + "_reassigned_low_memory",
+                             "low_memory": True}
+        cfg = Config("reassign", **params_low_memory)
+        self.assertTrue(run_ganon(cfg, params_low_memory["output_prefix"]), "ganon reassign exited with an error")
+        res_low_memory = reassign_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res_low_memory, "ganon reassign has inconsistent results")
+
+        # Same results
+        self.assertTrue(res["one_pd"].equals(res_low_memory["one_pd"]), "ganon reassign --low-memory has different .one output")
+        self.assertTrue(res["rep_pd"].equals(res_low_memory["rep_pd"]), "ganon reassign --low-memory has different .rep output")
+
+    def test_threads(self):
+        """
+        Test ganon reassign with --threads
+        """
+        params_classify = self.default_params_classify.copy()
+        params_classify["output_prefix"] = self.results_dir + "threads"
+
+        # Build config from params
+        cfg = Config("classify", **params_classify)
+        self.assertTrue(run_ganon(
+            cfg, params_classify["output_prefix"]), "ganon classify exited with an error")
+        res = classify_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res, "ganon classify has inconsistent results")
+
+        # Reassign with one thread
+        params = {"input_prefix": params_classify["output_prefix"],
+                  "output_prefix": params_classify["output_prefix"] + "_reassigned"}
+        cfg = Config("reassign", **params)
+        self.assertTrue(run_ganon(cfg, params["output_prefix"]), "ganon reassign exited with an error")
+        res = reassign_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res, "ganon reassign has inconsistent results")
+
+        # Reassign with multiple threads
+        params_threads = {"input_prefix": params_classify["output_prefix"],
+                          "output_prefix": params_classify["output_prefix"] + "_reassigned_threads",
+                          "threads": 4}
+        cfg = Config("reassign", **params_threads)
+        self.assertTrue(run_ganon(cfg, params_threads["output_prefix"]), "ganon reassign exited with an error")
+        res_threads = reassign_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res_threads, "ganon reassign has inconsistent results")
+
+        # Same results
+        self.assertTrue(res["one_pd"].equals(res_threads["one_pd"]), "ganon reassign --threads has different .one output")
+        self.assertTrue(res["rep_pd"].equals(res_threads["rep_pd"]), "ganon reassign --threads has different .rep output")
+
+    def test_em_soft(self):
+        """
+        Test ganon reassign with --em-mode soft
+        """
+        params_classify = self.default_params_classify.copy()
+        params_classify["output_prefix"] = self.results_dir + "em_soft"
+
+        # Build config from params
+        cfg = Config("classify", **params_classify)
+        self.assertTrue(run_ganon(
+            cfg, params_classify["output_prefix"]), "ganon classify exited with an error")
+        res = classify_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res, "ganon classify has inconsistent results")
+        total_reads_classified = res["rep_pd"]["unique"].fillna(0).astype(
+            int).sum() + res["rep_pd"]["lca"].fillna(0).astype(int).sum()
+
+        # Reassign
+        params = {"input_prefix": params_classify["output_prefix"],
+                  "output_prefix": params_classify["output_prefix"] + "_reassigned",
+                  "em_mode": "soft"}
+        cfg = Config("reassign", **params)
+        self.assertTrue(
+            run_ganon(cfg, params["output_prefix"]), "ganon reassign exited with an error")
+        res = reassign_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res, "ganon reassign has inconsistent results")
+        # There are only single matches on output
+        self.assertEqual(len(res["one_pd"].readid), len(
+            res["all_pd"].readid.unique()), "ganon reassign has multiple matches")
+        # Check if all reads got properly reported
+        self.assertEqual(total_reads_classified, res["rep_pd"]["unique"].fillna(0).astype(int).sum(
+        ) + res["rep_pd"]["lca"].fillna(0).astype(int).sum(), "ganon reassign reported wrong number of reads")
+
+    def test_prior(self):
+        """
+        Test ganon reassign with --prior from a previous run (.prob)
+        """
+        params_classify = self.default_params_classify.copy()
+        params_classify["output_prefix"] = self.results_dir + "prior"
+
+        # Build config from params
+        cfg = Config("classify", **params_classify)
+        self.assertTrue(run_ganon(
+            cfg, params_classify["output_prefix"]), "ganon classify exited with an error")
+        res = classify_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res, "ganon classify has inconsistent results")
+        total_reads_classified = res["rep_pd"]["unique"].fillna(0).astype(
+            int).sum() + res["rep_pd"]["lca"].fillna(0).astype(int).sum()
+
+        # Reassign until convergence
+        params = {"input_prefix": params_classify["output_prefix"],
+                  "output_prefix": params_classify["output_prefix"] + "_reassigned",
+                  "max_iter": 1000}
+        cfg = Config("reassign", **params)
+        self.assertTrue(run_ganon(cfg, params["output_prefix"]), "ganon reassign exited with an error")
+        res = reassign_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res, "ganon reassign has inconsistent results")
+        # .prob file created
+        self.assertTrue(check_files(params["output_prefix"], ["prob"]), "ganon reassign did not write .prob")
+
+        # Reassign starting from converged probabilities
+        params_prior = {"input_prefix": params_classify["output_prefix"],
+                        "output_prefix": params_classify["output_prefix"] + "_reassigned_prior",
+                        "max_iter": 1000,
+                        "prior": params["output_prefix"] + ".prob"}
+        cfg = Config("reassign", **params_prior)
+        self.assertTrue(run_ganon(cfg, params_prior["output_prefix"]), "ganon reassign exited with an error")
+        res_prior = reassign_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res_prior, "ganon reassign has inconsistent results")
+
+        # Same results
+        self.assertTrue(res["one_pd"].equals(res_prior["one_pd"]), "ganon reassign --prior has different .one output")
+        self.assertEqual(total_reads_classified, res_prior["rep_pd"]["unique"].fillna(0).astype(int).sum(
+        ) + res_prior["rep_pd"]["lca"].fillna(0).astype(int).sum(), "ganon reassign reported wrong number of reads")
+
+    def test_multiple_input(self):
+        """
+        Test ganon reassign with multiple --input-prefix in parallel
+        """
+        input_prefixes = []
+        for sample in ["multiple_input_a", "multiple_input_b"]:
+            params_classify = self.default_params_classify.copy()
+            params_classify["output_prefix"] = self.results_dir + sample
+
+            # Build config from params
+            cfg = Config("classify", **params_classify)
+            self.assertTrue(run_ganon(
+                cfg, params_classify["output_prefix"]), "ganon classify exited with an error")
+            res = classify_sanity_check_and_parse(vars(cfg))
+            self.assertIsNotNone(res, "ganon classify has inconsistent results")
+            input_prefixes.append(params_classify["output_prefix"])
+
+        # Reassign all samples
+        params = {"input_prefix": input_prefixes,
+                  "output_prefix": self.results_dir + "multiple_input_reassigned_",
+                  "threads": 2}
+        cfg = Config("reassign", **params)
+        self.assertTrue(run_ganon(cfg, params["output_prefix"]), "ganon reassign exited with an error")
+
+        for input_prefix in input_prefixes:
+            # Reassign sample alone
+            params_single = {"input_prefix": input_prefix,
+                             "output_prefix": input_prefix + "_reassigned"}
+            cfg = Config("reassign", **params_single)
+            self.assertTrue(run_ganon(cfg, params_single["output_prefix"]), "ganon reassign exited with an error")
+            res = reassign_sanity_check_and_parse(vars(cfg))
+            self.assertIsNotNone(res, "ganon reassign has inconsistent results")
+
+            # Output of the sample with the base input filename
+            params_multiple = {"input_prefix": [input_prefix],
+                               "output_prefix": params["output_prefix"] + os.path.basename(input_prefix),
+                               "remove_all": False,
+                               "skip_one": False}
+            res_multiple = reassign_sanity_check_and_parse(params_multiple)
+            self.assertIsNotNone(res_multiple, "ganon reassign has inconsistent results")
+
+            # Same results
+            self.assertTrue(res["one_pd"].equals(res_multiple["one_pd"]), "ganon reassign multiple input has different .one output")
+            self.assertTrue(res["rep_pd"].equals(res_multiple["rep_pd"]), "ganon reassign multiple input has different .rep output")
+
+    def test_binary(self):
+        """
+        Test ganon reassign with binary .all from ganon classify --output-binary
+        """
+        res_formats = []
+        for output_binary in [False, True]:
+            params_classify = self.default_params_classify.copy()
+            params_classify["output_prefix"] = self.results_dir + "binary" + ("" if output_binary else "_text")
+            params_classify["output_binary"] = output_binary
+
+            # Build config from params
+            cfg = Config("classify", **params_classify)
+            self.assertTrue(run_ganon(
+                cfg, params_classify["output_prefix"]), "ganon classify exited with an error")
+            res = classify_sanity_check_and_parse(vars(cfg))
+            self.assertIsNotNone(res, "ganon classify has inconsistent results")
+
+            # Reassign
+            params = {"input_prefix": params_classify["output_prefix"],
+                      "output_prefix": params_classify["output_prefix"] + "_reassigned"}
+            cfg = Config("reassign", **params)
+            self.assertTrue(run_ganon(cfg, params["output_prefix"]), "ganon reassign exited with an error")
+            res = reassign_sanity_check_and_parse(vars(cfg))
+            self.assertIsNotNone(res, "ganon reassign has inconsistent results")
+            res_formats.append(res)
+
+        # Same results
+        self.assertTrue(res_formats[0]["all_pd"].equals(res_formats[1]["all_pd"]), "ganon classify --output-binary has different .all output")
+        self.assertTrue(res_formats[0]["one_pd"].equals(res_formats[1]["one_pd"]), "ganon reassign with binary input has different .one output")
+        self.assertTrue(res_formats[0]["rep_pd"].equals(res_formats[1]["rep_pd"]), "ganon reassign with binary input has different .rep output")
+
+    def test_compressed(self):
+        """
+        Test ganon reassign with compressed input and output files
+        """
+        params_classify = self.default_params_classify.copy()
+        params_classify["output_prefix"] = self.results_dir + "compressed"
+
+        # Build config from params
+        cfg = Config("classify", **params_classify)
+        self.assertTrue(run_ganon(
+            cfg, params_classify["output_prefix"]), "ganon classify exited with an error")
+        res = classify_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res, "ganon classify has inconsistent results")
+
+        # Reassign
+        params = {"input_prefix": params_classify["output_prefix"],
+                  "output_prefix": params_classify["output_prefix"] + "_reassigned"}
+        cfg = Config("reassign", **params)
+        self.assertTrue(run_ganon(cfg, params["output_prefix"]), "ganon reassign exited with an error")
+        res = reassign_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res, "ganon reassign has inconsistent results")
+
+        # Compress .all and .rep
+        compressed_prefix = params_classify["output_prefix"] + "_gz"
+        for ext in ["all", "rep"]:
+            with open(params_classify["output_prefix"] + "." + ext, "rb") as f_in, gzip.open(compressed_prefix + "." + ext + ".gz", "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+
+        # Reassign compressed
+        params_compressed = {"input_prefix": compressed_prefix,
+                             "output_prefix": compressed_prefix + "_reassigned",
+                             "output_compression": "gzip"}
+        cfg = Config("reassign", **params_compressed)
+        self.assertTrue(run_ganon(cfg, params_compressed["output_prefix"]), "ganon reassign exited with an error")
+        self.assertTrue(check_files(params_compressed["output_prefix"], ["one.gz", "rep.gz"]), "ganon reassign did not write compressed files")
+
+        # Same results
+        self.assertTrue(res["one_pd"].equals(parse_all_one(params_compressed["output_prefix"] + ".one.gz")), "ganon reassign has different .one output for compressed files")
+        self.assertTrue(res["rep_pd"].equals(parse_rep(params_compressed["output_prefix"] + ".rep.gz")), "ganon reassign has different .rep output for compressed files")
+
+
+class TestReassignEM(unittest.TestCase):
+    """
+    Hard EM on a handcrafted .all file (without databases), checked against known results
+    em.all has 32 reads on 10 targets, 7 of them with unique matches (T1, T2, T5, T6)
+    T7 has no unique matches but gets most reads. T9 has no reads after the first iteration,
+    it is removed from the classes (prune_classes) while being the first match and the one with most k-mers of r26
+    Converges after 12 iterations, in iterations 3 to 5 only part of the classes are re-evaluated (get_active_classes)
+    """
+    results_dir = base_dir + "results/integration/reassign_em/"
+    default_params = {"input_prefix": data_dir + "reassign/em",
+                      "verbose": True,
+                      "quiet": False}
+
+    # Top match of reads with multiple matches
+    one_multi = {"r08": "T7", "r09": "T1", "r10": "T6", "r11": "T7", "r12": "T6", "r13": "T7", "r14": "T2",
+                 "r15": "T7", "r16": "T7", "r17": "T6", "r18": "T5", "r19": "T2", "r20": "T6", "r21": "T2",
+                 "r22": "T7", "r23": "T7", "r24": "T5", "r25": "T7", "r26": "T7", "r27": "T8", "r28": "T2",
+                 "r29": "T7", "r30": "T0", "r31": "T7", "r32": "T8"}
+    # Reassigned reads for each target
+    rep_converged = {"T0": 1, "T1": 2, "T2": 7, "T3": 0, "T4": 0, "T5": 4, "T6": 5, "T7": 11, "T8": 2, "T9": 0}
+    rep_default = {"T0": 1, "T1": 2, "T2": 8, "T3": 0, "T4": 0, "T5": 4, "T6": 5, "T7": 10, "T8": 2, "T9": 0}
+
+    @classmethod
+    def setUpClass(self):
+        setup_dir(self.results_dir)
+
+    def run_reassign(self, output_prefix, max_iter, low_memory):
+        """
+        Run ganon reassign and return top match {readid: (target, count)}, reassigned reads {target: count}
+        and the log
+        """
+        params = self.default_params.copy()
+        params["output_prefix"] = output_prefix
+        params["low_memory"] = low_memory
+        cfg = Config("reassign", **params)
+        # 0 is not passed to the parser by Config
+        cfg.max_iter = max_iter
+        self.assertTrue(run_ganon(cfg, params["output_prefix"]), "ganon reassign exited with an error")
+        res = reassign_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res, "ganon reassign has inconsistent results")
+        one = {r.readid: (r.target, r.count) for r in res["one_pd"].itertuples()}
+        rep = {r.target: int(r.unique) for r in res["rep_pd"].itertuples() if r.hierarchy[0] != "#"}
+        with open(params["output_prefix"] + ".log") as file:
+            log = file.read()
+        return one, rep, log
+
+    def check_one(self, one):
+        all_pd = parse_all_one(self.default_params["input_prefix"] + ".all")
+        self.assertEqual(len(one), all_pd.readid.nunique(), "ganon reassign has wrong number of reads")
+        for readid, matches in all_pd.groupby("readid", sort=False):
+            target, count = one[readid]
+            if len(matches) == 1:
+                self.assertEqual(target, matches.target.iloc[0], "ganon reassign changed a unique match")
+            else:
+                self.assertEqual(target, self.one_multi[readid], "ganon reassign has wrong top match for " + readid)
+            # k-mer count of the assigned match
+            self.assertEqual(count, matches[matches.target == target]["count"].iloc[0])
+
+    def test_max_iter_converged(self):
+        """
+        Test ganon reassign with --max-iter 0 (until convergence), in memory (active set) and --low-memory
+        """
+        for low_memory in [False, True]:
+            one, rep, log = self.run_reassign(self.results_dir + "max_iter_converged_" + str(low_memory), 0, low_memory)
+            self.check_one(one)
+            self.assertEqual(rep, self.rep_converged, "ganon reassign has wrong reassigned reads")
+            self.assertIn(" - Iteration 12 (0.0)", log, "ganon reassign did not converge after 12 iterations")
+            self.assertNotIn(" - Iteration 13 ", log)
+
+    def test_max_iter_default(self):
+        """
+        Test ganon reassign with default --max-iter (10), in memory (active set) and --low-memory
+        """
+        for low_memory in [False, True]:
+            one, rep, log = self.run_reassign(self.results_dir + "max_iter_default_" + str(low_memory), 10, low_memory)
+            self.check_one(one)
+            self.assertEqual(rep, self.rep_default, "ganon reassign has wrong reassigned reads")
+            self.assertIn(" - Iteration 10 ", log)
+            self.assertNotIn(" - Iteration 11 ", log)
+
+    def test_pruned_target(self):
+        """
+        Test ganon reassign with a target without reads after the first iteration (pruned from the classes)
+        """
+        one, rep, _ = self.run_reassign(self.results_dir + "pruned_target", 1, False)
+        self.assertEqual(rep["T9"], 0, "T9 should have no reads after the first iteration")
+        # r26 matches T9 first and with most k-mers, T9 is never the top match
+        self.assertEqual(one["r26"], ("T5", 10), "ganon reassign has wrong top match after the first iteration")
+        one, rep, _ = self.run_reassign(self.results_dir + "pruned_target_converged", 0, False)
+        self.assertEqual(one["r26"], ("T7", 14), "ganon reassign has wrong top match after pruning")
+        self.assertNotIn("T9", [target for target, _ in one.values()])
+
+
+class TestReassignClasses(unittest.TestCase):
+    """
+    Equivalence classes on a handcrafted .all file (without databases)
+    classes.all has 5 reads with unique matches (A, A, B, B, C) and 8 reads with multiple matches.
+    Reads share the same matches with different k-mer counts, in the same or in a different order.
+    A and B keep the same probabilities, ties are solved by the first match of each read
+    """
+    results_dir = base_dir + "results/integration/reassign_classes/"
+    default_params = {"input_prefix": data_dir + "reassign/classes",
+                      "verbose": True,
+                      "quiet": False}
+
+    # Same as reassigning every read individually (without equivalence classes)
+    one = [["u1", "A", 30], ["m1", "A", 20], ["u2", "A", 28], ["m3", "B", 30], ["m5", "A", 20], ["u3", "B", 31],
+           ["m2", "A", 45], ["m7", "A", 25], ["u4", "B", 29], ["m6", "B", 33], ["m4", "B", 12], ["u5", "C", 40],
+           ["m8", "B", 25]]
+    rep = {"A": 6, "B": 6, "C": 1}
+
+    @classmethod
+    def setUpClass(self):
+        setup_dir(self.results_dir)
+
+    def test_collapse_classes(self):
+        """
+        Test split_unique and collapse_classes on the parsed .all file
+        """
+        targets, read_ids, offsets, target_ids, kcounts = parse_all(self.default_params["input_prefix"] + ".all")
+        self.assertEqual(list(targets), ["A", "B", "C"])
+        initial_weight, multi_offsets, multi_target_ids = split_unique(offsets, target_ids, len(targets))
+        self.assertEqual(initial_weight.tolist(), [2, 2, 1])
+        self.assertEqual(len(multi_offsets)-1, 8)
+
+        class_offsets, class_target_ids, class_weights = collapse_classes(multi_offsets, multi_target_ids)
+        targets_rev = list(targets)
+        classes = {tuple(targets_rev[t] for t in class_target_ids[class_offsets[i]:class_offsets[i+1]]): int(w)
+                   for i, w in enumerate(class_weights)}
+        # Order of the matches is kept, reads with the same matches in a different order are in different classes
+        self.assertEqual(classes, {("A", "B"): 2, ("B", "A"): 2, ("C", "A"): 1, ("C", "B"): 1,
+                                   ("A", "B", "C"): 1, ("B", "A", "C"): 1})
+
+    def test_one(self):
+        """
+        Test ganon reassign with equivalence classes, in memory, --low-memory and --threads
+        """
+        for name, extra_params in [("memory", {}), ("low_memory", {"low_memory": True}), ("threads", {"threads": 2})]:
+            params = self.default_params.copy()
+            params.update(extra_params)
+            params["output_prefix"] = self.results_dir + name
+            cfg = Config("reassign", **params)
+            self.assertTrue(run_ganon(cfg, params["output_prefix"]), "ganon reassign exited with an error")
+            res = reassign_sanity_check_and_parse(vars(cfg))
+            self.assertIsNotNone(res, "ganon reassign has inconsistent results")
+
+            with open(params["output_prefix"] + ".log") as file:
+                self.assertIn(" - 8 reads with multiple matches in 6 equivalence classes", file.read())
+            self.assertEqual(res["one_pd"].values.tolist(), self.one, "ganon reassign has wrong .one output")
+            rep = {r.target: int(r.unique) for r in res["rep_pd"].itertuples() if r.hierarchy[0] != "#"}
+            self.assertEqual(rep, self.rep, "ganon reassign has wrong .rep output")
+
+    def test_duplicate_output_prefix(self):
+        """
+        Test ganon reassign with multiple inputs with the same name, fails before writing outputs
+        """
+        input_prefixes = []
+        for folder in ["duplicate1/", "duplicate2/"]:
+            os.makedirs(self.results_dir + folder)
+            for ext in [".all", ".rep"]:
+                shutil.copy(self.default_params["input_prefix"] + ext, self.results_dir + folder + "classes" + ext)
+            input_prefixes.append(self.results_dir + folder + "classes")
+
+        for name, input_prefix in [("folders", input_prefixes), ("repeated", [input_prefixes[0]] * 2)]:
+            for threads in [1, 2]:
+                params = self.default_params.copy()
+                params["input_prefix"] = input_prefix
+                params["threads"] = threads
+                params["output_prefix"] = self.results_dir + "duplicate_" + name + "_" + str(threads) + "_"
+                cfg = Config("reassign", **params)
+                self.assertFalse(run_ganon(cfg, params["output_prefix"]), "ganon reassign did not fail with duplicated outputs")
+                with open(params["output_prefix"] + ".log") as file:
+                    self.assertIn("have the same output prefix " + params["output_prefix"] + "classes", file.read())
+                for ext in [".one", ".rep", ".prob"]:
+                    self.assertFalse(os.path.isfile(params["output_prefix"] + "classes" + ext), "ganon reassign wrote outputs")
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -4,11 +4,24 @@ from utils import report_sanity_check_and_parse
 from utils import build_sanity_check_and_parse
 from utils import classify_sanity_check_and_parse
 from utils import list_files_folder
+from utils import table_sanity_check_and_parse
+from utils import parse_tre
 from ganon.config import Config
+from ganon.report import parse_rep, filter_tax, merge_reports, remove_hierarchy
+from ganon.tax_index import TaxIndex
+from ganon.tax_util import get_genome_size
+from ganon.tax_cache import CompiledTx, load_tax
+from ganon.util import open_file
+from ganon import api
+from multitax import NcbiTx, CustomTx
+from copy import copy, deepcopy
 from math import ceil
 import unittest
 import sys
 import shutil
+import os
+import pickle
+import numpy as np
 sys.path.append('src')
 
 base_dir = "tests/ganon/"
@@ -483,6 +496,88 @@ class TestReport(unittest.TestCase):
         self.assertEqual(len(res), len(
             params["input"]), "ganon report did not generate multiple report files")
 
+    def test_report_cache(self):
+        """
+        Test run with --report-cache, re-using cached reports with different filters
+        """
+        for min_count in [0, 15]:
+            params = self.default_params.copy()
+            params["min_count"] = min_count
+            params["output_prefix"] = self.results_dir + "test_report_cache_" + str(min_count)
+            cfg = Config("report", **params)
+            self.assertTrue(
+                run_ganon(cfg, params["output_prefix"]), "ganon report exited with an error")
+
+            # Run twice, first to write and then to read the cache
+            for run in ["write", "read"]:
+                params["output_prefix"] = self.results_dir + "test_report_cache_" + run + str(min_count)
+                params["report_cache"] = self.results_dir + "test_report_cache/"
+                cfg = Config("report", **params)
+                self.assertTrue(
+                    run_ganon(cfg, params["output_prefix"]), "ganon report exited with an error")
+                res = report_sanity_check_and_parse(vars(cfg))
+                self.assertIsNotNone(res, "ganon report has inconsistent results")
+                with open(self.results_dir + "test_report_cache_" + str(min_count) + ".tre") as file1, open(params["output_prefix"] + ".tre") as file2:
+                    self.assertEqual(file1.read(), file2.read(), "ganon report with --report-cache has different results")
+
+    def test_table_rep_files(self):
+        """
+        Test ganon table with rep files as input, should be the same as ganon table on the reports
+        """
+        params = self.default_params.copy()
+        params["input"] = [self.results_dir + "base_classify.rep",
+                           self.results_dir + "base_classify2.rep"]
+        params["output_prefix"] = self.results_dir + "test_table_rep_files_"
+        cfg = Config("report", **params)
+        self.assertTrue(
+            run_ganon(cfg, params["output_prefix"]), "ganon report exited with an error")
+
+        table_params = {"input": [params["output_prefix"] + "base_classify.tre",
+                                  params["output_prefix"] + "base_classify2.tre"],
+                        "output_file": self.results_dir + "test_table_rep_files_tre.tsv",
+                        "rank": "species",
+                        "verbose": True,
+                        "quiet": False}
+        cfg = Config("table", **table_params)
+        self.assertTrue(run_ganon(cfg, table_params["output_file"]), "ganon table exited with an error")
+        self.assertIsNotNone(table_sanity_check_and_parse(vars(cfg)), "ganon table has inconsistent results")
+
+        table_params["input"] = params["input"]
+        table_params["db_prefix"] = params["db_prefix"]
+        table_params["output_file"] = self.results_dir + "test_table_rep_files_rep.tsv"
+        cfg = Config("table", **table_params)
+        self.assertTrue(run_ganon(cfg, table_params["output_file"]), "ganon table exited with an error")
+        self.assertIsNotNone(table_sanity_check_and_parse(vars(cfg)), "ganon table has inconsistent results")
+
+        # Same table, labels are the input files
+        with open(self.results_dir + "test_table_rep_files_tre.tsv") as file:
+            tre_table = file.read().replace("test_table_rep_files_", "").replace(".tre", ".rep")
+        with open(self.results_dir + "test_table_rep_files_rep.tsv") as file:
+            rep_table = file.read()
+        self.assertEqual(tre_table, rep_table, "ganon table with .rep files differs from .tre files")
+
+    def test_multiple_rep_files_threads(self):
+        """
+        Test run with multiple rep files in parallel, should be the same as serial
+        """
+        params = self.default_params.copy()
+        params["input"] = [self.results_dir + "base_classify.rep",
+                           self.results_dir + "base_classify2.rep"]
+        params["split_hierarchy"] = True
+        for threads in [1, 2]:
+            params["output_prefix"] = self.results_dir + "test_multiple_rep_files_threads" + str(threads) + "_"
+            params["threads"] = threads
+            cfg = Config("report", **params)
+            self.assertTrue(
+                run_ganon(cfg, params["output_prefix"]), "ganon report exited with an error")
+            res = report_sanity_check_and_parse(vars(cfg))
+            self.assertIsNotNone(res, "ganon report has inconsistent results")
+
+        for file in list_files_folder(self.results_dir, ext=".tre"):
+            if "test_multiple_rep_files_threads1_" in file:
+                with open(file) as file1, open(file.replace("threads1_", "threads2_")) as file2:
+                    self.assertEqual(file1.read(), file2.read(), "ganon report with --threads has different results")
+
     def test_multiple_rep_files_folder(self):
         """
         Test run with multiple rep files as input
@@ -843,5 +938,480 @@ class TestReport(unittest.TestCase):
                         "ganon report inconsistend on bioboxes output format")
 
 
+    def test_output_format_multiple(self):
+        """
+        Test run with multiple --output-format, should be the same as single runs
+        """
+        params = self.default_params.copy()
+        params["output_prefix"] = self.results_dir + "test_output_format_multiple"
+        params["output_format"] = ["tsv", "text", "bioboxes"]
+        cfg = Config("report", **params)
+        self.assertTrue(
+            run_ganon(cfg, params["output_prefix"]), "ganon report exited with an error")
+
+        for output_format in params["output_format"]:
+            single_params = self.default_params.copy()
+            single_params["output_prefix"] = self.results_dir + "test_output_format_multiple_single_" + output_format
+            single_params["output_format"] = output_format
+            cfg = Config("report", **single_params)
+            self.assertTrue(
+                run_ganon(cfg, single_params["output_prefix"]), "ganon report exited with an error")
+            with open(single_params["output_prefix"] + ".tre") as file1, open(params["output_prefix"] + "." + output_format + ".tre") as file2:
+                self.assertEqual(file1.read(), file2.read(), "ganon report with multiple --output-format has different results")
+
+    def test_api(self):
+        """
+        Test in-process report and table from parsed .rep entries, should be the same as the output files
+        """
+        params = self.default_params.copy()
+        params["output_prefix"] = self.results_dir + "test_api"
+        params["ranks"] = ["species", "genus"]
+        cfg = Config("report", **params)
+        self.assertTrue(
+            run_ganon(cfg, params["output_prefix"]), "ganon report exited with an error")
+
+        tax, genome_sizes = api.load_taxonomy(db_prefix=params["db_prefix"])
+        reports, counts = parse_rep(params["input"], False)
+        rep = api.report(reports, counts, tax, genome_sizes, ranks=params["ranks"])
+        tre = parse_tre(params["output_prefix"] + ".tre")
+        self.assertEqual(rep[["rank", "target", "lineage", "name"]].values.tolist(),
+                         tre[["rank", "target", "lineage", "name"]].values.tolist(), "api report has different entries")
+        self.assertEqual(rep["cumulative"].astype(int).tolist(), tre["cumulative"].tolist(), "api report has different counts")
+
+        table_params = {"input": params["input"],
+                        "db_prefix": params["db_prefix"],
+                        "output_file": self.results_dir + "test_api.tsv",
+                        "rank": "species",
+                        "transpose": True,
+                        "quiet": True}
+        cfg = Config("table", **table_params)
+        self.assertTrue(run_ganon(cfg, table_params["output_file"]), "ganon table exited with an error")
+        table = api.table({params["input"]: (reports, counts)}, tax, genome_sizes, rank="species", transpose=True)
+        with open(table_params["output_file"]) as file:
+            self.assertEqual(table.to_csv(sep="\t"), file.read(), "api table differs from ganon table")
+
+
+class TestFilterTax(unittest.TestCase):
+    """
+    Check the filtered view of the taxonomy used in the reports against multitax filter on a copy
+    """
+    tax_args = {"undefined_node": "",
+                "undefined_rank": "na",
+                "undefined_name": "na",
+                "root_rank": "root",
+                "root_name": "root"}
+
+    @classmethod
+    def setUpClass(self):
+        self.full_tax = NcbiTx(files=data_dir + "build-custom/taxdump.tar.gz", **self.tax_args)
+
+    def test_filter_tax(self):
+        """
+        Test filter_tax with the targets of reports with --skip-hierarchy and --keep-hierarchy, full taxonomy is not modified
+        """
+        full_stats = self.full_tax.stats()
+        entry = {"direct_matches": 1, "unique_reads": 1, "lca_reads": 0}
+        for skip, keep in [(["B"], []), ([], ["A", "B"]), ([], ["C"])]:
+            reports = {"A": {"871271": entry, "1972133": entry, "2": entry},
+                       "B": {"2599936": entry, "2012515": entry},
+                       "C": {"1801617": entry, "1224": entry, "2608262": entry, "not_a_node": entry}}
+            counts = {h: {"reads": len(r), "matches": len(r)} for h, r in reports.items()}
+            reports = remove_hierarchy(reports, counts, skip, keep, True)
+            nodes = list(merge_reports(reports).keys())
+
+            tax = filter_tax(self.full_tax, nodes)
+            expected_tax = deepcopy(self.full_tax)
+            expected_tax.filter(nodes)
+            self.assertEqual(tax.stats(), expected_tax.stats(), "filter_tax differs from multitax filter")
+            self.assertEqual(sorted(tax.leaves()), sorted(expected_tax.leaves()), "filter_tax differs from multitax filter")
+            for leaf in expected_tax.leaves():
+                self.assertEqual(tax.lineage(leaf), expected_tax.lineage(leaf))
+                self.assertEqual(tax.name_lineage(leaf), expected_tax.name_lineage(leaf))
+                self.assertEqual(tax.rank_lineage(leaf), expected_tax.rank_lineage(leaf))
+
+            # Orphan nodes are added only to the view
+            tax.add("not_a_node", tax.root_node)
+            self.assertEqual(tax.parent("not_a_node"), tax.root_node)
+            self.assertEqual(self.full_tax.parent("not_a_node"), self.full_tax.undefined_node, "filter_tax changed the full taxonomy")
+            self.assertEqual(self.full_tax.stats(), full_stats, "filter_tax changed the full taxonomy")
+
+
+class TestTaxIndex(unittest.TestCase):
+    """
+    Check TaxIndex against the multitax methods it replaces in the reports
+    """
+    tax_args = {"undefined_node": "",
+                "undefined_rank": "na",
+                "undefined_name": "na",
+                "root_rank": "root",
+                "root_name": "root"}
+    # Default ranks, ranks shared by nodes in the same lineage (clade) and ranks not in the taxonomy
+    ranks = [["root"] + Config.choices_default_ranks,
+             ["clade", "species", "strain"],
+             ["no rank", "genus", "forma specialis", "subspecies"]]
+    subtrees = ["1236", "1783276", "884214", "1971485", "not_a_node"]
+
+    @classmethod
+    def setUpClass(self):
+        self.full_tax = NcbiTx(files=data_dir + "build-custom/taxdump.tar.gz", **self.tax_args)
+
+    def check_tax_index(self, tax):
+        ti = TaxIndex(tax)
+        idx = np.arange(len(ti.nodes))
+        for ranks in self.ranks:
+            lineages = ti.ranked_lineages(ranks)
+            closest_parents = ti.closest_parent(ranks)
+            for i, node in enumerate(ti.nodes):
+                self.assertEqual(ti.get_nodes(lineages[i]), tax.lineage(node, ranks=ranks),
+                                 "ranked_lineages differs from tax.lineage for " + node)
+                self.assertEqual(ti.get_nodes([closest_parents[i]])[0], tax.closest_parent(node, ranks=ranks),
+                                 "closest_parent differs from tax.closest_parent for " + node)
+
+            # Lineages cut before the closest parent (as in the genome size correction)
+            pos, lin = ti.lineage_pairs(idx, stop=closest_parents)
+            for i, node in enumerate(ti.nodes):
+                stop = ti.get_nodes([closest_parents[i]])[0]
+                self.assertEqual(ti.get_nodes(lin[pos == i]), tax.lineage(node, root_node=stop)[1:] if stop else tax.lineage(node),
+                                 "lineage_pairs with stop differs from tax.lineage for " + node)
+
+        pos, lin = ti.lineage_pairs(idx)
+        in_subtrees = ti.in_subtrees(self.subtrees, idx)
+        for i, node in enumerate(ti.nodes):
+            self.assertEqual(ti.get_nodes(lin[pos == i]), tax.lineage(node),
+                             "lineage_pairs differs from tax.lineage for " + node)
+            self.assertEqual(in_subtrees[i], any(n in tax.lineage(node) for n in self.subtrees),
+                             "in_subtrees differs from tax.lineage for " + node)
+
+    def test_full(self):
+        """
+        Test TaxIndex on the full taxonomy
+        """
+        self.check_tax_index(self.full_tax)
+
+    def test_hierarchy(self):
+        """
+        Test TaxIndex on the taxonomy filtered by the targets of a report with --skip-hierarchy and --keep-hierarchy
+        """
+        entry = {"direct_matches": 1, "unique_reads": 1, "lca_reads": 0}
+        for skip, keep in [(["B"], []), ([], ["A", "B"]), ([], ["C"])]:
+            reports = {"A": {"871271": entry, "1972133": entry, "2": entry},
+                       "B": {"2599936": entry, "2012515": entry},
+                       "C": {"1801617": entry, "1224": entry, "2608262": entry}}
+            counts = {h: {"reads": len(r), "matches": len(r)} for h, r in reports.items()}
+            reports = remove_hierarchy(reports, counts, skip, keep, True)
+            tax = filter_tax(self.full_tax, merge_reports(reports).keys())
+            self.check_tax_index(tax)
+
+    def test_multitax_version(self):
+        """
+        Test TaxIndex with a multitax taxonomy without the private attributes it uses
+        """
+        tax = copy(self.full_tax)
+        del tax._nodes
+        with self.assertRaises(ImportError):
+            TaxIndex(tax)
+
+
+class TestGenomeSize(unittest.TestCase):
+    """
+    Genome size estimation on the test NCBI taxonomy with species_genome_size.txt.gz (without downloads)
+    Sizes of leaves are averaged for each node of the lineages, nodes without estimate take the closest parent value
+    """
+    results_dir = base_dir + "results/integration/report_genome_size/"
+    tax_args = {"undefined_node": "",
+                "undefined_rank": "na",
+                "undefined_name": "na",
+                "root_rank": "root",
+                "root_name": "root"}
+    default_params = {"input": results_dir,
+                      "output_prefix": results_dir + "genome_size",
+                      "taxonomy": "ncbi",
+                      "taxonomy_files": data_dir + "build-custom/taxdump.tar.gz",
+                      "genome_size_files": data_dir + "build-custom/species_genome_size.txt.gz",
+                      "quiet": True}
+
+    # Same values and order as estimated before the single-pass implementation
+    leaves = [("1", 4222504), ("131567", 4222504), ("2157", 4433629), ("1783276", 4433629), ("1801631", 4926255),
+              ("2490204", 4926255), ("1920749", 4926255), ("2", 3941004), ("1224", 3941004), ("1236", 5418880),
+              ("118884", 7882008), ("204619", 7882008), ("1971485", 7882008), ("1972133", 7882008),
+              ("1801617", 1970502), ("2012515", 1970502), ("1462430", 6896757), ("2856052", 6896757),
+              ("2856053", 6896757), ("2856054", 6896757), ("2856051", 6896757), ("2565781", 6896757),
+              ("2565780", 3941004), ("2599936", 3941004), ("91347", 2955753), ("543", 2955753), ("191675", 2955753),
+              ("84563", 2955753), ("2608261", 2955753), ("2608262", 2955753), ("28216", 985251), ("80840", 985251),
+              ("75682", 985251), ("884214", 985251), ("884215", 985251), ("871271", 985251)]
+    nodes = [("1", 4222504), ("131567", 4222504), ("2", 3941004), ("1224", 3941004), ("28216", 985251),
+             ("80840", 985251), ("75682", 985251), ("884214", 985251), ("884215", 985251), ("871271", 985251),
+             ("2157", 4433629), ("1783276", 4433629), ("2565780", 3941004), ("2599936", 3941004)]
+
+    @classmethod
+    def setUpClass(self):
+        setup_dir(self.results_dir)
+        self.tax = NcbiTx(files=self.default_params["taxonomy_files"], **self.tax_args)
+
+    def test_genome_size(self):
+        """
+        Test get_genome_size for all leaves and for some nodes (lineages only)
+        """
+        cfg = Config("report", **self.default_params)
+        genome_sizes = get_genome_size(cfg, sorted(self.tax.leaves()), self.tax, self.results_dir)
+        self.assertEqual(list(genome_sizes.items()), self.leaves, "get_genome_size has wrong estimates")
+        genome_sizes = get_genome_size(cfg, ["871271", "2599936", "1224"], self.tax, self.results_dir)
+        self.assertEqual(list(genome_sizes.items()), self.nodes, "get_genome_size has wrong estimates")
+
+    def test_skip_genome_size(self):
+        """
+        Test get_genome_size with --skip-genome-size, all nodes of the lineages with size 1
+        """
+        params = self.default_params.copy()
+        params["skip_genome_size"] = True
+        cfg = Config("report", **params)
+        genome_sizes = get_genome_size(cfg, ["871271", "2599936", "1224"], self.tax, self.results_dir)
+        self.assertEqual(list(genome_sizes.items()), [(node, 1) for node, _ in self.nodes])
+
+
+class TestReportTaxonomy(unittest.TestCase):
+    """
+    Reports of .rep files with a taxonomy (--taxonomy-files), without databases
+    """
+    results_dir = base_dir + "results/integration/report_taxonomy/"
+    default_params = {"input": data_dir + "report/sample1.rep",
+                      "taxonomy": "ncbi",
+                      "taxonomy_files": data_dir + "build-custom/taxdump.tar.gz",
+                      "genome_size_files": data_dir + "build-custom/species_genome_size.txt.gz",
+                      "verbose": True,
+                      "quiet": False}
+
+    @classmethod
+    def setUpClass(self):
+        setup_dir(self.results_dir)
+
+    def test_taxonomy_cache(self):
+        """
+        Test run with --taxonomy-cache, names of nodes out of the lineages of the reported targets should not be read
+        """
+        params = self.default_params.copy()
+        params["output_prefix"] = self.results_dir + "test_taxonomy_cache"
+        cfg = Config("report", **params)
+        self.assertTrue(
+            run_ganon(cfg, params["output_prefix"]), "ganon report exited with an error")
+        res = report_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res, "ganon report has inconsistent results")
+
+        # Run twice, first to compile and then to load the taxonomy
+        params["taxonomy_cache"] = self.results_dir + "test_taxonomy_cache/"
+        for run in ["write", "read"]:
+            params["output_prefix"] = self.results_dir + "test_taxonomy_cache_" + run
+            cfg = Config("report", **params)
+            self.assertTrue(
+                run_ganon(cfg, params["output_prefix"]), "ganon report exited with an error")
+            with open(self.results_dir + "test_taxonomy_cache.tre") as file1, open(params["output_prefix"] + ".tre") as file2:
+                self.assertEqual(file1.read(), file2.read(), "ganon report with --taxonomy-cache has different results")
+
+            if run == "write":
+                # Replace names of other nodes with invalid characters, reading any of them fails
+                folder = params["taxonomy_cache"] + os.listdir(params["taxonomy_cache"])[0]
+                ctx = CompiledTx(folder)
+                reports, _ = parse_rep(params["input"], False)
+                used = ctx.lookup([node for h in reports for target in reports[h] for node in ctx.lineage(target)])
+                unused = np.setdiff1d(np.arange(len(ctx.nodes)), used)
+                with open(folder + "/names.bin", "r+b") as file:
+                    for start, end in ctx.name_pos[unused].tolist():
+                        file.seek(start)
+                        file.write(b"\xff" * (end - start))
+                with self.assertRaises(UnicodeDecodeError):
+                    CompiledTx(folder).get_names(unused)
+
+    def test_taxonomy_cache_changes(self):
+        """
+        Test --taxonomy-cache after changing the content of the taxonomy file (same size and modification time)
+        """
+        tax_file = self.results_dir + "test_taxonomy_cache_changes.tsv"
+        cache_folder = self.results_dir + "test_taxonomy_cache_changes/"
+        names = []
+        for name in ["A", "B"]:
+            st = os.stat(tax_file) if os.path.isfile(tax_file) else None
+            with open(tax_file, "w") as file:
+                file.write("1\t1\tno rank\troot\n2\t1\tspecies\t" + name + "\n")
+            if st:
+                os.utime(tax_file, ns=(st.st_atime_ns, st.st_mtime_ns))
+            names.append(load_tax(CustomTx, [tax_file], cache_folder, True).name("2"))
+
+        self.assertEqual(names, ["A", "B"], "compiled taxonomy re-used after changing the taxonomy file")
+        self.assertEqual(len(os.listdir(cache_folder)), 2, "ganon did not compile the changed taxonomy")
+
+    def test_output_compression(self):
+        """
+        Test run with --output-compression, compressed .tre with the same content
+        """
+        params = self.default_params.copy()
+        params["output_prefix"] = self.results_dir + "test_output_compression"
+        cfg = Config("report", **params)
+        self.assertTrue(
+            run_ganon(cfg, params["output_prefix"]), "ganon report exited with an error")
+
+        for compression, ext, magic in [("gzip", ".gz", b"\x1f\x8b"), ("zstd", ".zst", b"\x28\xb5\x2f\xfd")]:
+            params["output_prefix"] = self.results_dir + "test_output_compression_" + compression
+            params["output_compression"] = compression
+            cfg = Config("report", **params)
+            self.assertTrue(
+                run_ganon(cfg, params["output_prefix"]), "ganon report exited with an error")
+            self.assertFalse(os.path.isfile(params["output_prefix"] + ".tre"))
+            with open(params["output_prefix"] + ".tre" + ext, "rb") as file:
+                self.assertEqual(file.read(len(magic)), magic, "ganon report did not compress the output")
+            with open(self.results_dir + "test_output_compression.tre") as file1, open_file(params["output_prefix"] + ".tre" + ext) as file2:
+                self.assertEqual(file1.read(), file2.read(), "ganon report with --output-compression has different results")
+
+    def test_report_cache_changes(self):
+        """
+        Test run with --report-cache, cached reports are not re-used after changing the .rep, --normalize or --skip-hierarchy
+        """
+        params = self.default_params.copy()
+        params["input"] = self.results_dir + "test_report_cache_changes.rep"
+        params["report_cache"] = self.results_dir + "test_report_cache_changes/"
+        shutil.copy(data_dir + "report/sample1.rep", params["input"])
+
+        # Cache of the original .rep without options
+        params["output_prefix"] = self.results_dir + "test_report_cache_changes"
+        cfg = Config("report", **params)
+        self.assertTrue(
+            run_ganon(cfg, params["output_prefix"]), "ganon report exited with an error")
+
+        changes = {"normalize": {"normalize": True},
+                   "skip_hierarchy": {"skip_hierarchy": ["B"]},
+                   "rep": {}}
+        for change, change_params in changes.items():
+            if change == "rep":
+                with open(data_dir + "report/sample1.rep") as file, open(params["input"], "w") as out:
+                    out.write(file.read().replace("A\t871271\t100\t40\t", "A\t871271\t100\t20\t")
+                                         .replace("#total_classified\t135", "#total_classified\t115"))
+
+            # Expected results without cache
+            params_change = {**params, **change_params}
+            del params_change["report_cache"]
+            params_change["output_prefix"] = self.results_dir + "test_report_cache_changes_" + change
+            cfg = Config("report", **params_change)
+            self.assertTrue(
+                run_ganon(cfg, params_change["output_prefix"]), "ganon report exited with an error")
+
+            params_change = {**params, **change_params}
+            params_change["output_prefix"] = self.results_dir + "test_report_cache_changes_cached_" + change
+            cfg = Config("report", **params_change)
+            self.assertTrue(
+                run_ganon(cfg, params_change["output_prefix"]), "ganon report exited with an error")
+            with open(params_change["output_prefix"] + ".log") as file:
+                self.assertNotIn("cached report loaded", file.read(), "ganon report re-used the cache after changing " + change)
+            with open(self.results_dir + "test_report_cache_changes_" + change + ".tre") as file1, open(params_change["output_prefix"] + ".tre") as file2, open(params["output_prefix"] + ".tre") as file3:
+                tre = file2.read()
+                self.assertEqual(file1.read(), tre, "ganon report with --report-cache has different results after changing " + change)
+                self.assertNotEqual(file3.read(), tre, "ganon report has the same results after changing " + change)
+
+        # Original .rep, options and the new cached one
+        self.assertEqual(len(os.listdir(params["report_cache"])), 4, "ganon report did not write a cache for each change")
+
+    def test_report_cache_invalid(self):
+        """
+        Test run with an invalid --report-cache file, report is built again (with a warning) and the cache replaced
+        """
+        params = self.default_params.copy()
+        params["output_prefix"] = self.results_dir + "test_report_cache_invalid"
+        cfg = Config("report", **params)
+        self.assertTrue(
+            run_ganon(cfg, params["output_prefix"]), "ganon report exited with an error")
+
+        params["report_cache"] = self.results_dir + "test_report_cache_invalid/"
+        for invalid in ["write", "truncated", "garbage", "incompatible"]:
+            if invalid != "write":
+                cache_file = params["report_cache"] + os.listdir(params["report_cache"])[0]
+                with open(cache_file, "r+b") as file:
+                    if invalid == "truncated":
+                        file.truncate(os.path.getsize(cache_file) // 2)
+                    elif invalid == "incompatible":
+                        # Valid pickle referencing a function not available (AttributeError)
+                        file.truncate(0)
+                        file.write(b"cganon.report\nmissing_function\n.")
+                    else:
+                        file.write(b"\x00" * 16)
+            params["output_prefix"] = self.results_dir + "test_report_cache_invalid_" + invalid
+            cfg = Config("report", **params)
+            self.assertTrue(
+                run_ganon(cfg, params["output_prefix"]), "ganon report exited with an error")
+            with open(params["output_prefix"] + ".log") as file:
+                log = file.read()
+                self.assertEqual(invalid != "write", "WARNING: could not read report cache" in log)
+            with open(self.results_dir + "test_report_cache_invalid.tre") as file1, open(params["output_prefix"] + ".tre") as file2:
+                self.assertEqual(file1.read(), file2.read(), "ganon report with an invalid --report-cache has different results")
+
+        # Cache written again and re-used
+        params["output_prefix"] = self.results_dir + "test_report_cache_invalid_read"
+        cfg = Config("report", **params)
+        self.assertTrue(
+            run_ganon(cfg, params["output_prefix"]), "ganon report exited with an error")
+        with open(params["output_prefix"] + ".log") as file:
+            self.assertIn("cached report loaded", file.read(), "ganon report did not re-use the cache")
+        # Only entries are cached, without the taxonomy
+        with open(params["report_cache"] + os.listdir(params["report_cache"])[0], "rb") as file:
+            for _, tree in pickle.load(file):
+                self.assertNotIn("tax", tree)
+                self.assertNotIn("ti", tree)
+
+    def test_threads(self):
+        """
+        Test run with --threads for several .rep files, same reports as with one thread
+        """
+        params = self.default_params.copy()
+        params["input"] = [data_dir + "report/sample1.rep",
+                           data_dir + "report/sample2.rep",
+                           data_dir + "report/sample3.rep"]
+        params["input_extension"] = ".rep"
+
+        for split_hierarchy in [False, True]:
+            params["split_hierarchy"] = split_hierarchy
+            outputs = {}
+            saved = {}
+            for threads in [1, 2, 3]:
+                params["threads"] = threads
+                params["output_prefix"] = self.results_dir + "test_threads_" + \
+                    ("split_" if split_hierarchy else "") + str(threads) + "_"
+                cfg = Config("report", **params)
+                self.assertTrue(
+                    run_ganon(cfg, params["output_prefix"]), "ganon report exited with an error")
+                # Reports logged in the same order as with one thread
+                with open(params["output_prefix"] + ".log") as file:
+                    saved[threads] = [line.split(params["output_prefix"])[1] for line in file if "report saved to" in line]
+                outputs[threads] = {}
+                for file in sorted(os.listdir(self.results_dir)):
+                    if file.startswith(os.path.basename(params["output_prefix"])) and file.endswith(".tre"):
+                        with open(self.results_dir + file, "rb") as f:
+                            outputs[threads][file[len(os.path.basename(params["output_prefix"])):]] = f.read()
+
+            # One report per file (and per hierarchy with --split-hierarchy)
+            self.assertEqual(len(outputs[1]), 6 if split_hierarchy else 3, "ganon report did not write all reports")
+            for threads in [2, 3]:
+                self.assertEqual(outputs[1], outputs[threads],
+                                 "ganon report with --threads " + str(threads) + " has different results")
+                self.assertEqual(saved[1], saved[threads],
+                                 "ganon report with --threads " + str(threads) + " has a different order")
+
+    def test_threads_error(self):
+        """
+        Test run with --threads and an invalid .rep file among others, run fails as with one thread
+        """
+        invalid_rep = self.results_dir + "test_threads_error.rep"
+        with open(data_dir + "report/sample2.rep") as file, open(invalid_rep, "w") as out:
+            out.write(file.read().replace("\t80\t", "\tinvalid\t"))
+
+        params = self.default_params.copy()
+        params["input"] = [data_dir + "report/sample1.rep",
+                           invalid_rep,
+                           data_dir + "report/sample3.rep"]
+        params["input_extension"] = ".rep"
+        for threads in [1, 3]:
+            params["threads"] = threads
+            params["output_prefix"] = self.results_dir + "test_threads_error_" + str(threads) + "_"
+            cfg = Config("report", **params)
+            with self.assertRaises(ValueError):
+                run_ganon(cfg, params["output_prefix"])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,8 @@
 import unittest
 import sys
+import os
+import gzip
+import shutil
 sys.path.append('src')
 from ganon.config import Config
 
@@ -76,6 +79,65 @@ class TestTable(unittest.TestCase):
         # should output just bacteria
         self.assertEqual(res["out_pd"].columns.values.size, 1, "ganon table rank selection failed")
 
+    def test_multiple_ranks(self):
+        """
+        Test ganon table with several --rank in one table
+        """
+        params = self.default_params.copy()
+        params["output_file"] = self.results_dir + "test_multiple_ranks.tsv"
+        params["rank"] = ["superkingdom", "phylum"]
+        params["header"] = "lineage"
+
+        cfg = Config("table", **params)
+        self.assertTrue(run_ganon(cfg, params["output_file"]), "ganon table exited with an error")
+        res = table_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res, "ganon table has inconsistent results")
+        # only selected ranks, without root
+        self.assertTrue(all([len(c.split("|")) in [2, 3] for c in res["out_pd"].columns.values]), "ganon table multiple ranks failed")
+        self.assertTrue("1|2" in res["out_pd"].columns.values, "ganon table multiple ranks failed")
+
+        # Counts are not repeated among ranks, same total as superkingdom alone
+        params["output_file"] = self.results_dir + "test_multiple_ranks_superkingdom.tsv"
+        params["rank"] = "superkingdom"
+        cfg = Config("table", **params)
+        self.assertTrue(run_ganon(cfg, params["output_file"]), "ganon table exited with an error")
+        res_superkingdom = table_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res_superkingdom, "ganon table has inconsistent results")
+        self.assertEqual(res["out_pd"].sum().sum(), res_superkingdom["out_pd"].sum().sum(), "ganon table multiple ranks failed")
+
+    def test_split_rank(self):
+        """
+        Test ganon table with --split-rank, one table for each rank
+        """
+        params = self.default_params.copy()
+        params["output_file"] = self.results_dir + "test_split_rank.tsv"
+        params["rank"] = ["phylum", "species"]
+        params["split_rank"] = True
+        params["min_count"] = 0.01
+
+        split_cfg = Config("table", **params)
+        self.assertTrue(run_ganon(split_cfg, params["output_file"]), "ganon table exited with an error")
+        for rank in params["rank"]:
+            split_params = vars(split_cfg).copy()
+            split_params["output_file"] = self.results_dir + "test_split_rank." + rank + ".tsv"
+            res = table_sanity_check_and_parse(split_params)
+            self.assertIsNotNone(res, "ganon table has inconsistent results")
+
+            # Same as running ganon table for a single rank
+            single_params = params.copy()
+            single_params["output_file"] = self.results_dir + "test_split_rank_single." + rank + ".tsv"
+            single_params["rank"] = rank
+            single_params["split_rank"] = False
+            cfg = Config("table", **single_params)
+            self.assertTrue(run_ganon(cfg, single_params["output_file"]), "ganon table exited with an error")
+            with open(split_params["output_file"]) as split, open(single_params["output_file"]) as single:
+                self.assertEqual(split.read(), single.read(), "ganon table --split-rank has different results")
+
+        # --split-rank requires --rank
+        params["rank"] = ""
+        cfg = Config("table", **params)
+        self.assertFalse(run_ganon(cfg, params["output_file"]), "ganon table ran with --split-rank without --rank")
+
     def test_no_rank(self):
         """
         Test ganon table without specific --rank
@@ -480,6 +542,45 @@ class TestTable(unittest.TestCase):
         # should have 1 line with values higher than 0.02
         self.assertEqual(res["out_pd"].shape[0], 1, "ganon table skip zeros option failed")
 
+    def test_top_sample_min_frequency_skip_zeros(self):
+        """
+        Test ganon table with --top-sample, --min-frequency, --skip-zeros and --transpose combined
+        """
+        params = self.default_params.copy()
+        # report_reads4.tre has the same top species as report_reads1.tre
+        params["input"] = self.default_params["input"] + [self.results_dir + "report_reads4.tre"]
+        shutil.copy(data_dir + "table/report_reads1.tre", params["input"][-1])
+        params["min_frequency"] = 2
+        params["skip_zeros"] = True
+        files = [os.path.basename(f) for f in params["input"]]
+
+        # Top species of each file: Prevotella melaninogenica (1,4), Prevotella sp. oral taxon 313 (2), Veillonella tobetsuensis (3)
+        # Only the species present in 2 files is kept, files without it are skipped
+        # Top 2 species: Prevotella histicola (1,4) is also kept, sharing all files with non-zero counts
+        expected = {1: {"Prevotella melaninogenica": {files[0]: 31786, files[3]: 31786}},
+                    2: {"Prevotella melaninogenica": {files[0]: 31786, files[1]: 18928, files[2]: 18928, files[3]: 31786},
+                        "Prevotella histicola": {files[0]: 27732, files[1]: 0, files[2]: 0, files[3]: 27732}}}
+
+        for top_sample, expected_table in expected.items():
+            for transpose in [True, False]:
+                params["top_sample"] = top_sample
+                params["transpose"] = transpose
+                params["output_file"] = self.results_dir + "test_top_sample_min_frequency_skip_zeros_" + \
+                    str(top_sample) + ("_transpose" if transpose else "") + ".tsv"
+
+                # Build config from params
+                cfg = Config("table", **params)
+                # Run
+                self.assertTrue(run_ganon(cfg, params["output_file"]), "ganon table exited with an error")
+                # General sanity check of results
+                res = table_sanity_check_and_parse(vars(cfg))
+                self.assertIsNotNone(res, "ganon table has inconsistent results")
+
+                # Files as rows with --transpose, taxa as rows otherwise
+                table = res["out_pd"] if transpose else res["out_pd"].T
+                table.index = [os.path.basename(f) for f in table.index]
+                self.assertEqual(table.to_dict(), expected_table, "ganon table combined filters failed")
+
     def test_matches(self):
         """
         Test ganon table with report type "matches" from ganon report
@@ -530,5 +631,121 @@ class TestTable(unittest.TestCase):
         # check if printed taxid (just numeric for this specific test)
         self.assertTrue(all([c.isdigit() for c in res["out_pd"].columns.values]), "ganon table headers are wrong (taxid)")
 
+    def test_compressed(self):
+        """
+        Test ganon table with compressed input and output files
+        """
+        params = self.default_params.copy()
+        params["output_file"] = self.results_dir + "test_compressed_plain.tsv"
+        cfg = Config("table", **params)
+        self.assertTrue(run_ganon(cfg, params["output_file"]), "ganon table exited with an error")
+        res = table_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res, "ganon table has inconsistent results")
+
+        # Compress input reports
+        params["input"] = []
+        for tre_file in self.default_params["input"]:
+            gz_file = self.results_dir + os.path.basename(tre_file) + ".gz"
+            with open(tre_file, "rb") as f_in, gzip.open(gz_file, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            params["input"].append(gz_file)
+        params["output_file"] = self.results_dir + "test_compressed.tsv.gz"
+        cfg = Config("table", **params)
+        self.assertTrue(run_ganon(cfg, params["output_file"]), "ganon table exited with an error")
+        res_compressed = table_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res_compressed, "ganon table has inconsistent results")
+
+        # Same values, labels are the input files
+        self.assertTrue((res["out_pd"].values == res_compressed["out_pd"].values).all(), "ganon table has different results for compressed files")
+
+    def test_threads(self):
+        """
+        Test ganon table parsing files in parallel
+        """
+        params = self.default_params.copy()
+        params["output_file"] = self.results_dir + "test_threads_single.tsv"
+        cfg = Config("table", **params)
+        self.assertTrue(run_ganon(cfg, params["output_file"]), "ganon table exited with an error")
+
+        params["output_file"] = self.results_dir + "test_threads.tsv"
+        params["threads"] = 3
+        cfg = Config("table", **params)
+        self.assertTrue(run_ganon(cfg, params["output_file"]), "ganon table exited with an error")
+        res = table_sanity_check_and_parse(vars(cfg))
+        self.assertIsNotNone(res, "ganon table has inconsistent results")
+
+        # Same table (values and order) independent of the number of threads
+        with open(self.results_dir + "test_threads_single.tsv") as single, open(params["output_file"]) as threads:
+            self.assertEqual(single.read(), threads.read(), "ganon table has different results with threads")
+
+    def test_incremental(self):
+        """
+        Test ganon table with --incremental, adding and changing files
+        """
+        input_dir = self.results_dir + "test_incremental/"
+        os.makedirs(input_dir)
+        input_files = []
+        for tre_file in self.default_params["input"]:
+            input_files.append(input_dir + os.path.basename(tre_file))
+            shutil.copy(tre_file, input_files[-1])
+
+        params = self.default_params.copy()
+        params["incremental"] = True
+        params["output_file"] = self.results_dir + "test_incremental.tsv"
+        fresh_params = self.default_params.copy()
+        fresh_params["output_file"] = self.results_dir + "test_incremental_fresh.tsv"
+
+        for files in [input_files[:2], input_files]:
+            params["input"] = fresh_params["input"] = files
+            cfg = Config("table", **params)
+            self.assertTrue(run_ganon(cfg, params["output_file"]), "ganon table exited with an error")
+            self.assertTrue(os.path.isfile(params["output_file"] + ".cache"), "ganon table cache not written")
+            res = table_sanity_check_and_parse(vars(cfg))
+            self.assertIsNotNone(res, "ganon table has inconsistent results")
+
+            # Same as running without cache
+            cfg = Config("table", **fresh_params)
+            self.assertTrue(run_ganon(cfg, fresh_params["output_file"]), "ganon table exited with an error")
+            with open(params["output_file"]) as inc, open(fresh_params["output_file"]) as fresh:
+                self.assertEqual(inc.read(), fresh.read(), "ganon table --incremental has different results")
+
+        # Changed file is parsed again
+        with open(input_files[0]) as file:
+            lines = file.readlines()
+        with open(input_files[0], "w") as file:
+            file.writelines(lines[:len(lines)//2])
+        cfg = Config("table", **params)
+        self.assertTrue(run_ganon(cfg, params["output_file"]), "ganon table exited with an error")
+        cfg = Config("table", **fresh_params)
+        self.assertTrue(run_ganon(cfg, fresh_params["output_file"]), "ganon table exited with an error")
+        with open(params["output_file"]) as inc, open(fresh_params["output_file"]) as fresh:
+            self.assertEqual(inc.read(), fresh.read(), "ganon table --incremental has different results")
+
+    def test_low_memory(self):
+        """
+        Test ganon table with --low-memory, same results as in memory
+        """
+        for i, extra_params in enumerate([{},
+                                          {"rank": "", "transpose": False, "no_root": True},
+                                          {"top_all": 3, "unclassified_label": "unassigned", "filtered_label": "unassigned"},
+                                          {"top_sample": 2, "min_frequency": 2, "skip_zeros": True, "output_value": "percentage"}]):
+            params = self.default_params.copy()
+            params.update(extra_params)
+            params["output_file"] = self.results_dir + "test_low_memory_" + str(i) + "_memory.tsv"
+            cfg = Config("table", **params)
+            self.assertTrue(run_ganon(cfg, params["output_file"]), "ganon table exited with an error")
+
+            params["output_file"] = self.results_dir + "test_low_memory_" + str(i) + ".tsv"
+            params["low_memory"] = True
+            params["batch_size"] = 2
+            cfg = Config("table", **params)
+            self.assertTrue(run_ganon(cfg, params["output_file"]), "ganon table exited with an error")
+            res = table_sanity_check_and_parse(vars(cfg))
+            self.assertIsNotNone(res, "ganon table has inconsistent results")
+
+            with open(self.results_dir + "test_low_memory_" + str(i) + "_memory.tsv") as memory, open(params["output_file"]) as low_memory:
+                self.assertEqual(memory.read(), low_memory.read(), "ganon table --low-memory has different results")
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -10,6 +10,7 @@ from multitax import CustomTx
 
 sys.path.append('src')
 from ganon.util import download
+from ganon.matches import is_binary, iter_binary
 from ganon.config import Config
 from ganon import ganon
 
@@ -93,6 +94,15 @@ def parse_tsv(tsv_file):
 def parse_all_one(file):
     colums = ['readid', 'target', 'count']
     types = {'readid': 'str', 'target': 'str', 'count': 'uint64'}
+    if is_binary(file):
+        targets = {}
+        rows = []
+        for read_ids, offsets, target_ids, kcounts in iter_binary(file, targets):
+            targets_rev = list(targets.keys())
+            for i, readid in enumerate(read_ids):
+                for m in range(offsets[i], offsets[i+1]):
+                    rows.append([readid, targets_rev[target_ids[m]], kcounts[m]])
+        return pd.DataFrame(rows, columns=colums).astype(types)
     return pd.read_table(file, sep='\t', header=None, skiprows=0, names=colums, dtype=types)
 
 
@@ -253,7 +263,7 @@ def reassign_sanity_check_and_parse(params):
 
     res = {}
     if not params["remove_all"]:
-        res["all_pd"] = parse_all_one(params["input_prefix"]+".all")
+        res["all_pd"] = parse_all_one(params["input_prefix"][0]+".all")
         if res["all_pd"].empty:
             return None
 
@@ -291,8 +301,11 @@ def report_sanity_check_and_parse(params, sum_full_percentage: bool = True):
 
         res = {}
         # Sequence information from database to be updated
-        res["tre_pd"] = parse_tre(
-            out_tre, params["output_format"] if "output_format" in params else None)
+        # one output format per run
+        output_format = params["output_format"] if "output_format" in params else None
+        if isinstance(output_format, list):
+            output_format = output_format[0]
+        res["tre_pd"] = parse_tre(out_tre, output_format)
 
         # get idx for root (idx_root) and root + unclassified (idx_base)
         # strip white spaces for output_format text
@@ -0,0 +1,109 @@
+#include <utils/OutputFile.hpp>
+
+#include <catch2/catch.hpp>
+
+#include <zlib.h>
+
+#include <filesystem>
+#include <fstream>
+#include <sstream>
+#include <string>
+
+namespace
+{
+
+std::string read_gz( std::string const& file )
+{
+    std::string out;
+    gzFile      gz = gzopen( file.c_str(), "rb" );
+    char        buf[4096];
+    int         len;
+    while ( ( len = gzread( gz, buf, sizeof( buf ) ) ) > 0 )
+        out.append( buf, len );
+    gzclose( gz );
+    return out;
+}
+
+std::string read_plain( std::string const& file )
+{
+    std::ifstream     f( file, std::ios::binary );
+    std::stringstream ss;
+    ss << f.rdbuf();
+    return ss.str();
+}
+
+} // namespace
+
+SCENARIO( "Writing output files", "[utils][outputfile]" )
+{
+    const std::string content = "read1\ttarget1\t10\nread2\ttarget2\t20\n";
+
+    GIVEN( "A plain output file" )
+    {
+        const std::string file = "outputfile_plain.txt";
+        std::filesystem::remove( file );
+
+        WHEN( "it is written, closed and appended" )
+        {
+            OutputFile out;
+            out.open( file, false );
+            out << content;
+            out.close();
+            out.open( file, false, true );
+            out << content;
+            out.close();
+
+            THEN( "the content is written twice" )
+            {
+                REQUIRE( out.good() );
+                REQUIRE( read_plain( file ) == content + content );
+            }
+        }
+    }
+
+    GIVEN( "A compressed output file" )
+    {
+        const std::string file = "outputfile_compressed.txt.gz";
+        std::filesystem::remove( file );
+
+        WHEN( "more than the buffer size is written, closed and appended" )
+        {
+            std::string large;
+            for ( size_t i = 0; i < 10000; ++i )
+                large += content;
+
+            OutputFile out;
+            out.open( file, true );
+            out << large;
+            out.write( "\0\x01", 2 );
+            out.close();
+            out.open( file, true, true );
+            out << content;
+            out.close();
+
+            THEN( "the decompressed file contains all the content" )
+            {
+                REQUIRE( out.good() );
+                REQUIRE( read_plain( file ).substr( 0, 2 ) == "\x1f\x8b" );
+                REQUIRE( read_gz( file ) == large + std::string( "\0\x01", 2 ) + content );
+            }
+        }
+    }
+
+    GIVEN( "An output file in a missing folder" )
+    {
+        WHEN( "it is opened" )
+        {
+            OutputFile out_plain;
+            out_plain.open( "missing_folder/outputfile.txt", false );
+            OutputFile out_compressed;
+            out_compressed.open( "missing_folder/outputfile.txt.gz", true );
+
+            THEN( "the stream fails" )
+            {
+                REQUIRE( out_plain.fail() );
+                REQUIRE( out_compressed.fail() );
+            }
+        }
+    }
+}